@@ -182,8 +182,10 @@ install_debian() {
         libvirt-clients \
         virtinst \
         bridge-utils \
-        genisoimage \
         python3 \
+        python3-libvirt \
+        python3-zstandard \
+        zstd \
         openssh-client \
         dnsmasq-base
     
@@ -208,8 +210,10 @@ install_alpine() {
         libvirt-client \
         virt-install \
         bridge-utils \
-        cdrkit \
         python3 \
+        py3-libvirt \
+        py3-zstandard \
+        zstd \
         openssh-client \
         dnsmasq
     
@@ -2,6 +2,7 @@
 """nox - Lightweight VM Manager using libvirt/KVM"""
 
 import argparse
+import contextlib
 import json
 import math
 import os
@@ -10,7 +11,10 @@ import subprocess
 import sys
 import time
 import tempfile
+import threading
+import zlib
 import secrets
+import shlex
 import string
 
 def get_version():
@@ -31,8 +35,16 @@ VERSION = get_version()
 NOX_DIR = os.path.expanduser("~/.nox")
 VMS_DIR = os.path.join(NOX_DIR, "vms")
 IMAGES_DIR = os.path.join(NOX_DIR, "images")
+IMAGE_STORE_DIR = os.path.join(IMAGES_DIR, "sha512")
+IMAGE_INDEX_FILE = os.path.join(IMAGES_DIR, "index.json")
 BACKUPS_DIR = os.path.join(NOX_DIR, "backups")
+REPO_DIR = os.path.join(NOX_DIR, "repo")
+TEMPLATES_DIR = os.path.join(NOX_DIR, "templates")
 CONFIG_FILE = os.path.join(NOX_DIR, "config.json")
+CATALOG_FILE = os.path.join(NOX_DIR, "catalog.db")
+DAEMON_STATUS_FILE = os.path.join(NOX_DIR, "daemon.json")
+IP_CACHE_FILE = os.path.join(NOX_DIR, "ip-cache.json")
+LIBVIRT_URI = "qemu:///system"
 
 DEFAULT_CONFIG = {
     "defaults": {"os": "debian", "cpus": 1, "ram": 512, "disk": 5},
@@ -52,6 +64,7 @@ OS_IMAGES = {
     "debian": {
         "url": "https://cloud.debian.org/images/cloud/bookworm/latest/debian-12-genericcloud-arm64.qcow2",
         "url_amd64": "https://cloud.debian.org/images/cloud/bookworm/latest/debian-12-genericcloud-amd64.qcow2",
+        "sums": "https://cloud.debian.org/images/cloud/bookworm/latest/SHA512SUMS",
     },
 }
 
@@ -62,7 +75,9 @@ OS_IMAGES = {
 def ensure_dirs():
     os.makedirs(VMS_DIR, exist_ok=True)
     os.makedirs(IMAGES_DIR, exist_ok=True)
+    os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
     os.makedirs(BACKUPS_DIR, exist_ok=True)
+    os.makedirs(TEMPLATES_DIR, exist_ok=True)
 
 def load_config():
     if os.path.exists(CONFIG_FILE):
@@ -75,6 +90,18 @@ def save_config(cfg):
     with open(CONFIG_FILE, "w") as f:
         json.dump(cfg, f, indent=2)
 
+def write_json_atomic(path, data):
+    """Write JSON to path via a temp file + rename so readers never see half a file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
 def host_arch():
     m = os.uname().machine
     if m in ("aarch64", "arm64"):
@@ -117,19 +144,680 @@ def run(cmd, check=True, capture=True):
 
 def virsh(cmd, check=True):
     """Run a virsh command."""
-    return run(f"virsh --connect qemu:///system {cmd}", check=check, capture=True)
+    return run(f"virsh --connect {LIBVIRT_URI} {cmd}", check=check, capture=True)
+
+# ---------------------------------------------------------------------------
+# Hypervisor backends
+# ---------------------------------------------------------------------------
+
+# virsh-style names for libvirt's numeric domain states
+DOMAIN_STATES = {
+    0: "no state",
+    1: "running",
+    2: "idle",
+    3: "paused",
+    4: "in shutdown",
+    5: "shut off",
+    6: "crashed",
+    7: "pmsuspended",
+}
+
+class VirshBackend:
+    """Talks to libvirt by running one virsh process per operation."""
+
+    name = "virsh"
+
+    def list_names(self):
+        result = virsh("list --all --name", check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not list VMs: {result.stderr.strip()}")
+        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+    def exists(self, name):
+        return virsh(f"domstate {name}", check=False).returncode == 0
+
+    def state(self, name):
+        result = virsh(f"domstate {name}", check=False)
+        if result.returncode != 0:
+            return None
+        return result.stdout.strip()
+
+    def start(self, name):
+        virsh(f"start {name}")
+
+    def shutdown(self, name):
+        virsh(f"shutdown {name}")
+
+    def reboot(self, name):
+        virsh(f"reboot {name}")
+
+    def destroy(self, name, check=True):
+        virsh(f"destroy {name}", check=check)
+
+    def undefine(self, name, remove_storage=False, check=True):
+        flags = "--nvram --checkpoints-metadata"
+        if remove_storage:
+            flags += " --remove-all-storage"
+        virsh(f"undefine {name} {flags}", check=check)
+
+    def set_autostart(self, name, enabled=True):
+        virsh(f"autostart {name}" + ("" if enabled else " --disable"))
+
+    def dumpxml(self, name, inactive=False):
+        return virsh(f"dumpxml {name}{' --inactive' if inactive else ''}").stdout
+
+    def define(self, xml):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as tmp:
+            tmp.write(xml)
+            tmp_xml = tmp.name
+        try:
+            virsh(f"define {tmp_xml}")
+        finally:
+            os.unlink(tmp_xml)
+
+    def suspend(self, name):
+        virsh(f"suspend {name}")
+
+    def resume(self, name):
+        virsh(f"resume {name}")
+
+    def save(self, name, path):
+        virsh(f"save {name} {path}")
+
+    def restore(self, path, xml, paused=False):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as tmp:
+            tmp.write(xml)
+            tmp_xml = tmp.name
+        try:
+            virsh(f"restore {path} --xml {tmp_xml} {'--paused' if paused else '--running'}")
+        finally:
+            os.unlink(tmp_xml)
+
+    def dominfo(self, name):
+        info = {}
+        for line in virsh(f"dominfo {name}").stdout.splitlines():
+            if ":" in line:
+                key, value = line.split(":", 1)
+                info[key.strip()] = value.strip()
+        return info
+
+    def set_vcpus(self, name, vcpus):
+        virsh(f"setvcpus {name} {vcpus} --maximum --config")
+        virsh(f"setvcpus {name} {vcpus} --config")
+
+    def set_memory(self, name, ram_kb):
+        virsh(f"setmaxmem {name} {ram_kb} --config")
+        virsh(f"setmem {name} {ram_kb} --config")
+
+    def block_resize(self, name, disk_path, size_gb):
+        virsh(f"blockresize {name} {disk_path} {size_gb}G")
+
+    def snapshot_disk_only(self, name, snapshot, disk, overlay_path):
+        virsh(f"snapshot-create-as {name} {snapshot} --disk-only --atomic --no-metadata "
+              f"--diskspec {disk},snapshot=external,file={overlay_path}")
+
+    def block_commit(self, name, disk, check=True, bandwidth_mib=0):
+        bandwidth = f" --bandwidth {bandwidth_mib}" if bandwidth_mib else ""
+        virsh(f"blockcommit {name} {disk} --active --pivot{bandwidth}", check=check)
+
+    def block_pull(self, name, disk, bandwidth_mib=0):
+        bandwidth = f" --bandwidth {bandwidth_mib}" if bandwidth_mib else ""
+        virsh(f"blockpull {name} {disk}{bandwidth}")
+
+    def block_job_info(self, name, disk):
+        """Return {"cur", "end", "bandwidth"} for the disk's block job, or None."""
+        import re
+        result = virsh(f"blockjob {name} {disk} --raw", check=False)
+        fields = dict(re.findall(r"(\w+)=(\S+)", result.stdout))
+        if result.returncode != 0 or "cur" not in fields:
+            return None
+        return {key: int(fields.get(key, 0)) for key in ("cur", "end", "bandwidth")}
+
+    def backup_begin(self, name, backup_xml, checkpoint_xml=None):
+        paths = []
+        try:
+            for xml in (backup_xml, checkpoint_xml):
+                if xml is None:
+                    continue
+                with tempfile.NamedTemporaryFile(mode="w", suffix=".xml", delete=False) as tmp:
+                    tmp.write(xml)
+                    paths.append(tmp.name)
+            cmd = f"backup-begin {name} --backupxml {paths[0]}"
+            if checkpoint_xml is not None:
+                cmd += f" --checkpointxml {paths[1]}"
+            virsh(cmd)
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+    def job_wait(self, name, poll=0.5):
+        """Wait for the domain's current job to end; return its completed stats."""
+        while "None" not in self._jobinfo(name).get("Job type", "None"):
+            time.sleep(poll)
+        stats = self._jobinfo(name, "--completed")
+        if stats.get("Job type") != "Completed":
+            raise RuntimeError(f"job {stats.get('Job type', 'failed').lower()}: {stats.get('Error message', '')}")
+        return stats
+
+    def job_abort(self, name):
+        virsh(f"domjobabort {name}", check=False)
+
+    def _jobinfo(self, name, flags=""):
+        info = {}
+        for line in virsh(f"domjobinfo {name} {flags}").stdout.splitlines():
+            if ":" in line:
+                key, value = line.split(":", 1)
+                info[key.strip()] = value.strip()
+        return info
+
+    def checkpoints(self, name):
+        result = virsh(f"checkpoint-list {name} --name", check=False)
+        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+    def checkpoint_delete(self, name, checkpoint):
+        virsh(f"checkpoint-delete {name} {checkpoint}")
+
+    def fs_freeze(self, name):
+        virsh(f"domfsfreeze {name}")
+
+    def fs_thaw(self, name):
+        virsh(f"domfsthaw {name}")
+
+    def agent_command(self, name, command, timeout=None):
+        payload = json.dumps(command)
+        flags = f" --timeout {int(timeout)}" if timeout else ""
+        result = virsh(f"qemu-agent-command {name} '{payload}'{flags}")
+        return json.loads(result.stdout).get("return", {})
+
+    def interface_addresses(self, name):
+        """Return (mac, ipv4) pairs reported by the guest agent."""
+        result = virsh(f"domifaddr {name} --source agent", check=False)
+        if result.returncode != 0:
+            return []
+        pairs = []
+        for line in result.stdout.splitlines()[2:]:
+            parts = line.split()
+            # Continuation lines omit the interface name and MAC columns
+            if len(parts) >= 4 and parts[2] == "ipv4":
+                pairs.append((parts[1].lower(), parts[3].split("/")[0]))
+            elif len(parts) >= 3 and parts[1] == "ipv4" and pairs:
+                pairs.append((pairs[-1][0], parts[2].split("/")[0]))
+        return pairs
+
+    def domain_stats(self):
+        """Return {name: raw stats dict} for every domain from one domstats call."""
+        result = virsh("domstats --state --vcpu --balloon --block --interface", check=False)
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not query domain stats: {result.stderr.strip()}")
+        stats = {}
+        current = None
+        for line in result.stdout.splitlines():
+            line = line.strip()
+            if line.startswith("Domain:"):
+                current = stats.setdefault(line.split(":", 1)[1].strip().strip("'"), {})
+            elif current is not None and "=" in line:
+                key, value = line.split("=", 1)
+                current[key] = value
+        return stats
+
+    def dhcp_leases(self):
+        """Return (mac, ipv4) pairs from the DHCP leases of all active networks."""
+        pairs = []
+        for net in self.networks():
+            if net["state"] != "active":
+                continue
+            result = virsh(f"net-dhcp-leases {net['name']}", check=False)
+            for line in result.stdout.splitlines()[2:]:
+                parts = line.split()
+                if len(parts) >= 5 and parts[3] == "ipv4":
+                    pairs.append((parts[2].lower(), parts[4].split("/")[0]))
+        return pairs
+
+    def network_xml(self, network):
+        return virsh(f"net-dumpxml {network}").stdout
+
+    def networks(self):
+        result = virsh("net-list --all", check=False)
+        if result.returncode != 0:
+            return []
+        networks = []
+        for line in result.stdout.splitlines()[2:]:  # Skip header lines
+            parts = line.split()
+            if len(parts) >= 3:
+                networks.append({'name': parts[0], 'state': parts[1], 'type': 'libvirt'})
+        return networks
+
+class LibvirtBackend:
+    """Talks to libvirt through one persistent libvirt-python connection."""
+
+    name = "libvirt"
+
+    def __init__(self, libvirt_module):
+        self.libvirt = libvirt_module
+        # libvirt prints every error to stderr by default; we report our own
+        self.libvirt.registerErrorHandler(lambda ctx, err: None, None)
+        self.conn = self.libvirt.open(LIBVIRT_URI)
+
+    def _dom(self, name):
+        try:
+            return self.conn.lookupByName(name)
+        except self.libvirt.libvirtError as e:
+            raise RuntimeError(f"VM '{name}' not found: {e}")
+
+    def _call(self, what, func, *args):
+        try:
+            return func(*args)
+        except self.libvirt.libvirtError as e:
+            raise RuntimeError(f"{what} failed: {e}")
+
+    def list_names(self):
+        return [dom.name() for dom in self.conn.listAllDomains(0)]
+
+    def exists(self, name):
+        try:
+            self.conn.lookupByName(name)
+            return True
+        except self.libvirt.libvirtError:
+            return False
+
+    def state(self, name):
+        try:
+            state, _reason = self.conn.lookupByName(name).state()
+        except self.libvirt.libvirtError:
+            return None
+        return DOMAIN_STATES.get(state, "unknown")
+
+    def start(self, name):
+        self._call("start", self._dom(name).create)
+
+    def shutdown(self, name):
+        self._call("shutdown", self._dom(name).shutdown)
+
+    def reboot(self, name):
+        self._call("reboot", self._dom(name).reboot, 0)
+
+    def destroy(self, name, check=True):
+        try:
+            self._call("destroy", self._dom(name).destroy)
+        except RuntimeError:
+            if check:
+                raise
+
+    def undefine(self, name, remove_storage=False, check=True):
+        try:
+            dom = self._dom(name)
+            disks = self._disk_sources(dom.XMLDesc(0)) if remove_storage else []
+            self._call("undefine", dom.undefineFlags,
+                       self.libvirt.VIR_DOMAIN_UNDEFINE_NVRAM |
+                       self.libvirt.VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA)
+        except RuntimeError:
+            if check:
+                raise
+            return
+        # Like virsh --remove-all-storage, but never touch shared base images
+        for path in disks:
+            if os.path.abspath(path).startswith(VMS_DIR + os.sep) and os.path.exists(path):
+                os.remove(path)
+
+    def _disk_sources(self, xml):
+        import xml.etree.ElementTree as ET
+        root = ET.fromstring(xml)
+        return [src.get("file") for src in root.findall("./devices/disk[@device='disk']/source")
+                if src.get("file")]
+
+    def set_autostart(self, name, enabled=True):
+        self._call("autostart", self._dom(name).setAutostart, 1 if enabled else 0)
+
+    def dumpxml(self, name, inactive=False):
+        return self._call("dumpxml", self._dom(name).XMLDesc,
+                          self.libvirt.VIR_DOMAIN_XML_INACTIVE if inactive else 0)
+
+    def define(self, xml):
+        self._call("define", self.conn.defineXML, xml)
+
+    def suspend(self, name):
+        self._call("suspend", self._dom(name).suspend)
+
+    def resume(self, name):
+        self._call("resume", self._dom(name).resume)
+
+    def save(self, name, path):
+        self._call("save", self._dom(name).save, path)
+
+    def restore(self, path, xml, paused=False):
+        self._call("restore", self.conn.restoreFlags, path, xml,
+                   self.libvirt.VIR_DOMAIN_SAVE_PAUSED if paused else self.libvirt.VIR_DOMAIN_SAVE_RUNNING)
+
+    def dominfo(self, name):
+        dom = self._dom(name)
+        state, max_mem, mem, ncpus, _cputime = dom.info()
+        return {
+            "Id": str(dom.ID()) if dom.ID() >= 0 else "-",
+            "Name": dom.name(),
+            "UUID": dom.UUIDString(),
+            "State": DOMAIN_STATES.get(state, "unknown"),
+            "CPU(s)": str(ncpus),
+            "Max memory": f"{max_mem} KiB",
+            "Used memory": f"{mem} KiB",
+            "Persistent": "yes" if dom.isPersistent() else "no",
+            "Autostart": "enable" if dom.autostart() else "disable",
+        }
+
+    def set_vcpus(self, name, vcpus):
+        dom = self._dom(name)
+        lv = self.libvirt
+        self._call("setvcpus", dom.setVcpusFlags, vcpus,
+                   lv.VIR_DOMAIN_AFFECT_CONFIG | lv.VIR_DOMAIN_VCPU_MAXIMUM)
+        self._call("setvcpus", dom.setVcpusFlags, vcpus, lv.VIR_DOMAIN_AFFECT_CONFIG)
+
+    def set_memory(self, name, ram_kb):
+        dom = self._dom(name)
+        lv = self.libvirt
+        self._call("setmaxmem", dom.setMemoryFlags, ram_kb,
+                   lv.VIR_DOMAIN_AFFECT_CONFIG | lv.VIR_DOMAIN_MEM_MAXIMUM)
+        self._call("setmem", dom.setMemoryFlags, ram_kb, lv.VIR_DOMAIN_AFFECT_CONFIG)
+
+    def block_resize(self, name, disk_path, size_gb):
+        self._call("blockresize", self._dom(name).blockResize, disk_path,
+                   size_gb * 1024 ** 3, self.libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES)
+
+    def snapshot_disk_only(self, name, snapshot, disk, overlay_path):
+        lv = self.libvirt
+        xml = (f"<domainsnapshot><name>{snapshot}</name><memory snapshot='no'/>"
+               f"<disks><disk name='{disk}' snapshot='external'>"
+               f"<source file='{overlay_path}'/></disk></disks></domainsnapshot>")
+        flags = (lv.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | lv.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC |
+                 lv.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        self._call("snapshot", self._dom(name).snapshotCreateXML, xml, flags)
+
+    def block_commit(self, name, disk, check=True, bandwidth_mib=0):
+        lv = self.libvirt
+        try:
+            dom = self._dom(name)
+            self._call("blockcommit", dom.blockCommit, disk, None, None, int(bandwidth_mib),
+                       lv.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+            # Active commit never finishes on its own; pivot once it is in sync
+            while True:
+                info = self._call("blockjobinfo", dom.blockJobInfo, disk, 0)
+                if not info:
+                    break
+                if info["end"] and info["cur"] == info["end"]:
+                    self._call("blockjobabort", dom.blockJobAbort, disk,
+                               lv.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                    break
+                time.sleep(0.1)
+        except RuntimeError:
+            if check:
+                raise
+
+    def block_pull(self, name, disk, bandwidth_mib=0):
+        self._call("blockpull", self._dom(name).blockPull, disk, bandwidth_mib, 0)
+
+    def block_job_info(self, name, disk):
+        info = self._call("blockjobinfo", self._dom(name).blockJobInfo, disk, 0)
+        return {key: info[key] for key in ("cur", "end", "bandwidth")} if info else None
+
+    def backup_begin(self, name, backup_xml, checkpoint_xml=None):
+        self._call("backup-begin", self._dom(name).backupBegin, backup_xml, checkpoint_xml, 0)
+
+    def job_wait(self, name, poll=0.5):
+        lv = self.libvirt
+        dom = self._dom(name)
+        while self._call("jobstats", dom.jobStats, 0).get("type", 0) != lv.VIR_DOMAIN_JOB_NONE:
+            time.sleep(poll)
+        stats = self._call("jobstats", dom.jobStats, lv.VIR_DOMAIN_JOB_STATS_COMPLETED)
+        if stats.get("type") != lv.VIR_DOMAIN_JOB_COMPLETED:
+            raise RuntimeError(f"job failed: {stats.get('errmsg', '')}")
+        return stats
+
+    def job_abort(self, name):
+        try:
+            self._dom(name).abortJob()
+        except (RuntimeError, self.libvirt.libvirtError):
+            pass
+
+    def checkpoints(self, name):
+        try:
+            return [cp.getName() for cp in self._dom(name).listAllCheckpoints(0)]
+        except self.libvirt.libvirtError:
+            return []
+
+    def checkpoint_delete(self, name, checkpoint):
+        dom = self._dom(name)
+        self._call("checkpoint-delete", lambda: dom.checkpointLookupByName(checkpoint).delete(0))
+
+    def fs_freeze(self, name):
+        self._call("domfsfreeze", self._dom(name).fsFreeze, None, 0)
+
+    def fs_thaw(self, name):
+        self._call("domfsthaw", self._dom(name).fsThaw, None, 0)
+
+    def agent_command(self, name, command, timeout=None):
+        import libvirt_qemu
+        result = self._call("qemu-agent-command", libvirt_qemu.qemuAgentCommand,
+                            self._dom(name), json.dumps(command),
+                            int(timeout) if timeout else -1, 0)
+        return json.loads(result).get("return", {})
+
+    def interface_addresses(self, name):
+        lv = self.libvirt
+        try:
+            ifaces = self.conn.lookupByName(name).interfaceAddresses(
+                lv.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT, 0)
+        except lv.libvirtError:
+            return []
+        pairs = []
+        for iface in ifaces.values():
+            for addr in iface.get("addrs") or []:
+                if addr["type"] == lv.VIR_IP_ADDR_TYPE_IPV4:
+                    pairs.append(((iface.get("hwaddr") or "").lower(), addr["addr"]))
+        return pairs
+
+    def domain_stats(self):
+        lv = self.libvirt
+        wanted = (lv.VIR_DOMAIN_STATS_STATE | lv.VIR_DOMAIN_STATS_VCPU | lv.VIR_DOMAIN_STATS_BALLOON |
+                  lv.VIR_DOMAIN_STATS_BLOCK | lv.VIR_DOMAIN_STATS_INTERFACE)
+        records = self._call("domstats", self.conn.getAllDomainStats, wanted, 0)
+        return {dom.name(): dict(raw) for dom, raw in records}
+
+    def dhcp_leases(self):
+        lv = self.libvirt
+        pairs = []
+        for net in self.conn.listAllNetworks(lv.VIR_CONNECT_LIST_NETWORKS_ACTIVE):
+            try:
+                leases = net.DHCPLeases()
+            except lv.libvirtError:
+                continue
+            for lease in leases:
+                if lease.get("type") == lv.VIR_IP_ADDR_TYPE_IPV4:
+                    pairs.append((lease["mac"].lower(), lease["ipaddr"]))
+        return pairs
+
+    def network_xml(self, network):
+        try:
+            return self.conn.networkLookupByName(network).XMLDesc(0)
+        except self.libvirt.libvirtError as e:
+            raise RuntimeError(f"network '{network}' not found: {e}")
+
+    def networks(self):
+        return [{'name': net.name(), 'state': 'active' if net.isActive() else 'inactive',
+                 'type': 'libvirt'} for net in self.conn.listAllNetworks(0)]
+
+_backend = None
+
+def backend():
+    """Return the process-wide hypervisor backend, connecting on first use.
+
+    libvirt-python is preferred so every call reuses one connection; when it
+    is missing or cannot connect we fall back to running virsh. Set
+    NOX_BACKEND=virsh (or "backend" in config.json) to force the fallback.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    choice = os.environ.get("NOX_BACKEND") or load_config().get("backend", "auto")
+    if choice in ("auto", "libvirt"):
+        try:
+            import libvirt
+            _backend = LibvirtBackend(libvirt)
+            return _backend
+        except Exception as e:
+            if choice == "libvirt":
+                raise RuntimeError(f"libvirt-python backend unavailable: {e}")
+    _backend = VirshBackend()
+    return _backend
 
 def vm_exists(name):
     """Check if VM exists."""
-    result = virsh(f"dominfo {name}", check=False)
-    return result.returncode == 0
+    return backend().exists(name)
 
 def vm_state(name):
     """Get VM state."""
-    result = virsh(f"domstate {name}", check=False)
-    if result.returncode != 0:
+    return backend().state(name)
+
+def _stat_int(raw, key):
+    try:
+        return int(raw[key])
+    except (KeyError, ValueError):
         return None
-    return result.stdout.strip()
+
+def domain_summaries():
+    """Return one summary dict per domain, built from a single bulk stats query."""
+    summaries = []
+    for name, raw in sorted(backend().domain_stats().items()):
+        state = _stat_int(raw, "state.state")
+        mem_kb = _stat_int(raw, "balloon.maximum") or _stat_int(raw, "balloon.current")
+        disk = {}
+        for i in range(_stat_int(raw, "block.count") or 0):
+            if raw.get(f"block.{i}.name") == "vda":
+                disk = {
+                    "capacity": _stat_int(raw, f"block.{i}.capacity"),
+                    "allocation": _stat_int(raw, f"block.{i}.allocation"),
+                }
+        summaries.append({
+            "name": name,
+            "state": DOMAIN_STATES.get(state, "unknown") if state is not None else "unknown",
+            "vcpus": _stat_int(raw, "vcpu.current"),
+            "ram_mb": mem_kb // 1024 if mem_kb else None,
+            "disk_bytes": disk.get("capacity"),
+            "disk_allocated_bytes": disk.get("allocation"),
+            "interfaces": [raw[f"net.{i}.name"] for i in range(_stat_int(raw, "net.count") or 0)
+                           if f"net.{i}.name" in raw],
+        })
+    return summaries
+
+# ---------------------------------------------------------------------------
+# IP discovery
+# ---------------------------------------------------------------------------
+
+_ip_cache_lock = threading.Lock()
+
+def load_ip_cache():
+    try:
+        with open(IP_CACHE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"macs": {}, "domains": {}}
+
+def save_ip_cache(cache):
+    os.makedirs(NOX_DIR, exist_ok=True)
+    write_json_atomic(IP_CACHE_FILE, cache)
+
+def forget_ip_cache(name):
+    """Drop a deleted VM's MACs so a future VM of the same name starts clean."""
+    with _ip_cache_lock:
+        cache = load_ip_cache()
+        for mac in cache["domains"].pop(name, []):
+            cache["macs"].pop(mac, None)
+        save_ip_cache(cache)
+
+def domain_macs(name, cache):
+    """Return the VM's MAC addresses, remembering them in the cache (they never change)."""
+    macs = cache["domains"].get(name)
+    if macs is None:
+        import re
+        try:
+            xml = backend().dumpxml(name)
+        except RuntimeError:
+            return []
+        macs = sorted(set(m.lower() for m in re.findall(r"mac address='([^']+)'", xml)))
+        cache["domains"][name] = macs
+    return macs
+
+def neighbor_table():
+    """Return {mac: ipv4} from the kernel ARP table (covers macvtap guests)."""
+    table = {}
+    try:
+        with open("/proc/net/arp") as f:
+            for line in f.readlines()[1:]:
+                parts = line.split()
+                # Flags 0x2 = ATF_COM, i.e. a resolved entry
+                if len(parts) >= 4 and int(parts[2], 16) & 0x2:
+                    table[parts[3].lower()] = parts[0]
+    except OSError:
+        pass
+    return table
+
+def lookup_ips(names, agent=True):
+    """Resolve guest IPv4 addresses for several VMs in one pass.
+
+    Sources are tried cheapest first: the per-MAC cache (fresh within
+    ip_cache_ttl seconds), libvirt DHCP leases, the host neighbor table,
+    and finally the guest agent, which is only asked about the VMs still
+    unresolved. Misses are not retried; callers that need to wait poll.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    ttl = load_config().get("ip_cache_ttl", 300)
+    now = time.time()
+    results = {}
+
+    with _ip_cache_lock:
+        cache = load_ip_cache()
+        macs = {name: domain_macs(name, cache) for name in names}
+
+        def remember(mac, ip, source):
+            cache["macs"][mac] = {"ip": ip, "seen": now, "source": source}
+
+        def from_cache(name, max_age):
+            for mac in macs[name]:
+                entry = cache["macs"].get(mac)
+                if entry and now - entry["seen"] <= max_age:
+                    return entry["ip"]
+            return None
+
+        for name in names:
+            results[name] = from_cache(name, ttl)
+
+        missing = [n for n in names if not results[n]]
+        if missing:
+            wanted = set(mac for name in missing for mac in macs[name])
+            leases = dict(backend().dhcp_leases())
+            for mac, ip in neighbor_table().items():
+                if mac in wanted and mac not in leases:
+                    remember(mac, ip, "neighbor")
+            for mac, ip in leases.items():
+                if mac in wanted:
+                    remember(mac, ip, "lease")
+            for name in missing:
+                results[name] = from_cache(name, 0)
+
+        missing = [n for n in names if not results[n]]
+        if missing and agent:
+            def ask_agent(name):
+                return backend().interface_addresses(name)
+
+            with ThreadPoolExecutor(max_workers=min(16, len(missing))) as pool:
+                for name, pairs in zip(missing, pool.map(ask_agent, missing)):
+                    for mac, ip in pairs:
+                        if not ip.startswith("127."):
+                            remember(mac, ip, "agent")
+                            results[name] = results[name] or ip
+
+        save_ip_cache(cache)
+
+    return results
 
 def vm_dir(name):
     return os.path.join(VMS_DIR, name)
@@ -151,23 +839,50 @@ def save_meta(name, meta):
         json.dump(meta, f, indent=2)
 
 def vm_ip(name, timeout=60):
-    """Get VM IP address using qemu-guest-agent."""
+    """Wait up to timeout seconds for the VM's IP address (see lookup_ips)."""
     deadline = time.time() + timeout
 
-    while time.time() < deadline:
-        result = virsh(f"domifaddr {name} --source agent", check=False)
-        if result.returncode == 0:
-            stdout = result.stdout if isinstance(result.stdout, str) else result.stdout.decode('utf-8')
-            for line in stdout.splitlines():
-                if "ipv4" in line.lower() and "127.0.0.1" not in line:
-                    parts = line.split()
-                    for part in parts:
-                        if "/" in part and not part.startswith("127."):
-                            return part.split("/")[0]
-
-        time.sleep(2)
+    while True:
+        ip = lookup_ips([name]).get(name)
+        if ip:
+            return ip
+
+        # Leases show up well before the guest agent does, so poll briskly
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(1, remaining))
+
+def guest_exec(name, cmd_str, timeout=60):
+    """Run a shell command in the guest via qemu-guest-agent.
+
+    Returns (exitcode, stdout, stderr). Raises RuntimeError if the agent
+    rejects the command or it does not finish within timeout seconds.
+    """
+    import base64
+    ret = backend().agent_command(name, {
+        "execute": "guest-exec",
+        "arguments": {
+            "path": "/bin/bash",
+            "arg": ["-c", cmd_str],
+            "capture-output": True
+        }
+    })
+    pid = ret.get("pid")
+    if pid is None:
+        raise RuntimeError("guest-exec returned no pid")
 
-    return None
+    deadline = time.time() + timeout
+    delay = 0.05
+    while time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+        status = backend().agent_command(name, {"execute": "guest-exec-status", "arguments": {"pid": pid}})
+        if status.get("exited"):
+            out = base64.b64decode(status.get("out-data", "")).decode(errors="replace")
+            err = base64.b64decode(status.get("err-data", "")).decode(errors="replace")
+            return status.get("exitcode", 0), out, err
+    raise RuntimeError("Command timed out")
 
 def generate_password():
     """Generate random password."""
@@ -177,22 +892,7 @@ def generate_password():
 def list_networks():
     """List available libvirt networks."""
     try:
-        result = virsh("net-list --all", check=False)
-        if result.returncode != 0:
-            return []
-        
-        output = result.stdout
-        if isinstance(output, bytes):
-            output = output.decode('utf-8')
-        
-        networks = []
-        for line in output.splitlines()[2:]:  # Skip header lines
-            parts = line.split()
-            if len(parts) >= 3:
-                name = parts[0]
-                state = parts[1]
-                networks.append({'name': name, 'state': state, 'type': 'libvirt'})
-        return networks
+        return backend().networks()
     except Exception as e:
         print(f"Warning: Failed to list networks: {e}", file=sys.stderr)
         return []
@@ -291,146 +991,1607 @@ def select_network_interactive():
                 sys.exit(0)
 
 # ---------------------------------------------------------------------------
-# S3 Helper Functions
+# Disk streaming (NBD)
 # ---------------------------------------------------------------------------
 
-def upload_to_s3(backup_path, backup_name, s3_config):
-    """Upload backup to S3-compatible storage."""
+NBD_CHUNK = 4 * 1024 * 1024
+
+class IOBudget:
+    """Bandwidth and IOPS budget shared by every thread doing backup I/O.
+
+    Token buckets holding up to one second of burst; consume() blocks the
+    caller until its bytes and operations fit. A zero rate is unlimited.
+    Child processes (qemu-img, qemu-nbd) can't draw from the buckets, so
+    each gets an equal share of the rates, split `shares` ways.
+    """
+
+    def __init__(self, bandwidth_mb=0, iops=0):
+        self.lock = threading.Lock()
+        self.configure(bandwidth_mb, iops)
+
+    def configure(self, bandwidth_mb=0, iops=0, shares=1):
+        with self.lock:
+            self.rates = (float(bandwidth_mb or 0) * 1024 ** 2, float(iops or 0))
+            self.tokens = list(self.rates)
+            self.stamp = time.monotonic()
+            self.shares = max(1, shares)
+
+    def share(self):
+        """(bytes/s, IOPS) for one child process; 0 is unlimited."""
+        return tuple(int(rate / self.shares) for rate in self.rates)
+
+    def consume(self, nbytes, ops=1):
+        if not any(self.rates):
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = 0
+            for i, (rate, amount) in enumerate(zip(self.rates, (nbytes, ops))):
+                if rate:
+                    # Tokens may go negative; the caller sleeps off its own debt
+                    self.tokens[i] = min(rate, self.tokens[i] + (now - self.stamp) * rate) - amount
+                    wait = max(wait, -self.tokens[i] / rate)
+            self.stamp = now
+        if wait > 0:
+            time.sleep(wait)
+
+IO_BUDGET = IOBudget()
+UPLOAD_BUDGET = IOBudget()
+
+def throttle_settings(cfg=None):
+    """I/O caps in MB/s (0 = unlimited) for backup reads, restore writes and block jobs.
+
+    Read from config "throttle"; backup.bandwidth_mb / backup.iops and
+    restore.bandwidth_mb from older configs still set the same caps.
+    """
+    cfg = cfg or load_config()
+    backup, restore = cfg.get("backup", {}), cfg.get("restore", {})
+    return dict({"backup_mb": backup.get("bandwidth_mb", 0), "iops": backup.get("iops", 0),
+                 "restore_mb": restore.get("bandwidth_mb", 0), "blockjob_mb": 0, "cgroup": False},
+                **cfg.get("throttle", {}))
+
+def qemu_img_rate():
+    """qemu-img convert's -r option for this process's share of IO_BUDGET."""
+    rate = IO_BUDGET.share()[0]
+    return f"-r {rate} " if rate else ""
+
+def io_scope(read_path=None, write_path=None):
+    """Command prefix running a child in a systemd scope with cgroup io.max limits.
+
+    Used only with throttle.cgroup set: it caps the child's I/O on the
+    devices backing read_path/write_path at its share of IO_BUDGET,
+    including I/O qemu-img's own -r limit doesn't see. Returns a list.
+    """
+    rate, iops = IO_BUDGET.share()
+    if not (rate or iops) or not throttle_settings().get("cgroup") or not shutil.which("systemd-run"):
+        return []
+    cmd = ["systemd-run", "--scope", "--quiet", "--collect"]
+    for kind, path in (("Read", read_path), ("Write", write_path)):
+        if path and not path.startswith("nbd+"):
+            path = os.path.dirname(os.path.abspath(path)) if not os.path.exists(path) else path
+            if rate:
+                cmd += ["-p", f"IO{kind}BandwidthMax={path} {rate}"]
+            if iops:
+                cmd += ["-p", f"IO{kind}IOPSMax={path} {iops}"]
+    return cmd + ["--"] if len(cmd) > 4 else []
+
+def io_scope_prefix(read_path=None, write_path=None):
+    """io_scope() as a shell-quoted string for run()."""
+    return "".join(shlex.quote(arg) + " " for arg in io_scope(read_path, write_path))
+
+def vm_scope_unit(name):
+    """The systemd scope libvirt runs a VM's QEMU process in, or None."""
     try:
-        print(f"\nUploading backup to S3...")
-        
-        endpoint = s3_config.get("endpoint")
-        bucket = s3_config.get("bucket")
-        access_key = s3_config.get("access_key")
-        secret_key = s3_config.get("secret_key")
-        region = s3_config.get("region", "us-east-1")
-        
-        # Create tarball of backup
-        import tarfile
-        tarball_path = f"{backup_path}.tar.gz"
-        with tarfile.open(tarball_path, "w:gz") as tar:
-            tar.add(backup_path, arcname=backup_name)
-        
-        # Upload using AWS CLI or boto3
-        s3_path = f"s3://{bucket}/nox-backups/{backup_name}.tar.gz"
-        
-        # Try using aws cli first
-        env = os.environ.copy()
-        env["AWS_ACCESS_KEY_ID"] = access_key
-        env["AWS_SECRET_ACCESS_KEY"] = secret_key
-        env["AWS_DEFAULT_REGION"] = region
-        
-        if endpoint:
-            env["AWS_ENDPOINT_URL"] = endpoint
-            cmd = f"aws s3 cp {tarball_path} {s3_path} --endpoint-url {endpoint}"
+        with open(f"/run/libvirt/qemu/{name}.pid") as f:
+            pid = int(f.read().strip())
+        with open(f"/proc/{pid}/cgroup") as f:
+            for line in f:
+                for part in line.strip().split(":", 2)[-1].split("/"):
+                    if part.endswith(".scope"):
+                        return part
+    except (OSError, ValueError):
+        pass
+    return None
+
+class vm_io_limit:
+    """Context manager capping a VM's writes to target's device at its IO_BUDGET share.
+
+    Push-mode backup jobs copy inside QEMU, where neither qemu-img's -r
+    nor io_scope() reach. With throttle.cgroup set, the VM's machine scope
+    gets IOWriteBandwidthMax/IOWriteIOPSMax on the job's target for the
+    job's duration; the copy then runs at the cap, and guest writes to
+    the same device share it meanwhile. Without it, a warning is printed.
+    """
+
+    def __init__(self, name, target):
+        self.name, self.target, self.unit = name, target, None
+
+    def __enter__(self):
+        rate, iops = IO_BUDGET.share()
+        if not (rate or iops):
+            return self
+        if throttle_settings().get("cgroup") and shutil.which("systemctl"):
+            self.unit = vm_scope_unit(self.name)
+        if not self.unit:
+            print("Warning: push-mode backup jobs run inside QEMU and ignore --bandwidth/--iops "
+                  "unless throttle.cgroup is set", file=sys.stderr)
+            return self
+        path = self.target if os.path.exists(self.target) else os.path.dirname(os.path.abspath(self.target))
+        props = ([f"IOWriteBandwidthMax={path} {rate}"] if rate else []) + \
+                ([f"IOWriteIOPSMax={path} {iops}"] if iops else [])
+        run("systemctl set-property --runtime " + " ".join(shlex.quote(arg) for arg in [self.unit] + props))
+        return self
+
+    def __exit__(self, *exc):
+        if self.unit:
+            run(f"systemctl set-property --runtime {shlex.quote(self.unit)} IOWriteBandwidthMax= IOWriteIOPSMax=",
+                check=False)
+
+class NbdClient:
+    """Minimal NBD client (fixed newstyle handshake, simple replies).
+
+    One request is in flight per connection; open several clients on the
+    same export to read or write in parallel.
+    """
+
+    CMD_READ, CMD_WRITE, CMD_DISC, CMD_FLUSH = 0, 1, 2, 3
+
+    def __init__(self, socket_path, export=""):
+        import socket
+        import struct
+        self.struct = struct
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.handle = 0
+
+        magic, opt_magic, flags = struct.unpack(">QQH", self._recv(18))
+        if magic != 0x4e42444d41474943 or opt_magic != 0x49484156454f5054:
+            raise RuntimeError("not an NBD newstyle server")
+        self.sock.sendall(struct.pack(">I", flags & 0x3))  # FIXED_NEWSTYLE | NO_ZEROES
+
+        name = export.encode()
+        data = struct.pack(">I", len(name)) + name + struct.pack(">H", 0)
+        self.sock.sendall(struct.pack(">QII", 0x49484156454f5054, 7, len(data)) + data)  # NBD_OPT_GO
+        self.size = None
+        while True:
+            _magic, _opt, rtype, length = struct.unpack(">QIII", self._recv(20))
+            payload = self._recv(length)
+            if rtype == 1:  # NBD_REP_ACK
+                break
+            if rtype & 0x80000000:
+                raise RuntimeError(f"NBD export '{export}' refused: {payload.decode(errors='replace')}")
+            if rtype == 3 and struct.unpack(">H", payload[:2])[0] == 0:  # NBD_INFO_EXPORT
+                self.size = struct.unpack(">Q", payload[2:10])[0]
+
+    def _recv(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        got = 0
+        while got < n:
+            r = self.sock.recv_into(view[got:])
+            if not r:
+                raise RuntimeError("NBD connection closed")
+            got += r
+        return bytes(buf)
+
+    def _request(self, cmd, offset, length, data=b""):
+        self.handle += 1
+        self.sock.sendall(self.struct.pack(">IHHQQI", 0x25609513, 0, cmd, self.handle, offset, length) + data)
+        magic, error, _handle = self.struct.unpack(">IIQ", self._recv(16))
+        if magic != 0x67446698 or error:
+            raise RuntimeError(f"NBD request failed at offset {offset} (error {error})")
+
+    def read(self, offset, length):
+        self._request(self.CMD_READ, offset, length)
+        return self._recv(length)
+
+    def write(self, offset, data):
+        self._request(self.CMD_WRITE, offset, len(data), data)
+
+    def flush(self):
+        self._request(self.CMD_FLUSH, 0, 0)
+
+    def close(self):
+        try:
+            self.sock.sendall(self.struct.pack(">IHHQQI", 0x25609513, 0, self.CMD_DISC, 0, 0, 0))
+        except OSError:
+            pass
+        self.sock.close()
+
+class qemu_nbd_export:
+    """Context manager exporting a disk image over a private NBD unix socket."""
+
+    def __init__(self, image, fmt="qcow2", readonly=True, connections=1):
+        self.image, self.fmt, self.readonly, self.connections = image, fmt, readonly, connections
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nox-nbd-")
+        self.socket = os.path.join(self.tmpdir, "nbd.sock")
+        cmd = ["qemu-nbd", "--persistent", f"--shared={self.connections}", f"--format={self.fmt}",
+               f"--socket={self.socket}", "--cache=none", "--aio=threads"]
+        if self.readonly:
+            cmd.append("--read-only")
+        scope = io_scope(read_path=self.image) if self.readonly else io_scope(write_path=self.image)
+        self.proc = subprocess.Popen(scope + cmd + [self.image], stderr=subprocess.PIPE)
+        deadline = time.time() + 10
+        while not os.path.exists(self.socket):
+            if self.proc.poll() is not None or time.time() > deadline:
+                err = self.proc.stderr.read().decode() if self.proc.poll() is not None else "timeout"
+                self.__exit__(None, None, None)
+                raise RuntimeError(f"qemu-nbd failed to export {self.image}: {err}")
+            time.sleep(0.02)
+        return self.socket
+
+    def __exit__(self, *exc):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+def nbd_uri(socket_path, export):
+    return f"nbd+unix:///{export}?socket={socket_path}"
+
+def nbd_target(image):
+    """Split an nbd+unix:// URI into (socket, export); None for a plain file."""
+    if not image.startswith("nbd+unix://"):
+        return None
+    from urllib.parse import urlsplit, parse_qs
+    url = urlsplit(image)
+    return parse_qs(url.query)["socket"][0], url.path.lstrip("/")
+
+def allocated_extents(image):
+    """Return [(offset, length, has_data)] for an image (or NBD URI) from qemu-img map."""
+    result = run(f"qemu-img map -U --output=json {shlex.quote(image)}")
+    return [(e["start"], e["length"], e["data"]) for e in json.loads(result.stdout)]
+
+def image_data_bytes(image):
+    """Bytes of an image (with its backing chain) that hold data rather than holes or zeros."""
+    return sum(length for _offset, length, has_data in allocated_extents(image) if has_data)
+
+def image_virtual_size(image):
+    return json.loads(run(f"qemu-img info -U --output=json {shlex.quote(image)}").stdout)["virtual-size"]
+
+def read_extents(socket_path, export, extents, writer, readers=1):
+    """Copy extents from an NBD export into writer, in order.
+
+    Allocated chunks are fetched by `readers` concurrent connections with a
+    bounded read-ahead window; holes are emitted as zeros without a read.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    local = threading.local()
+    clients = []
+    lock = threading.Lock()
+
+    def fetch(offset, length):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = NbdClient(socket_path, export)
+            with lock:
+                clients.append(client)
+        IO_BUDGET.consume(length)
+        return client.read(offset, length)
+
+    zeros = bytes(NBD_CHUNK)
+    pending = deque()
+
+    def emit():
+        item = pending.popleft()
+        writer.write(zeros[:item] if isinstance(item, int) else item.result())
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, readers)) as pool:
+            try:
+                for offset, length, has_data in extents:
+                    end = offset + length
+                    while offset < end:
+                        n = min(NBD_CHUNK, end - offset)
+                        pending.append(pool.submit(fetch, offset, n) if has_data else n)
+                        offset += n
+                        while len(pending) > 2 * readers:
+                            emit()
+                while pending:
+                    emit()
+            except BaseException:
+                for item in pending:
+                    if not isinstance(item, int):
+                        item.cancel()
+                raise
+    finally:
+        for client in clients:
+            client.close()
+
+# ---------------------------------------------------------------------------
+# Compression codecs
+# ---------------------------------------------------------------------------
+
+BACKUP_CODECS = ("zstd", "zlib", "none", "dedup")
+
+def parse_codec(spec):
+    """Parse "zstd", "zstd:19", "zlib", "none" or "dedup[:LEVEL]" into (codec, level)."""
+    codec, _, level = (spec or "zstd").partition(":")
+    if codec not in BACKUP_CODECS:
+        raise RuntimeError(f"Unknown codec '{codec}' (choose from {', '.join(BACKUP_CODECS)})")
+    return codec, int(level) if level else None
+
+class _PipeCodec:
+    """Run an external (de)compressor, feeding it writes and pumping its output to sink."""
+
+    def __init__(self, cmd, sink):
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.sink = sink
+        self.pump = threading.Thread(target=self._pump, daemon=True)
+        self.pump.start()
+
+    def _pump(self):
+        for block in iter(lambda: self.proc.stdout.read(1024 * 1024), b""):
+            self.sink.write(block)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.pump.join()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"{self.proc.args[0]} exited with status {self.proc.returncode}")
+
+class _Passthrough:
+    def __init__(self, sink):
+        self.write = sink.write
+
+    def close(self):
+        pass
+
+def open_compressor(sink, codec, level=None, threads=1):
+    """Return a writer that compresses into sink; close() flushes it.
+
+    zstd runs multi-threaded through python3-zstandard when available,
+    otherwise through the zstd binary.
+    """
+    if codec == "none":
+        return _Passthrough(sink)
+    if codec == "zlib":
+        comp = zlib.compressobj(level if level is not None else 6, wbits=31)  # gzip framing
+
+        class _Zlib:
+            def write(self, data):
+                sink.write(comp.compress(data))
+
+            def close(self):
+                sink.write(comp.flush())
+        return _Zlib()
+    level = level if level is not None else 3
+    try:
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+        writer = cctx.stream_writer(sink, closefd=False)
+
+        class _Zstd:
+            write = writer.write
+
+            def close(self):
+                writer.flush(zstandard.FLUSH_FRAME)
+        return _Zstd()
+    except ImportError:
+        if not shutil.which("zstd"):
+            raise RuntimeError("zstd codec needs python3-zstandard or the zstd binary")
+        return _PipeCodec(["zstd", "-q", "-c", f"-T{threads}", f"-{level}"], sink)
+
+def open_decompressor(source, codec):
+    """Return a file-like object yielding the decompressed bytes of source."""
+    if codec == "none":
+        return source
+    if codec == "zlib":
+        import gzip
+        return gzip.GzipFile(fileobj=source)
+    try:
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(source, closefd=False)
+    except ImportError:
+        if not shutil.which("zstd"):
+            raise RuntimeError("zstd codec needs python3-zstandard or the zstd binary")
+        proc = subprocess.Popen(["zstd", "-q", "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed():
+            for block in iter(lambda: source.read(1024 * 1024), b""):
+                proc.stdin.write(block)
+            proc.stdin.close()
+        threading.Thread(target=feed, daemon=True).start()
+        return proc.stdout
+
+def stream_image(image, writer, readers=1):
+    """Write an image's full virtual contents as raw bytes into writer.
+
+    image is a file (exported through qemu-nbd) or an nbd+unix:// URI.
+    Only allocated extents are read over NBD; holes are emitted as zeros,
+    which cost the compressor next to nothing.
+    """
+    extents = allocated_extents(image)
+    target = nbd_target(image)
+    if target:
+        read_extents(target[0], target[1], extents, writer, readers)
+        return
+    with qemu_nbd_export(image, connections=readers) as sock:
+        read_extents(sock, "", extents, writer, readers)
+
+def unstream_image(reader, dest, virtual_size):
+    """Create qcow2 dest from a raw byte stream, skipping all-zero chunks."""
+    run(f"qemu-img create -q -f qcow2 {dest} {virtual_size}")
+    zeros = bytes(NBD_CHUNK)
+    with qemu_nbd_export(dest, readonly=False) as sock:
+        client = NbdClient(sock)
+        try:
+            offset = 0
+            while offset < virtual_size:
+                want = min(NBD_CHUNK, virtual_size - offset)
+                chunk = b""
+                while len(chunk) < want:
+                    block = reader.read(want - len(chunk))
+                    if not block:
+                        raise RuntimeError("backup stream ended early")
+                    chunk += block
+                if chunk != zeros[:want]:
+                    IO_BUDGET.consume(want)
+                    client.write(offset, chunk)
+                offset += want
+            client.flush()
+        finally:
+            client.close()
+
+# ---------------------------------------------------------------------------
+# Deduplicating chunk repository
+# ---------------------------------------------------------------------------
+
+CDC_BLOCK = 4096                # disks change in filesystem blocks; cut only between them
+CDC_MIN = 64 * 1024
+CDC_MAX = 4 * 1024 * 1024
+CDC_MASK = 0x3f                 # ~64 blocks past the minimum: ~320KiB average chunks
+CDC_MAGIC = zlib.crc32(bytes(CDC_BLOCK)) & CDC_MASK  # zero blocks always qualify as cut points
+ZERO_MIN = bytes(CDC_MIN)
+S3_REPO_PREFIX = "nox-repo/chunks/"
+S3_REPO_MANIFESTS = "nox-repo/manifests/"
+S3_REPO_GC = "nox-repo/gc.json"
+
+def chunk_path(digest):
+    return os.path.join(REPO_DIR, "chunks", digest[:2], digest)
+
+def repo_lock(exclusive=False):
+    """Lock the chunk repository: shared for writers, exclusive for garbage collection.
+
+    Returns the open lock file; the lock is released when it is closed.
+    """
+    import fcntl
+    os.makedirs(REPO_DIR, exist_ok=True)
+    f = open(os.path.join(REPO_DIR, "lock"), "a")
+    fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return f
+
+def pack_chunk(data, level=None):
+    """Compress one chunk; the first byte records the codec used."""
+    try:
+        import zstandard
+        return b"Z" + zstandard.ZstdCompressor(level=level or 3).compress(data)
+    except ImportError:
+        return b"z" + zlib.compress(data, level or 6)
+
+def unpack_chunk(blob):
+    if blob[:1] == b"Z":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(blob[1:])
+    return zlib.decompress(blob[1:])
+
+class RepoWriter:
+    """Write-only stream split into content-defined chunks in REPO_DIR.
+
+    A chunk ends after a 4KiB block whose masked crc32 equals CDC_MAGIC
+    (within CDC_MIN..CDC_MAX), so identical data in different disks or
+    backups yields identical chunks even when shifted by whole blocks.
+    Chunks are stored once under their sha256, compressed individually;
+    zero regions split into all-zero chunks that are only recorded as
+    runs. close() returns the manifest. The repository stays share-locked
+    until then, so pruning cannot collect chunks this writer reuses.
+    """
+
+    def __init__(self, level=None, threads=1):
+        from concurrent.futures import ThreadPoolExecutor
+        os.makedirs(os.path.join(REPO_DIR, "chunks"), exist_ok=True)
+        self.repo_lock = repo_lock()
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.slots = threading.Semaphore(2 * max(1, threads))
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.buf = bytearray()
+        self.scanned = 0
+        self.entries = []
+        self.stats = {"logical_bytes": 0, "data_bytes": 0, "chunk_count": 0, "new_chunks": 0, "stored_bytes": 0}
+
+    def write(self, data):
+        self.stats["logical_bytes"] += len(data)
+        if not self.buf and len(data) % CDC_MIN == 0 and data == bytes(len(data)):
+            self._emit_zero(len(data))
+            return len(data)
+        self.buf += data
+        buf, pos = self.buf, self.scanned
+        while pos + CDC_BLOCK <= len(buf):
+            if pos == 0 and len(buf) >= CDC_MIN and buf[:CDC_MIN] == ZERO_MIN:
+                # Fast path for holes: a zero chunk always ends at CDC_MIN
+                self._emit_zero(CDC_MIN)
+                del buf[:CDC_MIN]
+                continue
+            pos += CDC_BLOCK
+            if pos >= CDC_MAX or (pos >= CDC_MIN and
+                                  zlib.crc32(buf[pos - CDC_BLOCK:pos]) & CDC_MASK == CDC_MAGIC):
+                self._emit(bytes(buf[:pos]))
+                del buf[:pos]
+                pos = 0
+        self.scanned = pos
+        return len(data)
+
+    def _emit_zero(self, length):
+        last = self.entries[-1] if self.entries else None
+        if isinstance(last, list) and last[0] is None:
+            last[1] += length
         else:
-            cmd = f"aws s3 cp {tarball_path} {s3_path}"
-        
-        result = subprocess.run(cmd, shell=True, env=env, capture_output=True, text=True)
-        
-        # Clean up tarball
-        os.remove(tarball_path)
-        
-        if result.returncode == 0:
-            print(f"✓ Backup uploaded to S3: {s3_path}")
+            self.entries.append([None, length])
+
+    def _emit(self, chunk):
+        if chunk == bytes(len(chunk)):
+            self._emit_zero(len(chunk))
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self._store, chunk)
+        future.add_done_callback(lambda _f: self.slots.release())
+        self.entries.append(future)
+
+    def _store(self, chunk):
+        import hashlib
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = chunk_path(digest)
+        with self.lock:
+            new = digest not in self.seen and not os.path.exists(path)
+            self.seen.add(digest)
+            self.stats["chunk_count"] += 1
+            self.stats["data_bytes"] += len(chunk)
+        if new:
+            blob = pack_chunk(chunk, self.level)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.tmp.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, path)
+            with self.lock:
+                self.stats["new_chunks"] += 1
+                self.stats["stored_bytes"] += len(blob)
+        return [digest, len(chunk)]
+
+    def close(self, manifest_path=None):
+        """Finish the stream; write the manifest to manifest_path while still locked."""
+        try:
+            if self.buf:
+                self._emit(bytes(self.buf))
+                self.buf = bytearray()
+            try:
+                chunks = [e if isinstance(e, list) else e.result() for e in self.entries]
+            finally:
+                self.pool.shutdown()
+                repo_store_usage(add_chunks=self.stats["new_chunks"], add_bytes=self.stats["stored_bytes"])
+            manifest = dict({"version": 1, "chunks": chunks}, **self.stats)
+            if manifest_path:
+                write_json_atomic(manifest_path, manifest)
+            return manifest
+        finally:
+            self.repo_lock.close()
+
+class RepoReader:
+    """Sequential reader reassembling a chunk manifest, with parallel fetches.
+
+    Chunks missing from the local repository are fetched from S3 when an
+    S3Client is given. Every chunk is verified against its hash.
+    """
+
+    def __init__(self, manifest, s3_client=None, threads=4):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        self.s3 = s3_client
+        self.threads = max(1, threads)
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.items = self._items(manifest["chunks"])
+        self.pending = deque()
+        self.buf = bytearray()
+
+    def _items(self, chunks):
+        for digest, length in chunks:
+            if digest is None:
+                while length > 0:
+                    yield min(length, NBD_CHUNK)
+                    length -= NBD_CHUNK
+            else:
+                yield self.pool.submit(self._fetch, digest, length)
+
+    def _fetch(self, digest, length):
+        import hashlib
+        path = chunk_path(digest)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                blob = f.read()
         else:
-            print(f"Warning: Failed to upload to S3: {result.stderr}", file=sys.stderr)
-            
+            resp = self.s3.get(f"{S3_REPO_PREFIX}{digest[:2]}/{digest}") if self.s3 else None
+            if resp is None:
+                raise RuntimeError(f"chunk {digest} is missing from the repository")
+            blob = resp.read()
+        data = unpack_chunk(blob)
+        if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError(f"chunk {digest} is corrupt")
+        return data
+
+    def read(self, n=-1):
+        while n < 0 or len(self.buf) < n:
+            while len(self.pending) < 2 * self.threads:
+                item = next(self.items, None)
+                if item is None:
+                    break
+                self.pending.append(item)
+            if not self.pending:
+                break
+            item = self.pending.popleft()
+            self.buf += bytes(item) if isinstance(item, int) else item.result()
+        n = len(self.buf) if n < 0 else min(n, len(self.buf))
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def close(self):
+        for item in self.pending:
+            if not isinstance(item, int):
+                item.cancel()
+        self.pool.shutdown(wait=True)
+
+def repo_s3_client():
+    s3_config = load_config().get("s3", {})
+    return S3Client(s3_config) if s3_config.get("enabled") else None
+
+def s3_chunk_record(generation=None, add=()):
+    """Return REPO_DIR/s3-chunks.json: the chunks this host knows are in S3.
+
+    The record is only valid for the gc.json generation it was made under.
+    With generation, the record is replaced (when it is for another
+    generation) or extended with add, then written back.
+    """
+    path = os.path.join(REPO_DIR, "s3-chunks.json")
+    record = {"generation": None, "chunks": []}
+    if os.path.exists(path):
+        with open(path) as f:
+            record = json.load(f)
+    if generation is not None:
+        if record["generation"] != generation:
+            record = {"generation": generation, "chunks": []}
+        record["chunks"] = sorted(set(record["chunks"]).union(add))
+        write_json_atomic(path, record)
+    return record
+
+def s3_known_chunks(client):
+    """Return (digests, generation) for the chunks in the S3 repository.
+
+    gc_s3_repo() bumps the generation in S3_REPO_GC whenever it deletes
+    chunks, so the local record is used as long as the generation matches;
+    otherwise the chunk prefix is listed once and the record rebuilt.
+    Chunks uploaded since are safe from any GC for s3.gc_grace_hours.
+    """
+    doc, _etag = s3_read_json(client, S3_REPO_GC)
+    generation = (doc or {}).get("generation", 0)
+    record = s3_chunk_record()
+    if record["generation"] == generation:
+        return set(record["chunks"]), generation
+    have = {obj["key"].rsplit("/", 1)[-1] for obj in client.list(S3_REPO_PREFIX)}
+    s3_chunk_record(generation, have)
+    return have, generation
+
+def upload_repo_chunks(manifest, client):
+    """Upload the manifest's chunks that the S3 repository does not have yet."""
+    from concurrent.futures import ThreadPoolExecutor
+    have, generation = s3_known_chunks(client)
+    missing = sorted({d for d, _ in manifest["chunks"] if d is not None} - have)
+    if not missing:
+        print("  All chunks already in S3")
+        return
+
+    def put(digest):
+        with open(chunk_path(digest), "rb") as f:
+            blob = f.read()
+        client.put(f"{S3_REPO_PREFIX}{digest[:2]}/{digest}", blob)
+        return len(blob)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=client.parallel) as pool:
+        total = sum(pool.map(put, missing))
+    s3_chunk_record(generation, missing)
+    elapsed = max(time.time() - started, 1e-6)
+    print(f"  Uploaded {len(missing)} new chunks, {total / 1024 ** 2:.1f}MB "
+          f"({total / 1024 ** 2 / elapsed:.1f}MB/s)")
+
+_repo_usage_lock = threading.Lock()
+
+def repo_store_usage(refresh=False, add_chunks=0, add_bytes=0):
+    """Return {"chunks", "stored_bytes"} for the chunk store, kept in REPO_DIR/usage.json.
+
+    Writers add what they stored; refresh recounts the store from disk.
+    """
+    path = os.path.join(REPO_DIR, "usage.json")
+    with _repo_usage_lock:
+        usage = None
+        if not refresh and os.path.exists(path):
+            with open(path) as f:
+                usage = json.load(f)
+        if usage is None:
+            usage = {"chunks": 0, "stored_bytes": 0}
+            for root, _dirs, files in os.walk(os.path.join(REPO_DIR, "chunks")):
+                for filename in files:
+                    usage["chunks"] += 1
+                    usage["stored_bytes"] += os.path.getsize(os.path.join(root, filename))
+            refresh = True
+        if add_chunks or add_bytes or refresh:
+            usage["chunks"] += add_chunks
+            usage["stored_bytes"] += add_bytes
+            if os.path.isdir(REPO_DIR):
+                write_json_atomic(path, usage)
+        return usage
+
+def repo_usage(refresh=False):
+    """Return logical vs stored totals over local dedup backups and the repository."""
+    usage = {"backups": 0, "logical_bytes": 0, "data_bytes": 0}
+    for (info,) in catalog().execute("SELECT info FROM backups WHERE local=1 AND disk_format='chunks'"):
+        info = json.loads(info or "{}")
+        usage["backups"] += 1
+        usage["logical_bytes"] += info.get("logical_bytes", 0)
+        usage["data_bytes"] += info.get("data_bytes", 0)
+    if usage["backups"] or refresh:
+        usage.update(repo_store_usage(refresh))
+    return usage
+
+BACKUP_ENGINES = ("snapshot", "push", "pull")
+
+def backup_settings(cfg=None):
+    return dict({"codec": "zstd", "threads": host_cpus(), "engine": "snapshot", "readers": 4},
+                **(cfg or load_config()).get("backup", {}))
+
+def allocated_bytes(path):
+    """Bytes actually allocated on the host filesystem for path."""
+    return os.stat(path).st_blocks * 512 if os.path.exists(path) else 0
+
+def export_disk(disk_path, backup_path, vm_name, codec_spec, threads, readers=1, base=None):
+    """Write disk_path into the backup directory, compressing exactly once.
+
+    disk_path may be an image file or an nbd+unix:// URI. Returns a dict
+    describing the written disk for backup_info.json. zlib keeps the
+    historic compressed-qcow2 format; none writes a sparse qcow2; zstd
+    streams the raw disk from `readers` NBD connections into a
+    multi-threaded zstd file. With base (the disk's backing image), only
+    data above it is written, as a qcow2 overlay compressed in-format.
+    """
+    codec, level = parse_codec(codec_spec)
+    coroutines = max(1, min(16, threads))
+    if base:
+        disk_file = f"{vm_name}.qcow2"
+        flags = {"zlib": "-c", "zstd": "-c -o compression_type=zstd"}.get(codec, f"-m {coroutines} -W")
+        run(f"{io_scope_prefix(disk_path, backup_path)}qemu-img convert {qemu_img_rate()}-O qcow2 {flags} "
+            f"-B {shlex.quote(base)} -F qcow2 {shlex.quote(disk_path)} {os.path.join(backup_path, disk_file)}")
+        return {"disk_file": disk_file, "disk_format": "qcow2", "codec": codec_spec or "zstd",
+                "virtual_size": image_virtual_size(disk_path),
+                "disk_bytes": os.path.getsize(os.path.join(backup_path, disk_file)),
+                "base": {"sha512": base_image_hash(base), "file": os.path.basename(base),
+                         "path": os.path.abspath(base)}}
+    if codec == "dedup":
+        disk_file = f"{vm_name}.chunks.json"
+        virtual_size = image_virtual_size(disk_path)
+        writer = RepoWriter(level, threads)
+        stream_image(disk_path, writer, readers)
+        manifest = writer.close(os.path.join(backup_path, disk_file))
+        print(f"  {manifest['chunk_count']} chunks, {manifest['new_chunks']} new "
+              f"({manifest['stored_bytes'] / 1024 ** 2:.1f}MB stored)")
+        return {"disk_file": disk_file, "disk_format": "chunks", "codec": codec_spec,
+                "virtual_size": virtual_size, "disk_bytes": manifest["stored_bytes"],
+                "logical_bytes": manifest["logical_bytes"], "data_bytes": manifest["data_bytes"]}
+    if codec == "zstd":
+        disk_file = f"{vm_name}.raw.zst"
+        virtual_size = image_virtual_size(disk_path)
+        with open(os.path.join(backup_path, disk_file), "wb") as out:
+            writer = open_compressor(out, codec, level, threads)
+            stream_image(disk_path, writer, readers)
+            writer.close()
+        fmt = "raw.zst"
+    else:
+        disk_file = f"{vm_name}.qcow2"
+        virtual_size = None
+        flags = "-c" if codec == "zlib" else f"-m {coroutines} -W"
+        run(f"{io_scope_prefix(disk_path, backup_path)}qemu-img convert {qemu_img_rate()}-O qcow2 {flags} "
+            f"{shlex.quote(disk_path)} {os.path.join(backup_path, disk_file)}")
+        fmt = "qcow2"
+    return {"disk_file": disk_file, "disk_format": fmt, "codec": codec_spec or "zstd",
+            "virtual_size": virtual_size,
+            "disk_bytes": os.path.getsize(os.path.join(backup_path, disk_file))}
+
+def import_disk(backup_path, info, restore_disk):
+    """Recreate a VM disk from a backup written by export_disk (or an older nox)."""
+    disk_file = info.get("disk_file") or f"{info['vm_name']}.qcow2"
+    src = os.path.join(backup_path, disk_file)
+    if info.get("base"):
+        # Re-attach the overlay to the verified local copy of its base image
+        base = fetch_base_image(info["base"]["sha512"], info["base"])
+        spec = {"driver": "qcow2", "file": {"driver": "file", "filename": src},
+                "backing": {"driver": "qcow2", "file": {"driver": "file", "filename": base}}}
+        run(f"{io_scope_prefix(src, restore_disk)}qemu-img convert {qemu_img_rate()}-O qcow2 "
+            f"-B {shlex.quote(base)} -F qcow2 {shlex.quote('json:' + json.dumps(spec))} {restore_disk}")
+    elif info.get("type") in ("incremental", "differential"):
+        # Layer full + increments without modifying any backup file
+        run(f"{io_scope_prefix(src, restore_disk)}qemu-img convert {qemu_img_rate()}-O qcow2 "
+            f"{shlex.quote(chain_image_spec(info['chain']))} {restore_disk}")
+    elif info.get("disk_format") == "raw.zst":
+        with open(src, "rb") as f:
+            unstream_image(open_decompressor(f, "zstd"), restore_disk, info["virtual_size"])
+    elif info.get("disk_format") == "chunks":
+        with open(src) as f:
+            reader = RepoReader(json.load(f), repo_s3_client())
+        try:
+            unstream_image(reader, restore_disk, info["virtual_size"])
+        finally:
+            reader.close()
+    else:
+        run(f"{io_scope_prefix(src, restore_disk)}qemu-img convert {qemu_img_rate()}-O qcow2 {src} {restore_disk}")
+
+# ---------------------------------------------------------------------------
+# S3 Helper Functions
+# ---------------------------------------------------------------------------
+
+S3_PREFIX = "nox-backups/"
+S3_IMAGES_PREFIX = "nox-images/"
+S3_MANIFEST_PREFIX = S3_PREFIX + "_manifests/"
+S3_INDEX_KEY = S3_PREFIX + "_index.json"
+S3_MIN_PART = 5 * 1024 ** 2
+
+def sigv4_headers(method, url, headers, payload_hash, access_key, secret_key, region,
+                  amz_date=None, service="s3"):
+    """Return headers signed with AWS Signature Version 4 for url."""
+    import hashlib
+    import hmac
+    from urllib.parse import urlsplit, quote, unquote, parse_qsl
+
+    amz_date = amz_date or time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    date = amz_date[:8]
+    parts = urlsplit(url)
+    headers = dict({k.lower(): str(v).strip() for k, v in headers.items()},
+                   **{"host": parts.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+    signed = ";".join(sorted(headers))
+    query = "&".join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}"
+                     for k, v in sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    # The URL path is already percent-encoded (S3Client.url); encode the raw key exactly once
+    canonical = "\n".join([method, quote(unquote(parts.path) or "/", safe="/-_.~"), query,
+                           "".join(f"{k}:{headers[k]}\n" for k in sorted(headers)), signed, payload_hash])
+    scope = f"{date}/{region}/{service}/aws4_request"
+    to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+
+    key = ("AWS4" + secret_key).encode()
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed}, Signature={signature}")
+    return headers
+
+class S3Client:
+    """Small S3 client (path-style requests, SigV4) for S3-compatible storage."""
+
+    def __init__(self, s3_config):
+        self.region = s3_config.get("region", "us-east-1")
+        self.endpoint = (s3_config.get("endpoint") or f"https://s3.{self.region}.amazonaws.com").rstrip("/")
+        self.bucket = s3_config.get("bucket")
+        self.access_key = s3_config.get("access_key")
+        self.secret_key = s3_config.get("secret_key")
+        self.part_size = max(S3_MIN_PART, int(s3_config.get("part_size_mb", 64)) * 1024 ** 2)
+        self.parallel = max(1, int(s3_config.get("parallel", 4)))
+
+    def url(self, key="", query=None):
+        from urllib.parse import quote, urlencode
+        url = f"{self.endpoint}/{self.bucket}/{quote(key, safe='/-_.~')}"
+        return url + ("?" + urlencode(query) if query else "")
+
+    def request(self, method, key="", query=None, body=b"", headers=None, stream=False, retries=3):
+        """Send a signed request; return the response (body read unless stream)."""
+        import hashlib
+        import urllib.error
+        import urllib.request
+        url = self.url(key, query)
+        payload_hash = hashlib.sha256(body).hexdigest()
+        if body:
+            UPLOAD_BUDGET.consume(len(body))
+        for attempt in range(retries):
+            signed = sigv4_headers(method, url, headers or {}, payload_hash,
+                                   self.access_key, self.secret_key, self.region)
+            signed.pop("host")
+            req = urllib.request.Request(url, data=body if method in ("PUT", "POST") else None,
+                                         method=method, headers=signed)
+            try:
+                resp = urllib.request.urlopen(req, timeout=300)
+                if not stream:
+                    resp.body = resp.read()
+                return resp
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or attempt == retries - 1:
+                    detail = e.read().decode(errors="replace")[:300]
+                    raise RuntimeError(f"S3 {method} {key or self.bucket} failed: HTTP {e.code} {detail}")
+            except (urllib.error.URLError, OSError) as e:
+                if attempt == retries - 1:
+                    raise RuntimeError(f"S3 {method} {key or self.bucket} failed: {e}")
+            time.sleep(2 ** attempt)
+
+    def get(self, key, byte_range=None):
+        """Return a streaming response for key, or None if it does not exist."""
+        headers = {"range": f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else {}
+        try:
+            return self.request("GET", key, headers=headers, stream=True)
+        except RuntimeError as e:
+            if "HTTP 404" in str(e):
+                return None
+            raise
+
+    def put(self, key, data, headers=None):
+        return self.request("PUT", key, body=data, headers=headers)
+
+    def head(self, key):
+        """Return the object's size, or None if it does not exist."""
+        try:
+            return int(self.request("HEAD", key).headers["Content-Length"])
+        except RuntimeError as e:
+            if "HTTP 404" in str(e):
+                return None
+            raise
+
+    def list(self, prefix):
+        """Yield {key, size, modified} for every object under prefix."""
+        import xml.etree.ElementTree as ET
+        query = {"list-type": "2", "prefix": prefix}
+        while True:
+            root = ET.fromstring(self.request("GET", "", query=query).body)
+            ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+            for item in root.iter(f"{ns}Contents"):
+                yield {"key": item.findtext(f"{ns}Key"), "size": int(item.findtext(f"{ns}Size", "0")),
+                       "modified": item.findtext(f"{ns}LastModified", "")}
+            token = root.findtext(f"{ns}NextContinuationToken")
+            if root.findtext(f"{ns}IsTruncated") != "true" or not token:
+                return
+            query["continuation-token"] = token
+
+    def delete_many(self, keys):
+        """Delete keys with multi-object DELETE requests (1000 per request).
+
+        Returns the keys S3 reported as not deleted.
+        """
+        import base64
+        import hashlib
+        import xml.etree.ElementTree as ET
+        from xml.sax.saxutils import escape
+        keys, failed = list(keys), []
+        for start in range(0, len(keys), 1000):
+            body = ("<Delete><Quiet>true</Quiet>" + "".join(
+                f"<Object><Key>{escape(k)}</Key></Object>" for k in keys[start:start + 1000]) +
+                "</Delete>").encode()
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+            root = ET.fromstring(self.request("POST", "", query={"delete": ""}, body=body,
+                                              headers={"Content-MD5": md5}).body)
+            ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+            failed += [e.findtext(f"{ns}Key") for e in root.iter(f"{ns}Error")]
+        return failed
+
+class S3MultipartWriter:
+    """Write-only stream uploaded to S3 as concurrent multipart parts.
+
+    At most `parallel` parts are buffered or in flight at once, so memory
+    stays bounded at about parallel * part_size.
+    """
+
+    def __init__(self, client, key, label="upload"):
+        import xml.etree.ElementTree as ET
+        from concurrent.futures import ThreadPoolExecutor
+        self.client, self.key, self.label = client, key, label
+        root = ET.fromstring(client.request("POST", key, query={"uploads": ""}).body)
+        ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+        self.upload_id = root.findtext(f"{ns}UploadId")
+        self.pool = ThreadPoolExecutor(max_workers=client.parallel)
+        self.slots = threading.Semaphore(client.parallel)
+        self.lock = threading.Lock()
+        self.buf = bytearray()
+        self.parts = []
+        self.total = 0
+        self.started = time.time()
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.client.part_size:
+            chunk = bytes(self.buf[:self.client.part_size])
+            del self.buf[:self.client.part_size]
+            self._submit(chunk)
+        return len(data)
+
+    def _submit(self, chunk):
+        self.slots.acquire()
+        for future in self.parts:
+            if future.done() and future.exception():
+                self.slots.release()
+                raise future.exception()
+        number = len(self.parts) + 1
+        future = self.pool.submit(self._upload, number, chunk)
+        future.add_done_callback(lambda _f: self.slots.release())
+        self.parts.append(future)
+        self.total += len(chunk)
+
+    def _upload(self, number, chunk):
+        started = time.time()
+        resp = self.client.request("PUT", self.key, query={"partNumber": str(number), "uploadId": self.upload_id},
+                                   body=chunk)
+        elapsed = max(time.time() - started, 1e-6)
+        with self.lock:
+            print(f"  part {number}: {len(chunk) / 1024 ** 2:.1f}MB in {elapsed:.1f}s "
+                  f"({len(chunk) / 1024 ** 2 / elapsed:.1f}MB/s)")
+        return resp.headers["ETag"]
+
+    def close(self):
+        """Upload what is left and complete the object; return bytes uploaded."""
+        try:
+            if self.buf or not self.parts:
+                self._submit(bytes(self.buf))
+                self.buf = bytearray()
+            etags = [f.result() for f in self.parts]
+        except BaseException:
+            self.abort()
+            raise
+        self.pool.shutdown()
+        body = "<CompleteMultipartUpload>" + "".join(
+            f"<Part><PartNumber>{i}</PartNumber><ETag>{etag}</ETag></Part>"
+            for i, etag in enumerate(etags, 1)) + "</CompleteMultipartUpload>"
+        resp = self.client.request("POST", self.key, query={"uploadId": self.upload_id}, body=body.encode())
+        if b"<Error>" in resp.body:
+            raise RuntimeError(f"S3 multipart completion failed: {resp.body.decode(errors='replace')[:300]}")
+        elapsed = max(time.time() - self.started, 1e-6)
+        print(f"  {self.label}: {self.total / 1024 ** 2:.1f}MB in {len(etags)} parts, "
+              f"{self.total / 1024 ** 2 / elapsed:.1f}MB/s overall")
+        return self.total
+
+    def abort(self):
+        for future in self.parts:
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        try:
+            self.client.request("DELETE", self.key, query={"uploadId": self.upload_id})
+        except RuntimeError:
+            pass
+
+class S3RangeReader:
+    """Sequential file-like reader over an S3 object.
+
+    Parts are fetched as ranged GETs by `parallel` threads, keeping up to
+    `parallel` parts in flight ahead of the reader.
+    """
+
+    def __init__(self, client, key, size):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        self.client, self.key, self.size = client, key, size
+        self.pool = ThreadPoolExecutor(max_workers=client.parallel)
+        self.pending = deque()
+        self.next_offset = 0
+        self.buf = bytearray()
+        self.started = time.time()
+        self._fill()
+
+    def _fetch(self, offset, length):
+        resp = self.client.get(self.key, (offset, offset + length - 1))
+        data = resp.read() if resp is not None else b""
+        if len(data) != length:
+            raise RuntimeError(f"short read from S3 at offset {offset} ({len(data)} of {length} bytes)")
+        return data
+
+    def _fill(self):
+        while len(self.pending) < self.client.parallel and self.next_offset < self.size:
+            length = min(self.client.part_size, self.size - self.next_offset)
+            self.pending.append(self.pool.submit(self._fetch, self.next_offset, length))
+            self.next_offset += length
+
+    def read(self, n=-1):
+        while (n < 0 or len(self.buf) < n) and self.pending:
+            self.buf += self.pending.popleft().result()
+            self._fill()
+        n = len(self.buf) if n < 0 else min(n, len(self.buf))
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown(wait=True)
+
+def extract_backup_member(tar, member, backup_name, dest=None):
+    """Check a member of a backup tar and, given dest, extract it there.
+
+    Only plain files and directories under backup_name/ are accepted;
+    links, devices, absolute paths and ".." are refused.
+    """
+    import tarfile
+    name = os.path.normpath(member.name)
+    if backup_name in ("", ".", "..") or "/" in backup_name or not (member.isfile() or member.isdir()) \
+            or (name != backup_name and not name.startswith(f"{backup_name}/")):
+        raise RuntimeError(f"unexpected entry in backup archive: {member.name}")
+    if dest is not None:
+        tar.extract(member, dest, **({"filter": "data"} if hasattr(tarfile, "data_filter") else {}))
+
+class S3BackupStream:
+    """A backup tar streamed from S3, for restoring without local copies.
+
+    The metadata files at the front of the tar are unpacked into a scratch
+    directory (backup_path) on open; restore_disk() then decodes the disk
+    image, which comes last, straight into the destination file.
+    `streamable` is False for backups that must be downloaded instead:
+    incremental chains, and tars from older nox with the disk first.
+    """
+
+    METADATA = ("backup_info.json", "meta.json", "domain.xml", "user-data", "meta-data", "cloud-init.iso")
+
+    def __init__(self, backup_name, s3_config):
+        self.client = S3Client(s3_config)
+        for suffix in (".tar", ".tar.gz"):
+            key = f"{S3_PREFIX}{backup_name}{suffix}"
+            size = self.client.head(key)
+            if size is not None:
+                break
+        else:
+            raise RuntimeError(f"Backup '{backup_name}' not found in S3")
+        self.scratch = tempfile.TemporaryDirectory(prefix="nox-restore-")
+        self.backup_path = os.path.join(self.scratch.name, backup_name)
+        self.reader = S3RangeReader(self.client, key, size)
+        try:
+            self._open(backup_name)
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self, backup_name):
+        import tarfile
+        self.tar = tarfile.open(fileobj=self.reader, mode="r|*")
+        self.info, self.disk_member, self.streamable = None, None, True
+        for member in self.tar:
+            extract_backup_member(self.tar, member, backup_name)
+            filename = os.path.basename(member.name)
+            if member.isfile() and self.info and filename == self.disk_file:
+                self.disk_member = member
+                break
+            if member.isfile() and filename not in self.METADATA:
+                self.streamable = False
+                break
+            extract_backup_member(self.tar, member, backup_name, self.scratch.name)
+            if filename == "backup_info.json":
+                with open(os.path.join(self.backup_path, filename)) as f:
+                    self.info = json.load(f)
+                if self.info.get("type") in ("incremental", "differential"):
+                    self.streamable = False
+                    break
+        if self.streamable and self.disk_member is None:
+            raise RuntimeError("backup archive has no disk image")
+
+    @property
+    def disk_file(self):
+        return self.info.get("disk_file") or f"{self.info['vm_name']}.qcow2"
+
+    def restore_disk(self, dest):
+        source = self.tar.extractfile(self.disk_member)
+        if self.info.get("disk_format") == "raw.zst":
+            unstream_image(open_decompressor(source, "zstd"), dest, self.info["virtual_size"])
+        elif self.info.get("disk_format") == "chunks":
+            reader = RepoReader(json.load(source), self.client, self.client.parallel)
+            try:
+                unstream_image(reader, dest, self.info["virtual_size"])
+            finally:
+                reader.close()
+        else:
+            # A (possibly compressed) qcow2 is usable as the VM disk as-is
+            with open(dest, "wb") as out:
+                shutil.copyfileobj(source, out, NBD_CHUNK)
+            if self.info.get("base"):
+                base = fetch_base_image(self.info["base"]["sha512"], self.info["base"])
+                run(f"qemu-img rebase -u -F qcow2 -b {shlex.quote(base)} {shlex.quote(dest)}")
+        elapsed = max(time.time() - self.reader.started, 1e-6)
+        print(f"  Streamed {self.reader.next_offset / 1024 ** 2:.1f}MB from S3 "
+              f"({self.reader.next_offset / 1024 ** 2 / elapsed:.1f}MB/s)")
+
+    def close(self):
+        self.reader.close()
+        self.scratch.cleanup()
+
+def write_backup_tar(backup_path, backup_name, fileobj):
+    """Stream a backup directory into fileobj as an uncompressed tar.
+
+    Small metadata files come first and the disk image last, so a reader
+    of the stream knows how to handle the disk before it arrives.
+    """
+    import tarfile
+    info = load_backup_info(backup_name) or {}
+    disk_file = info.get("disk_file")
+    files = sorted(os.listdir(backup_path), key=lambda f: (f == disk_file, f))
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        tar.add(backup_path, arcname=backup_name, recursive=False)
+        for filename in files:
+            tar.add(os.path.join(backup_path, filename), arcname=f"{backup_name}/{filename}")
+
+def upload_base_image(sha512, client, recorded=None):
+    """Upload a base image to S3 once; later backups only reference it."""
+    key = f"{S3_IMAGES_PREFIX}{sha512}.qcow2"
+    if client.head(key) is not None:
+        return
+    path = find_base_image(sha512, recorded)
+    if not path:
+        raise RuntimeError(f"base image {sha512[:16]}... is missing locally")
+    print(f"  Uploading base image {sha512[:16]}... (first backup referencing it)")
+    writer = S3MultipartWriter(client, key, label="base image")
+    try:
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, writer, client.part_size)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+def upload_to_s3(backup_path, backup_name, s3_config):
+    """Upload backup to S3-compatible storage; returns False (after a warning) on failure."""
+    try:
+        upload_backup(backup_path, backup_name, S3Client(s3_config))
+        return True
     except Exception as e:
         print(f"Warning: S3 upload failed: {e}", file=sys.stderr)
+        return False
 
-def list_s3_backups(s3_config):
-    """List backups from S3."""
+def upload_backup(backup_path, backup_name, client):
+    """Upload a backup as a streamed tar (no temp files) and record it; raises on failure."""
+    key = f"{S3_PREFIX}{backup_name}.tar"
+    print(f"\nUploading backup to S3 ({client.part_size // 1024 ** 2}MB parts, {client.parallel} in parallel)...")
+    info = load_backup_info(backup_name) or {}
+    # Held shared so a prune on this host cannot sweep chunks or base images mid-upload
+    lock = repo_lock()
     try:
-        endpoint = s3_config.get("endpoint")
-        bucket = s3_config.get("bucket")
-        access_key = s3_config.get("access_key")
-        secret_key = s3_config.get("secret_key")
-        region = s3_config.get("region", "us-east-1")
-        
-        env = os.environ.copy()
-        env["AWS_ACCESS_KEY_ID"] = access_key
-        env["AWS_SECRET_ACCESS_KEY"] = secret_key
-        env["AWS_DEFAULT_REGION"] = region
-        
-        s3_path = f"s3://{bucket}/nox-backups/"
-        
-        if endpoint:
-            env["AWS_ENDPOINT_URL"] = endpoint
-            cmd = f"aws s3 ls {s3_path} --endpoint-url {endpoint}"
-        else:
-            cmd = f"aws s3 ls {s3_path}"
-        
-        result = subprocess.run(cmd, shell=True, env=env, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            backups = []
-            for line in result.stdout.splitlines():
-                parts = line.split()
-                if len(parts) >= 4 and parts[-1].endswith('.tar.gz'):
-                    backup_name = parts[-1].replace('.tar.gz', '')
-                    date_str = f"{parts[0]} {parts[1]}"
-                    size = parts[2]
-                    backups.append({
-                        'name': backup_name,
-                        'date': date_str,
-                        'size': size,
-                        'source': 's3'
-                    })
-            return backups
+        if info.get("base") or info.get("disk_format") == "chunks":
+            # The reference document goes first: chunks and base images that S3
+            # already has are reused, and gc_s3_repo() must see them as live
+            # before the tar and the VM manifest exist.
+            refs = {"version": 1, "chunks": []}
+            if info.get("disk_format") == "chunks":
+                with open(os.path.join(backup_path, info["disk_file"])) as f:
+                    refs = json.load(f)
+            if info.get("base"):
+                refs["base_sha512"] = info["base"]["sha512"]
+            client.put(f"{S3_REPO_MANIFESTS}{backup_name}.json", json.dumps(refs).encode())
+        if info.get("base"):
+            upload_base_image(info["base"]["sha512"], client, info["base"])
+        if info.get("disk_format") == "chunks":
+            upload_repo_chunks(refs, client)
+        writer = S3MultipartWriter(client, key, label=backup_name)
+        try:
+            write_backup_tar(backup_path, backup_name, writer)
+        except BaseException:
+            writer.abort()
+            raise
+        size = writer.close()
+    finally:
+        lock.close()
+    if info:
+        info.setdefault("backup_name", backup_name)
+        catalog_record(info, backup_path)
+    catalog_set_remote(backup_name, key, size, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+                       info.get("vm_name"), info.get("timestamp"))
+    if info.get("vm_name"):
+        s3_manifest_update(client, info["vm_name"], add=[s3_manifest_entry(info, key, size)])
+    print(f"✓ Backup uploaded to S3: s3://{client.bucket}/{key}")
+
+def s3_read_json(client, key):
+    """Return (document, etag) for a JSON object, or (None, None) if absent."""
+    resp = client.get(key)
+    if resp is None:
+        return None, None
+    with resp:
+        return json.loads(resp.read()), resp.headers.get("ETag")
+
+def s3_update_json(client, key, mutate, attempts=10):
+    """Read-modify-write a JSON object atomically via conditional PUTs.
+
+    mutate(doc or None) returns the new document. If another writer
+    changed the object in between (HTTP 412), the update is retried on
+    the fresh copy.
+    """
+    import random
+    for attempt in range(attempts):
+        doc, etag = s3_read_json(client, key)
+        doc = mutate(doc)
+        headers = {"If-Match": etag} if etag else {"If-None-Match": "*"}
+        try:
+            client.put(key, json.dumps(doc, indent=1).encode(), headers=headers)
+            return doc
+        except RuntimeError as e:
+            if "HTTP 412" not in str(e) and "HTTP 409" not in str(e):
+                raise
+        time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    raise RuntimeError(f"could not update s3://{client.bucket}/{key}: too many concurrent writers")
+
+def s3_manifest_key(vm_name):
+    return f"{S3_MANIFEST_PREFIX}{vm_name}.json"
+
+def s3_manifest_entry(info, key, size):
+    return {"name": info["backup_name"], "key": key, "bytes": size,
+            "timestamp": info.get("timestamp"), "type": info.get("type", "full"),
+            "parent": info.get("parent"), "chain": info.get("chain", [info["backup_name"]]),
+            "disk_format": info.get("disk_format"), "disk_sha256": info.get("disk_sha256"),
+            "base_sha512": (info.get("base") or {}).get("sha512"),
+            "uploaded": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())}
+
+def s3_manifest_update(client, vm_name, add=(), remove=()):
+    """Add entries to / remove backup names from a VM's manifest, then sync the root index."""
+    add_names = {entry["name"] for entry in add}
+
+    def change(doc):
+        doc = doc or {"format": 1, "vm": vm_name, "version": 0, "backups": []}
+        kept = [b for b in doc["backups"] if b["name"] not in add_names and b["name"] not in remove]
+        doc["backups"] = sorted(kept + list(add), key=lambda b: (b.get("timestamp") or "", b["name"]))
+        doc["version"] += 1
+        doc["updated"] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        return doc
+
+    manifest = s3_update_json(client, s3_manifest_key(vm_name), change)
+
+    def change_index(doc):
+        doc = doc or {"format": 1, "version": 0, "vms": {}}
+        if doc["vms"].get(vm_name, {}).get("version", 0) >= manifest["version"]:
+            return doc  # a concurrent writer already recorded a newer manifest
+        if manifest["backups"]:
+            doc["vms"][vm_name] = {"backups": len(manifest["backups"]),
+                                   "latest": manifest["backups"][-1].get("timestamp"),
+                                   "bytes": sum(b.get("bytes") or 0 for b in manifest["backups"]),
+                                   "version": manifest["version"]}
         else:
-            return []
-            
+            doc["vms"][vm_name] = {"backups": 0, "version": manifest["version"]}
+        doc["version"] += 1
+        return doc
+
+    s3_update_json(client, S3_INDEX_KEY, change_index)
+    return manifest
+
+def rebuild_s3_manifests(client):
+    """Build manifests and the root index from a one-off listing of the bucket.
+
+    Used once for buckets written by older nox versions.
+    """
+    print("Indexing S3 backups (one-time)...")
+    by_vm = {}
+    for obj in client.list(S3_PREFIX):
+        name = obj["key"][len(S3_PREFIX):]
+        if "/" in name or not name.endswith((".tar.gz", ".tar")):
+            continue
+        backup_name = name[:-len(".tar.gz")] if name.endswith(".tar.gz") else name[:-len(".tar")]
+        vm_name, _, timestamp = backup_name.rpartition("_")
+        vm_name, _, day = vm_name.rpartition("_")
+        info = {"backup_name": backup_name, "timestamp": f"{day}_{timestamp}", "type": None}
+        entry = dict(s3_manifest_entry(info, obj["key"], obj["size"]),
+                     uploaded=obj["modified"][:19].replace("T", " "), chain=None)
+        by_vm.setdefault(vm_name or backup_name, []).append(entry)
+    for vm_name, entries in by_vm.items():
+        s3_manifest_update(client, vm_name, add=entries)
+    if not by_vm:
+        s3_update_json(client, S3_INDEX_KEY, lambda doc: doc or {"format": 1, "version": 1, "vms": {}})
+
+def list_s3_backups(s3_config):
+    """List backups from S3: one GET for the index plus one per VM manifest.
+
+    Returns None (after a warning) if S3 could not be read.
+    """
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        client = S3Client(s3_config)
+        index, _ = s3_read_json(client, S3_INDEX_KEY)
+        if index is None:
+            rebuild_s3_manifests(client)
+            index, _ = s3_read_json(client, S3_INDEX_KEY)
+        with ThreadPoolExecutor(max_workers=client.parallel) as pool:
+            manifests = list(pool.map(lambda vm: s3_read_json(client, s3_manifest_key(vm))[0],
+                                      sorted(vm for vm, summary in index["vms"].items() if summary["backups"])))
+        backups = []
+        for manifest in filter(None, manifests):
+            for entry in manifest["backups"]:
+                backups.append(dict(entry, vm_name=manifest["vm"], date=entry.get("uploaded"),
+                                    size=f"{(entry.get('bytes') or 0) / 1024 ** 3:.2f}GB", source='s3'))
+        return backups
     except Exception as e:
         print(f"Warning: Failed to list S3 backups: {e}", file=sys.stderr)
-        return []
+        return None
 
 def download_from_s3(backup_name, s3_config):
-    """Download backup from S3."""
+    """Download backup from S3, extracting the tar stream as it arrives."""
     try:
         print(f"Downloading backup from S3...")
-        
-        endpoint = s3_config.get("endpoint")
-        bucket = s3_config.get("bucket")
-        access_key = s3_config.get("access_key")
-        secret_key = s3_config.get("secret_key")
-        region = s3_config.get("region", "us-east-1")
-        
-        env = os.environ.copy()
-        env["AWS_ACCESS_KEY_ID"] = access_key
-        env["AWS_SECRET_ACCESS_KEY"] = secret_key
-        env["AWS_DEFAULT_REGION"] = region
-        
-        s3_path = f"s3://{bucket}/nox-backups/{backup_name}.tar.gz"
-        tarball_path = os.path.join(BACKUPS_DIR, f"{backup_name}.tar.gz")
-        
-        if endpoint:
-            env["AWS_ENDPOINT_URL"] = endpoint
-            cmd = f"aws s3 cp {s3_path} {tarball_path} --endpoint-url {endpoint}"
-        else:
-            cmd = f"aws s3 cp {s3_path} {tarball_path}"
-        
-        result = subprocess.run(cmd, shell=True, env=env, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            # Extract tarball
-            import tarfile
-            with tarfile.open(tarball_path, "r:gz") as tar:
-                tar.extractall(BACKUPS_DIR)
-            
-            # Clean up tarball
-            os.remove(tarball_path)
-            
-            print(f"✓ Backup downloaded from S3")
-            return True
+        import tarfile
+        client = S3Client(s3_config)
+
+        # Older nox versions uploaded gzipped tarballs
+        for suffix in (".tar", ".tar.gz"):
+            resp = client.get(f"{S3_PREFIX}{backup_name}{suffix}")
+            if resp is not None:
+                break
         else:
-            print(f"Error: Failed to download from S3: {result.stderr}", file=sys.stderr)
+            print(f"Error: Backup '{backup_name}' not found in S3", file=sys.stderr)
             return False
-            
+
+        os.makedirs(BACKUPS_DIR, exist_ok=True)
+        with resp, tarfile.open(fileobj=resp, mode="r|*") as tar:
+            for member in tar:
+                extract_backup_member(tar, member, backup_name, BACKUPS_DIR)
+
+        info = load_backup_info(backup_name)
+        if info:
+            info.setdefault("backup_name", backup_name)
+            catalog_record(info)
+        print(f"✓ Backup downloaded from S3")
+        return True
+
     except Exception as e:
         print(f"Error: S3 download failed: {e}", file=sys.stderr)
         return False
 
+# ---------------------------------------------------------------------------
+# Backup catalog
+# ---------------------------------------------------------------------------
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    vm_name TEXT,
+    timestamp TEXT,
+    type TEXT,
+    parent TEXT,
+    chain TEXT,
+    disk_format TEXT,
+    codec TEXT,
+    size_bytes INTEGER,
+    disk_sha256 TEXT,
+    base_sha512 TEXT,
+    local INTEGER DEFAULT 0,
+    s3_key TEXT,
+    s3_size INTEGER,
+    s3_modified TEXT,
+    restored_at TEXT,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_vm ON backups (vm_name, timestamp);
+CREATE TABLE IF NOT EXISTS upload_queue (
+    backup_name TEXT PRIMARY KEY,
+    enqueued_at REAL,
+    attempts INTEGER DEFAULT 0,
+    next_attempt REAL DEFAULT 0,
+    last_error TEXT
+);
+"""
+
+_catalog = threading.local()
+
+def catalog():
+    """Return this thread's connection to the backup catalog (~/.nox/catalog.db)."""
+    db = getattr(_catalog, "db", None)
+    if db is None:
+        import sqlite3
+        os.makedirs(NOX_DIR, exist_ok=True)
+        db = _catalog.db = sqlite3.connect(CATALOG_FILE, timeout=30)
+        db.row_factory = sqlite3.Row
+        # WAL lets the daemon and CLI commands read and write concurrently
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(CATALOG_SCHEMA)
+    return db
+
+def backup_dir_size(backup_path):
+    total = 0
+    for root, _dirs, files in os.walk(backup_path):
+        for filename in files:
+            total += os.path.getsize(os.path.join(root, filename))
+    return total
+
+def catalog_record(info, backup_path=None):
+    """Insert or update a local backup from its backup_info dict."""
+    backup_path = backup_path or os.path.join(BACKUPS_DIR, info["backup_name"])
+    with catalog() as db:
+        db.execute(
+            "INSERT INTO backups (name, vm_name, timestamp, type, parent, chain, disk_format, codec, "
+            "size_bytes, disk_sha256, base_sha512, local, info) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT(name) DO UPDATE SET vm_name=excluded.vm_name, timestamp=excluded.timestamp, "
+            "type=excluded.type, parent=excluded.parent, chain=excluded.chain, disk_format=excluded.disk_format, "
+            "codec=excluded.codec, size_bytes=excluded.size_bytes, disk_sha256=excluded.disk_sha256, "
+            "base_sha512=excluded.base_sha512, local=1, info=excluded.info",
+            (info["backup_name"], info.get("vm_name"), info.get("timestamp"), info.get("type", "full"),
+             info.get("parent"), json.dumps(info.get("chain", [info["backup_name"]])),
+             info.get("disk_format", "qcow2"), info.get("codec"), backup_dir_size(backup_path),
+             info.get("disk_sha256"), (info.get("base") or {}).get("sha512"), json.dumps(info)))
+
+def catalog_set_remote(backup_name, key, size=None, modified=None, vm_name=None, timestamp=None, entry=None):
+    """Record where a backup lives in S3 (key None: not in S3).
+
+    entry (an S3 manifest entry) fills in details for backups not held locally.
+    """
+    entry = entry or {}
+    with catalog() as db:
+        db.execute("INSERT INTO backups (name, vm_name, timestamp, type, parent, chain, disk_format, "
+                   "disk_sha256, base_sha512) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(name) DO NOTHING",
+                   (backup_name, vm_name, timestamp, entry.get("type"), entry.get("parent"),
+                    json.dumps(entry["chain"]) if entry.get("chain") else None, entry.get("disk_format"),
+                    entry.get("disk_sha256"), entry.get("base_sha512")))
+        db.execute("UPDATE backups SET s3_key=?, s3_size=?, s3_modified=? WHERE name=?",
+                   (key, size, modified, backup_name))
+
+def catalog_mark_restored(backup_name):
+    with catalog() as db:
+        db.execute("UPDATE backups SET restored_at=? WHERE name=?",
+                   (time.strftime("%Y%m%d_%H%M%S"), backup_name))
+
+def catalog_forget(backup_name, local=False, s3=False):
+    """Record that a backup was deleted locally and/or from S3."""
+    with catalog() as db:
+        if local:
+            db.execute("UPDATE backups SET local=0 WHERE name=?", (backup_name,))
+        if s3:
+            db.execute("UPDATE backups SET s3_key=NULL, s3_size=NULL, s3_modified=NULL WHERE name=?",
+                       (backup_name,))
+        db.execute("DELETE FROM backups WHERE name=? AND local=0 AND s3_key IS NULL", (backup_name,))
+
+def catalog_backups(vm_name=None):
+    """Return catalogued backups (newest first) as dicts."""
+    query = "SELECT * FROM backups WHERE (local=1 OR s3_key IS NOT NULL)"
+    params = ()
+    if vm_name:
+        query += " AND vm_name=?"
+        params = (vm_name,)
+    rows = catalog().execute(query + " ORDER BY timestamp DESC, name DESC", params).fetchall()
+    return [dict(row, chain=json.loads(row["chain"] or "[]")) for row in rows]
+
+def catalog_initialized():
+    """True once the catalog has been reconciled with the backups on disk and in S3."""
+    return catalog().execute("PRAGMA user_version").fetchone()[0] >= 1
+
+def catalog_refresh(s3_config=None):
+    """Reconcile the catalog with BACKUPS_DIR and, if enabled, S3.
+
+    Returns False if S3 could not be listed; its entries are then left as they were.
+    """
+    seen = set()
+    if os.path.isdir(BACKUPS_DIR):
+        for backup_name in os.listdir(BACKUPS_DIR):
+            info = load_backup_info(backup_name)
+            if info:
+                info.setdefault("backup_name", backup_name)
+                catalog_record(info)
+                seen.add(backup_name)
+    with catalog() as db:
+        for (name,) in db.execute("SELECT name FROM backups WHERE local=1").fetchall():
+            if name not in seen:
+                db.execute("UPDATE backups SET local=0 WHERE name=?", (name,))
+
+    if s3_config and s3_config.get("enabled"):
+        listed = list_s3_backups(s3_config)
+        if listed is None:
+            return False
+        remote = {b["name"]: b for b in listed}
+        for name, b in remote.items():
+            catalog_set_remote(name, b["key"], b.get("bytes"), b.get("date"), b.get("vm_name"), b.get("timestamp"), b)
+        with catalog() as db:
+            for (name,) in db.execute("SELECT name FROM backups WHERE s3_key IS NOT NULL").fetchall():
+                if name not in remote:
+                    db.execute("UPDATE backups SET s3_key=NULL, s3_size=NULL, s3_modified=NULL WHERE name=?",
+                               (name,))
+    with catalog() as db:
+        db.execute("DELETE FROM backups WHERE local=0 AND s3_key IS NULL")
+    catalog().execute("PRAGMA user_version = 1")
+    return True
+
 def interactive_backup_selection(backups):
     """Interactive backup selection using arrow keys."""
     if not backups:
@@ -495,12 +2656,473 @@ def interactive_backup_selection(backups):
         
         return None
 
+# ---------------------------------------------------------------------------
+# Retention
+# ---------------------------------------------------------------------------
+
+RETENTION_PERIODS = (("hourly", "%Y%m%d%H"), ("daily", "%Y%m%d"), ("weekly", "%G%V"),
+                     ("monthly", "%Y%m"), ("yearly", "%Y"))
+RETENTION_KEYS = ("last",) + tuple(period for period, _ in RETENTION_PERIODS)
+
+def retention_policy(cfg, location, overrides=None):
+    """Return the {last, hourly, daily, ...} counts for "local" or "s3".
+
+    Config "retention" holds counts for both locations, optionally
+    overridden by its "local" / "s3" objects; command-line counts win.
+    """
+    retention = cfg.get("retention", {})
+    policy = {k: int(retention.get(k, 0)) for k in RETENTION_KEYS}
+    policy.update({k: int(v) for k, v in retention.get(location, {}).items() if k in RETENTION_KEYS})
+    policy.update({k: v for k, v in (overrides or {}).items() if v is not None})
+    return policy
+
+def backup_time(backup):
+    try:
+        return time.strptime(backup["timestamp"], "%Y%m%d_%H%M%S")
+    except (TypeError, ValueError):
+        return None
+
+def select_retained(backups, policy):
+    """Apply a grandfather-father-son policy to one VM's backups (newest first).
+
+    Keeps the newest `last` backups and the newest backup of each of the
+    latest N hours/days/weeks/months/years, then every earlier link of
+    the chains of kept incremental and differential backups.
+    Returns {backup name: [reasons]}.
+    """
+    keep = {}
+    for b in backups[:policy.get("last", 0)]:
+        keep.setdefault(b["name"], []).append("last")
+    for period, fmt in RETENTION_PERIODS:
+        seen = set()
+        for b in backups:
+            if len(seen) >= policy.get(period, 0):
+                break
+            when = backup_time(b)
+            if when and time.strftime(fmt, when) not in seen:
+                seen.add(time.strftime(fmt, when))
+                keep.setdefault(b["name"], []).append(period)
+    by_name = {b["name"]: b for b in backups}
+    for name in list(keep):
+        for member in by_name[name]["chain"]:
+            reasons = keep.setdefault(member, [])
+            if member != name and member in by_name and not any(r.startswith("chain of") for r in reasons):
+                reasons.append(f"chain of {name}")
+    return keep
+
+def backups_in_use():
+    """Names of local backups a VM disk still uses as its backing file (instant restores)."""
+    used = set()
+    for name in os.listdir(VMS_DIR) if os.path.isdir(VMS_DIR) else []:
+        disk = os.path.join(vm_dir(name), f"{name}.qcow2")
+        backing = disk_backing(disk) if os.path.exists(disk) else None
+        if backing and os.path.abspath(backing).startswith(BACKUPS_DIR + os.sep):
+            used.add(os.path.relpath(os.path.abspath(backing), BACKUPS_DIR).split(os.sep)[0])
+    return used
+
+def gc_local_chunks():
+    """Delete repository chunks no local backup references; return (chunks, bytes) freed.
+
+    Holds the repository lock exclusively, so running backups either
+    finish their manifest first or start after the sweep.
+    """
+    import glob
+    lock = repo_lock(exclusive=True)
+    try:
+        referenced = set()
+        for manifest_file in glob.glob(os.path.join(BACKUPS_DIR, "*", "*.chunks.json")):
+            with open(manifest_file) as f:
+                referenced.update(digest for digest, _ in json.load(f)["chunks"] if digest)
+        freed = [0, 0]
+        for root, _dirs, files in os.walk(os.path.join(REPO_DIR, "chunks")):
+            for filename in files:
+                if filename not in referenced:
+                    path = os.path.join(root, filename)
+                    freed[0] += 1
+                    freed[1] += os.path.getsize(path)
+                    os.unlink(path)
+        repo_store_usage(refresh=True)
+        return tuple(freed)
+    finally:
+        lock.close()
+
+def gc_s3_repo(client, grace_hours=24):
+    """Delete S3 chunks, chunk manifests and base images no S3 backup references.
+
+    Roots are read from the bucket, not the catalog: every backup in a VM
+    manifest, and every reference document in S3_REPO_MANIFESTS unless its
+    backup tar is gone and it is older than grace_hours. Uploads write
+    that document before any chunk or base image, so objects an in-flight
+    upload reuses stay referenced. Unreferenced objects younger than
+    grace_hours are left alone too. Deleting chunks bumps the generation
+    in S3_REPO_GC (see s3_known_chunks()). Returns (objects, bytes) freed.
+    """
+    import calendar
+    cutoff = time.time() - grace_hours * 3600
+
+    def old(obj):
+        try:
+            return calendar.timegm(time.strptime(obj["modified"][:19], "%Y-%m-%dT%H:%M:%S")) < cutoff
+        except ValueError:
+            return False
+
+    def read_all(keys):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=client.parallel) as pool:
+            return list(pool.map(lambda key: s3_read_json(client, key)[0], keys))
+
+    lock = repo_lock(exclusive=True)
+    try:
+        vm_manifests = read_all([obj["key"] for obj in client.list(S3_MANIFEST_PREFIX)])
+        if None in vm_manifests:
+            print("  Skipping S3 chunk and base image cleanup: a VM manifest changed while reading")
+            return 0, 0
+        entries = [entry for doc in vm_manifests for entry in doc["backups"]]
+        if any(entry.get("type") is None for entry in entries):
+            print("  Skipping S3 chunk and base image cleanup: some S3 backups predate manifests")
+            return 0, 0
+        tars = set()
+        for obj in client.list(S3_PREFIX):
+            name = obj["key"][len(S3_PREFIX):]
+            if "/" not in name and name.endswith((".tar", ".tar.gz")):
+                tars.add(name[:-len(".tar.gz")] if name.endswith(".tar.gz") else name[:-len(".tar")])
+        listed = {entry["name"] for entry in entries}
+
+        garbage, roots = [], []
+        for obj in client.list(S3_REPO_MANIFESTS):
+            name = obj["key"][len(S3_REPO_MANIFESTS):-len(".json")]
+            if name not in listed and name not in tars and old(obj):
+                garbage.append(obj)
+            else:
+                roots.append(obj)
+        refs = read_all([obj["key"] for obj in roots])
+        if None in refs:
+            print("  Skipping S3 chunk and base image cleanup: a chunk manifest disappeared while reading")
+            return 0, 0
+        bases = {entry["base_sha512"] for entry in entries if entry.get("base_sha512")}
+        bases.update(doc["base_sha512"] for doc in refs if doc.get("base_sha512"))
+
+        root_names = {obj["key"][len(S3_REPO_MANIFESTS):-len(".json")] for obj in roots}
+        if all(entry["name"] in root_names for entry in entries if entry.get("disk_format") == "chunks"):
+            referenced = {digest for doc in refs for digest, _ in doc["chunks"] if digest}
+            garbage += [obj for obj in client.list(S3_REPO_PREFIX)
+                        if obj["key"].rsplit("/", 1)[-1] not in referenced and old(obj)]
+        else:
+            print("  Skipping S3 chunk cleanup: some dedup backups have no chunk manifest in S3")
+
+        garbage += [obj for obj in client.list(S3_IMAGES_PREFIX)
+                    if obj["key"][len(S3_IMAGES_PREFIX):-len(".qcow2")] not in bases and old(obj)]
+
+        failed = set(client.delete_many(obj["key"] for obj in garbage))
+        chunks = {obj["key"].rsplit("/", 1)[-1] for obj in garbage
+                  if obj["key"].startswith(S3_REPO_PREFIX) and obj["key"] not in failed}
+        if chunks:
+            # Tell every host that its record of uploaded chunks is stale
+            doc = s3_update_json(client, S3_REPO_GC,
+                                 lambda doc: {"generation": (doc or {}).get("generation", 0) + 1})
+            record = s3_chunk_record()
+            if record["generation"] == doc["generation"] - 1:
+                s3_chunk_record(doc["generation"], set(record["chunks"]) - chunks)
+    finally:
+        lock.close()
+    if failed:
+        print(f"  Warning: {len(failed)} unreferenced S3 objects could not be deleted", file=sys.stderr)
+    freed = [obj for obj in garbage if obj["key"] not in failed]
+    return len(freed), sum(obj["size"] for obj in freed)
+
+def prune_backups(vm_names, policies, s3_config, dry_run=False):
+    """Delete backups outside each location's retention policy.
+
+    policies maps "local" and/or "s3" to retention_policy() counts.
+    Each location is pruned on its own, so a backup can stay in S3
+    after leaving the local disk.
+    """
+    if not catalog_refresh(s3_config if "s3" in policies else None):
+        print("Skipping S3 pruning: the S3 backup list could not be read", file=sys.stderr)
+        policies = {k: v for k, v in policies.items() if k != "s3"}
+    in_use = backups_in_use() if "local" in policies else set()
+    queued = {row[0] for row in catalog().execute("SELECT backup_name FROM upload_queue")}
+    by_vm = {}
+    for b in catalog_backups():
+        by_vm.setdefault(b["vm_name"] or "?", []).append(b)
+
+    labels = {"local": "local", "s3": "S3"}
+    plan = {location: [] for location in policies}
+    for vm_name in sorted(by_vm):
+        if vm_names and vm_name not in vm_names:
+            continue
+        decisions = {}
+        for location, policy in policies.items():
+            present = [b for b in by_vm[vm_name] if (b["local"] if location == "local" else b["s3_key"])]
+            keep = select_retained(present, policy)
+            for b in present:
+                reasons = keep.get(b["name"])
+                if not reasons and location == "local" and b["name"] in in_use:
+                    reasons = ["in use by a VM disk"]
+                if not reasons and location == "local" and b["name"] in queued:
+                    reasons = ["pending upload"]
+                if not reasons and not backup_time(b):
+                    reasons = ["undated"]
+                if reasons:
+                    decisions.setdefault(b["name"], []).append(f"{labels[location]}: keep ({', '.join(reasons)})")
+                else:
+                    decisions.setdefault(b["name"], []).append(f"{labels[location]}: prune")
+                    plan[location].append(b)
+        if decisions:
+            print(f"\n{vm_name}:")
+            for b in by_vm[vm_name]:
+                if b["name"] in decisions:
+                    print(f"  {b['name']:<40} {'; '.join(decisions[b['name']])}")
+
+    gb = 1024 ** 3
+    local_plan, s3_plan = plan.get("local", []), plan.get("s3", [])
+    print(f"\n{'Would prune' if dry_run else 'Pruning'} {len(local_plan)} local backups "
+          f"({sum(b['size_bytes'] or 0 for b in local_plan) / gb:.2f}GB) and {len(s3_plan)} S3 backups "
+          f"({sum(b['s3_size'] or 0 for b in s3_plan) / gb:.2f}GB)")
+    if dry_run:
+        return
+
+    for b in local_plan:
+        shutil.rmtree(os.path.join(BACKUPS_DIR, b["name"]), ignore_errors=True)
+        catalog_forget(b["name"], local=True)
+    if any(b["disk_format"] == "chunks" for b in local_plan):
+        chunks, freed = gc_local_chunks()
+        print(f"  Freed {chunks} unreferenced chunks ({freed / gb:.2f}GB) from the local repository")
+
+    if s3_plan:
+        client = S3Client(s3_config)
+        # Drop manifest entries first: a crash then leaves orphaned objects, not dangling entries
+        for vm_name in sorted({b["vm_name"] for b in s3_plan if b["vm_name"]}):
+            s3_manifest_update(client, vm_name, remove={b["name"] for b in s3_plan if b["vm_name"] == vm_name})
+        failed = set(client.delete_many(b["s3_key"] for b in s3_plan))
+        for b in s3_plan:
+            catalog_forget(b["name"], s3=True)
+        if failed:
+            print(f"  Warning: {len(failed)} backup objects could not be deleted from S3", file=sys.stderr)
+        objects, freed = gc_s3_repo(client, s3_config.get("gc_grace_hours", 24))
+        print(f"  Freed {objects} unreferenced S3 objects ({freed / gb:.2f}GB)")
+    print("✓ Prune complete")
+
+# ---------------------------------------------------------------------------
+# Backup daemon
+# ---------------------------------------------------------------------------
+
+def parse_duration(value):
+    """Seconds in a duration like 90, "90s", "30m", "6h", "1d" or "2w"."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    text = str(value).strip().lower()
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def daemon_log(message):
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+def enqueue_upload(backup_name):
+    with catalog() as db:
+        db.execute("INSERT INTO upload_queue (backup_name, enqueued_at) VALUES (?, ?) "
+                   "ON CONFLICT(backup_name) DO NOTHING", (backup_name, time.time()))
+
+def upload_queue_stats():
+    """Return depth, pending bytes, lag (age of the oldest entry), failing and lost entries of the upload queue."""
+    rows = catalog().execute(
+        "SELECT q.*, b.size_bytes FROM upload_queue q LEFT JOIN backups b ON b.name = q.backup_name "
+        "ORDER BY q.enqueued_at").fetchall()
+    lost = [dict(r) for r in rows if r["next_attempt"] is None]
+    rows = [r for r in rows if r["next_attempt"] is not None]
+    return {"depth": len(rows), "bytes": sum(r["size_bytes"] or 0 for r in rows),
+            "lag_s": time.time() - rows[0]["enqueued_at"] if rows else 0,
+            "failing": [dict(r) for r in rows if r["attempts"]], "lost": lost}
+
+def drain_upload_queue(client, stop, retry_max_s=3600):
+    """Upload queued backups oldest first until stop is set, retrying failures with backoff."""
+    while not stop.is_set():
+        row = catalog().execute("SELECT * FROM upload_queue WHERE next_attempt <= ? ORDER BY enqueued_at LIMIT 1",
+                                (time.time(),)).fetchone()
+        if row is None:
+            stop.wait(10)
+            continue
+        name = row["backup_name"]
+        backup_path = os.path.join(BACKUPS_DIR, name)
+        if not os.path.isdir(backup_path):
+            # Kept in the queue, never retried, so `nox daemon status` reports the loss
+            daemon_log(f"upload: {name} was deleted locally before reaching S3; marking it lost")
+            with catalog() as db:
+                db.execute("UPDATE upload_queue SET next_attempt=NULL, last_error=? WHERE backup_name=?",
+                           ("lost: deleted locally before upload", name))
+            continue
+        try:
+            started = time.time()
+            upload_backup(backup_path, name, client)
+            daemon_log(f"upload: {name} done in {time.time() - started:.0f}s")
+            with catalog() as db:
+                db.execute("DELETE FROM upload_queue WHERE backup_name=?", (name,))
+        except Exception as e:
+            delay = min(retry_max_s, 60 * 2 ** row["attempts"])
+            daemon_log(f"upload: {name} failed (attempt {row['attempts'] + 1}), retrying in {delay:.0f}s: {e}")
+            with catalog() as db:
+                db.execute("UPDATE upload_queue SET attempts=attempts+1, next_attempt=?, last_error=? "
+                           "WHERE backup_name=?", (time.time() + delay, str(e)[:500], name))
+
+def schedule_for(name, schedules):
+    """The first schedule whose "vms" glob patterns and "label" selectors match the VM."""
+    import fnmatch
+    labels = vm_labels(name)
+    for schedule in schedules:
+        patterns = schedule.get("vms", ["*"])
+        patterns = [patterns] if isinstance(patterns, str) else patterns
+        wanted = parse_labels([schedule["label"]] if isinstance(schedule.get("label"), str)
+                              else schedule.get("label"))
+        if any(fnmatch.fnmatchcase(name, p) for p in patterns) and \
+                all(k in labels and (v is None or labels[k] == v) for k, v in wanted.items()):
+            return schedule
+    return None
+
+def last_backup_time(name, backup_type=None):
+    """Epoch time of a VM's newest catalogued backup (of backup_type), or None."""
+    query, params = "SELECT MAX(timestamp) FROM backups WHERE vm_name=?", [name]
+    if backup_type:
+        query += " AND type=?"
+        params.append(backup_type)
+    timestamp = catalog().execute(query, params).fetchone()[0]
+    when = backup_time({"timestamp": timestamp})
+    return time.mktime(when) if when else None
+
+def backup_due(schedule, last, now=None):
+    """Epoch time the schedule next wants a backup, given the last one.
+
+    "at": "HH:MM" runs daily at that local time; otherwise "every"
+    (a duration, default 1d) after the previous backup.
+    """
+    now = now or time.time()
+    if schedule.get("at"):
+        hour, minute = (int(part) for part in schedule["at"].split(":"))
+        today = time.localtime(now)
+        slot = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, hour, minute, 0, 0, 0, -1))
+        if slot > now:
+            slot -= 86400
+        return slot if last is None or last < slot else slot + 86400
+    return (last or 0) + parse_duration(schedule.get("every", "1d"))
+
+def scheduled_backup(name, schedule):
+    """Run one scheduled backup; local completion only, the upload is queued."""
+    mode = schedule.get("mode", "full")
+    if mode != "full" and schedule.get("full_every"):
+        last_full = last_backup_time(name, "full")
+        if last_full is None or time.time() - last_full >= parse_duration(schedule["full_every"]):
+            mode = "full"
+    info = backup_vm(name, codec=schedule.get("codec"), upload=False, mode=mode,
+                     engine=schedule.get("engine"), thin=schedule.get("thin"),
+                     quiesce=schedule.get("quiesce"), trim=schedule.get("trim"))
+    if load_config().get("s3", {}).get("enabled"):
+        enqueue_upload(info["backup_name"])
+    return info
+
+def run_daemon(poll=30):
+    """Run scheduled backups and drain the upload queue until SIGTERM/SIGINT."""
+    import fcntl
+    import signal
+    from concurrent.futures import ThreadPoolExecutor
+    os.makedirs(NOX_DIR, exist_ok=True)
+    lock = open(os.path.join(NOX_DIR, "daemon.lock"), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        raise RuntimeError("another nox daemon is already running")
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    cfg = load_config()
+    settings = dict({"workers": 2, "upload_bandwidth_mb": 0, "retry_max": "1h"}, **cfg.get("daemon", {}))
+    throttle = throttle_settings(cfg)
+    IO_BUDGET.configure(throttle["backup_mb"], throttle["iops"], shares=int(settings["workers"]))
+    UPLOAD_BUDGET.configure(settings["upload_bandwidth_mb"])
+    uploader = None
+    if cfg.get("s3", {}).get("enabled"):
+        uploader = threading.Thread(target=drain_upload_queue, name="uploader",
+                                    args=(S3Client(cfg["s3"]), stop, parse_duration(settings["retry_max"])))
+        uploader.start()
+    daemon_log(f"nox daemon started (pid {os.getpid()}, {settings['workers']} backup workers"
+               f"{', uploads queued to S3' if uploader else ''})")
+
+    pool = ThreadPoolExecutor(max_workers=max(1, int(settings["workers"])))
+    running, retry_at = {}, {}
+    try:
+        while not stop.is_set():
+            # Re-read the config every round so schedule edits apply without a restart
+            schedules = load_config().get("daemon", {}).get("schedules", [])
+            now = time.time()
+            next_due = {}
+            for name in select_vms():
+                schedule = schedule_for(name, schedules)
+                if not schedule or name in running:
+                    continue
+                due = max(backup_due(schedule, last_backup_time(name)), retry_at.get(name, 0))
+                next_due[name] = due
+                if due <= now:
+                    daemon_log(f"backup: starting {name}")
+                    running[name] = (pool.submit(scheduled_backup, name, schedule), now)
+            for name, (future, started) in list(running.items()):
+                if not future.done():
+                    continue
+                del running[name]
+                try:
+                    info = future.result()
+                    retry_at.pop(name, None)
+                    daemon_log(f"backup: {name} finished in {time.time() - started:.0f}s ({info['backup_name']})")
+                except Exception as e:
+                    retry_at[name] = time.time() + 900
+                    daemon_log(f"backup: {name} failed, retrying in 15m: {e}")
+            write_json_atomic(DAEMON_STATUS_FILE, {
+                "pid": os.getpid(), "heartbeat": time.time(), "running": sorted(running),
+                "next_due": {name: due for name, due in sorted(next_due.items())}})
+            stop.wait(poll)
+    finally:
+        daemon_log("stopping: waiting for running backups and the current upload")
+        stop.set()
+        pool.shutdown(wait=True)
+        if uploader:
+            uploader.join()
+        if os.path.exists(DAEMON_STATUS_FILE):
+            os.unlink(DAEMON_STATUS_FILE)
+        lock.close()
+
+def print_daemon_status():
+    status = None
+    if os.path.exists(DAEMON_STATUS_FILE):
+        with open(DAEMON_STATUS_FILE) as f:
+            status = json.load(f)
+    if status and time.time() - status["heartbeat"] < 300:
+        print(f"Daemon:        running (pid {status['pid']}, last heartbeat "
+              f"{time.time() - status['heartbeat']:.0f}s ago)")
+        print(f"Backing up:    {', '.join(status['running']) or 'nothing'}")
+        for name, due in sorted(status["next_due"].items(), key=lambda item: item[1])[:10]:
+            print(f"  next {name:<24} {time.strftime('%Y-%m-%d %H:%M', time.localtime(due))}")
+    else:
+        print("Daemon:        not running")
+    stats = upload_queue_stats()
+    print(f"Upload queue:  {stats['depth']} backups, {stats['bytes'] / 1024 ** 3:.2f}GB, "
+          f"lag {stats['lag_s'] / 60:.0f}m")
+    for row in stats["failing"]:
+        print(f"  {row['backup_name']}: {row['attempts']} failed attempts, next in "
+              f"{max(0, row['next_attempt'] - time.time()) / 60:.0f}m: {(row['last_error'] or '').splitlines()[0][:80]}")
+    for row in stats["lost"]:
+        print(f"  {row['backup_name']}: LOST, deleted locally before it reached S3")
+
 # ---------------------------------------------------------------------------
 # Cloud-init generation
 # ---------------------------------------------------------------------------
 
-def generate_cloud_init(name, password, ssh_key=None, os_name="debian"):
-    """Generate cloud-init user-data."""
+def generate_cloud_init(name, password, ssh_key=None, os_name="debian", install_packages=True):
+    """Generate cloud-init user-data.
+
+    Templates already carry qemu-guest-agent, so clones pass
+    install_packages=False and skip the apt run entirely.
+    """
     # Find SSH public key
     if not ssh_key:
         for keyfile in ["id_ed25519.pub", "id_rsa.pub"]:
@@ -510,6 +3132,13 @@ def generate_cloud_init(name, password, ssh_key=None, os_name="debian"):
                     ssh_key = f.read().strip()
                 break
 
+    packages = """
+package_update: true
+package_upgrade: false
+packages:
+  - qemu-guest-agent
+""" if install_packages else ""
+
     user_data = f"""#cloud-config
 hostname: {name}
 fqdn: {name}.local
@@ -526,12 +3155,7 @@ users:
       - {ssh_key if ssh_key else ''}
 
 ssh_pwauth: true
-
-package_update: true
-package_upgrade: false
-packages:
-  - qemu-guest-agent
-
+{packages}
 runcmd:
   - echo 'nox:{password}' | chpasswd
   - systemctl enable qemu-guest-agent
@@ -546,13 +3170,471 @@ local-hostname: {name}
 
     return user_data, meta_data
 
+# ---------------------------------------------------------------------------
+# NoCloud seed media
+# ---------------------------------------------------------------------------
+
+ISO_SECTOR = 2048
+
+def _both16(n):
+    import struct
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+def _both32(n):
+    import struct
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+def _iso_dir_record(extent, size, is_dir, name, date):
+    length = 33 + len(name)
+    pad = b"\0" if length % 2 else b""
+    return (bytes([length + len(pad), 0]) + _both32(extent) + _both32(size) + date +
+            bytes([2 if is_dir else 0, 0, 0]) + _both16(1) + bytes([len(name)]) + name + pad)
+
+def _iso_path_table(root_extent, big_endian):
+    import struct
+    fmt = ">IH" if big_endian else "<IH"
+    return bytes([1, 0]) + struct.pack(fmt, root_extent, 1) + b"\0\0"
+
+def _iso_level1_name(filename):
+    """Map e.g. "user-data" to the ISO9660 level 1 identifier "USER_DAT.;1"."""
+    stem, _, ext = filename.upper().partition(".")
+    clean = lambda t: "".join(c if c.isalnum() else "_" for c in t)
+    return f"{clean(stem)[:8]}.{clean(ext)[:3]};1".encode()
+
+def _iso_volume_descriptor(vtype, volume_id, total_sectors, root_record, path_tables, joliet):
+    import struct
+    vd = bytearray(ISO_SECTOR)
+    vd[0] = vtype
+    vd[1:7] = b"CD001\x01"
+    # Identifier fields are space padded; Joliet ones are UCS-2 spaces
+    filler = (b"\0 " * 512) if joliet else (b" " * 1024)
+    vd[8:72] = filler[:64]
+    vd[190:813] = filler[:623]
+    ident = volume_id.encode("utf-16-be") if joliet else volume_id.encode()
+    vd[40:40 + len(ident)] = ident
+    vd[80:88] = _both32(total_sectors)
+    if joliet:
+        vd[88:91] = b"%/E"  # UCS-2 level 3
+    vd[120:124] = _both16(1)
+    vd[124:128] = _both16(1)
+    vd[128:132] = _both16(ISO_SECTOR)
+    vd[132:140] = _both32(10)
+    vd[140:144] = struct.pack("<I", path_tables[0])
+    vd[148:152] = struct.pack(">I", path_tables[1])
+    vd[156:190] = root_record
+    vd[813:881] = (b"0" * 16 + b"\0") * 4
+    vd[881] = 1
+    return bytes(vd)
+
+def build_seed_iso(path, files, volume_id="cidata"):
+    """Write a NoCloud seed image: ISO9660 with Joliet names, no external tools.
+
+    files maps names such as "user-data" to bytes. Linux mounts the Joliet
+    tree, so cloud-init sees the original lowercase names; the primary tree
+    carries level 1 (8.3) names for other readers.
+    """
+    # Fixed layout: descriptors at 16-18, path tables at 19-22,
+    # root directories at 23 (primary) and 24 (Joliet), then file data.
+    root, jroot = 23, 24
+    names = sorted(files)
+    extents = {}
+    next_sector = 25
+    for name in names:
+        extents[name] = next_sector
+        next_sector += max(1, -(-len(files[name]) // ISO_SECTOR))
+    total = next_sector
+
+    t = time.gmtime()
+    date = bytes([t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0])
+
+    def directory(extent, encode):
+        entries = [_iso_dir_record(extent, ISO_SECTOR, True, b"\0", date),
+                   _iso_dir_record(extent, ISO_SECTOR, True, b"\1", date)]
+        for name in sorted(names, key=encode):
+            entries.append(_iso_dir_record(extents[name], len(files[name]), False, encode(name), date))
+        data = b"".join(entries)
+        if len(data) > ISO_SECTOR:
+            raise RuntimeError("too many seed files for one directory sector")
+        return data.ljust(ISO_SECTOR, b"\0")
+
+    primary_names = {_iso_level1_name(n) for n in names}
+    if len(primary_names) != len(names):
+        raise RuntimeError("seed file names collide in ISO9660 8.3 form")
+
+    image = bytearray(ISO_SECTOR * 16)
+    image += _iso_volume_descriptor(1, volume_id, total, _iso_dir_record(root, ISO_SECTOR, True, b"\0", date),
+                                    (19, 20), joliet=False)
+    image += _iso_volume_descriptor(2, volume_id, total, _iso_dir_record(jroot, ISO_SECTOR, True, b"\0", date),
+                                    (21, 22), joliet=True)
+    image += (b"\xffCD001\x01").ljust(ISO_SECTOR, b"\0")
+    for extent, big_endian in ((root, False), (root, True), (jroot, False), (jroot, True)):
+        image += _iso_path_table(extent, big_endian).ljust(ISO_SECTOR, b"\0")
+    image += directory(root, _iso_level1_name)
+    image += directory(jroot, lambda n: n.encode("utf-16-be"))
+    for name in names:
+        data = files[name]
+        image += data.ljust(max(1, -(-len(data) // ISO_SECTOR)) * ISO_SECTOR, b"\0")
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(image)
+    os.replace(tmp, path)
+
+def write_seed_iso(vm_path):
+    """(Re)build a VM's cloud-init.iso from the user-data/meta-data kept next to it."""
+    files = {}
+    for filename in ("user-data", "meta-data"):
+        with open(os.path.join(vm_path, filename), "rb") as f:
+            files[filename] = f.read()
+    iso = os.path.join(vm_path, "cloud-init.iso")
+    build_seed_iso(iso, files)
+    return iso
+
+def seed_settings():
+    """Return (mode, url): "iso" seed media, or "net" for the NoCloud-Net HTTP server."""
+    seed = load_config().get("seed", {})
+    mode = seed.get("mode", "iso")
+    url = seed.get("url")
+    if mode == "net" and not url:
+        host = network_host_address(seed.get("network", "nox-net"))
+        if not host:
+            raise RuntimeError("seed mode 'net' needs seed.url in config.json")
+        url = f"http://{host}:{SEED_PORT}"
+    return mode, url
+
+SEED_PORT = 8461
+
+def network_host_address(network):
+    """Return the host's IP on a libvirt network, i.e. where guests can reach us."""
+    import re
+    try:
+        xml = backend().network_xml(network)
+    except RuntimeError:
+        return None
+    m = re.search(r"<ip [^>]*address=['\"]([^'\"]+)['\"]", xml)
+    return m.group(1) if m else None
+
+def serve_seeds(listen=None, port=SEED_PORT):
+    """Serve NoCloud-Net data at /<vm>/{user-data,meta-data,vendor-data}.
+
+    Each VM's SMBIOS serial is "ds=nocloud-net;s=<url>/<vm>/", so the path
+    is the key and no seed media is attached at all. user-data holds the
+    VM's password, so by default the server only listens on the host's
+    address in the seed network.
+    """
+    import http.server
+    if not listen:
+        network = load_config().get("seed", {}).get("network", "nox-net")
+        listen = network_host_address(network)
+        if not listen:
+            raise RuntimeError(f"cannot find the host address of network '{network}'; pass --listen")
+
+    class SeedHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            body = None
+            if len(parts) == 2 and parts[1] in ("user-data", "meta-data", "vendor-data") \
+                    and parts[0] and not parts[0].startswith("."):
+                p = os.path.join(vm_dir(parts[0]), parts[1])
+                if os.path.exists(p):
+                    with open(p, "rb") as f:
+                        body = f.read()
+                elif parts[1] == "vendor-data" and os.path.isdir(vm_dir(parts[0])):
+                    body = b""
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            print(f"{self.client_address[0]} {fmt % args}")
+
+    server = http.server.ThreadingHTTPServer((listen, port), SeedHandler)
+    print(f"Serving NoCloud seeds on http://{listen}:{port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
 # ---------------------------------------------------------------------------
 # VM creation
 # ---------------------------------------------------------------------------
 
+_image_lock = threading.Lock()
+
+def image_source(os_name, arch):
+    """Return (url, sums_url) for an OS image; config.json "images" overrides OS_IMAGES."""
+    os_info = dict(OS_IMAGES.get(os_name, {}))
+    os_info.update(load_config().get("images", {}).get(os_name, {}))
+    if not os_info:
+        raise RuntimeError(f"Unknown OS: {os_name}")
+
+    # Select URL based on architecture
+    if arch == "arm64":
+        image_url = os_info.get("url")
+    else:
+        image_url = os_info.get("url_amd64")
+
+    if not image_url:
+        raise RuntimeError(f"No image URL for {os_name} on {arch}")
+    return image_url, os_info.get("sums")
+
+def load_image_index():
+    try:
+        with open(IMAGE_INDEX_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def file_sha512(path):
+    return file_digest(path, "sha512")
+
+def file_digest(path, algorithm):
+    import hashlib
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def fetch_expected_sha512(image_url, sums_url):
+    """Look up the image's SHA-512 in the distro's SHA512SUMS file."""
+    import urllib.request
+    filename = os.path.basename(image_url)
+    with urllib.request.urlopen(sums_url, timeout=30) as resp:
+        for line in resp.read().decode().splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1].lstrip("*") == filename:
+                return parts[0].lower()
+    raise RuntimeError(f"{filename} not listed in {sums_url}")
+
+def _download_range(url, fd, rng, lock, save_state):
+    """Fetch bytes [start+done, end] of url into fd, recording progress in rng."""
+    import urllib.request
+    start, end = rng[0], rng[1]
+    if start + rng[2] > end:
+        return
+    req = urllib.request.Request(url, headers={"Range": f"bytes={start + rng[2]}-{end}"})
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        if resp.status != 206:
+            raise RuntimeError("server ignored range request")
+        unsaved = 0
+        while True:
+            chunk = resp.read(1024 * 1024)
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, start + rng[2])
+            with lock:
+                rng[2] += len(chunk)
+            unsaved += len(chunk)
+            if unsaved >= 16 * 1024 * 1024:
+                save_state()
+                unsaved = 0
+    save_state()
+
+def download_file(url, dest, connections=4):
+    """Download url to dest, resumably, using parallel range requests when possible.
+
+    Progress lives in dest.part (data) and dest.part.json (per-range offsets),
+    so an interrupted download picks up where it stopped. dest only appears,
+    via atomic rename, once every byte has arrived.
+    """
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    part = dest + ".part"
+    state_path = part + ".json"
+
+    size, ranges_ok = None, False
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=30) as resp:
+            size = int(resp.headers.get("Content-Length") or 0) or None
+            ranges_ok = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except Exception:
+        pass
+
+    state = None
+    if os.path.exists(state_path) and os.path.exists(part):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get("url") != url or state.get("size") != size:
+            state = None
+
+    if not (size and ranges_ok):
+        # No size or no range support: plain single stream, restarting from scratch
+        with urllib.request.urlopen(url, timeout=60) as resp, open(part, "wb") as out:
+            shutil.copyfileobj(resp, out, 1024 * 1024)
+        os.replace(part, dest)
+        return
+
+    if state is None:
+        step = -(-size // max(1, connections))
+        state = {"url": url, "size": size,
+                 "ranges": [[off, min(off + step, size) - 1, 0] for off in range(0, size, step)]}
+        with open(part, "wb") as f:
+            f.truncate(size)
+    else:
+        print(f"Resuming download ({sum(r[2] for r in state['ranges']) * 100 // size}% done)...")
+
+    lock = threading.Lock()
+
+    def save_state():
+        with lock:
+            write_json_atomic(state_path, state)
+
+    fd = os.open(part, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(state["ranges"])) as pool:
+            futures = [pool.submit(_download_range, url, fd, rng, lock, save_state)
+                       for rng in state["ranges"]]
+            for future in futures:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.replace(part, dest)
+    os.remove(state_path)
+
+def ensure_base_image(os_name, arch, refresh=False):
+    """Return the path of a verified cloud image, downloading it once if needed.
+
+    Images are stored content-addressed as IMAGES_DIR/sha512/<sha512>.qcow2
+    and checked against the distro's SHA512SUMS before use. Safe to call
+    from several threads: concurrent creates share one download.
+    """
+    key = f"{os_name}-{arch}"
+    with _image_lock:
+        index = load_image_index()
+        entry = index.get(key)
+        if entry and not refresh:
+            path = os.path.join(IMAGE_STORE_DIR, f"{entry['sha512']}.qcow2")
+            if os.path.exists(path):
+                print(f"Using cached {os_name} cloud image")
+                return path
+
+        image_url, sums_url = image_source(os_name, arch)
+        legacy = os.path.join(IMAGES_DIR, f"{key}.qcow2")
+        os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+        try:
+            expected = fetch_expected_sha512(image_url, sums_url) if sums_url else None
+        except OSError as e:
+            if refresh or not os.path.exists(legacy):
+                raise RuntimeError(f"cannot fetch {sums_url}: {e}")
+            # Offline on the first run after an upgrade: keep using the older nox's image
+            print(f"Warning: cannot fetch {sums_url} ({e}); using the cached {os_name} image unverified",
+                  file=sys.stderr)
+            expected = file_sha512(legacy)
+            if not os.path.exists(os.path.join(IMAGE_STORE_DIR, f"{expected}.qcow2")):
+                os.link(legacy, os.path.join(IMAGE_STORE_DIR, f"{expected}.qcow2"))
+
+        path = os.path.join(IMAGE_STORE_DIR, f"{expected}.qcow2") if expected else None
+        if path and not os.path.exists(path) and os.path.exists(legacy) and file_sha512(legacy) == expected:
+            # Adopt an image cached by an older nox instead of fetching it again
+            os.link(legacy, path)
+
+        if not path or not os.path.exists(path):
+            print(f"Downloading {os_name} cloud image...")
+            tmp = os.path.join(IMAGE_STORE_DIR, f"{key}.download")
+            started = time.time()
+            download_file(image_url, tmp, load_config().get("download_connections", 4))
+            actual = file_sha512(tmp)
+            if expected and actual != expected:
+                os.remove(tmp)
+                raise RuntimeError(f"Checksum mismatch for {image_url}: expected {expected}, got {actual}")
+            if not expected:
+                print(f"Warning: no SHA512SUMS configured for {os_name}; image is unverified", file=sys.stderr)
+            path = os.path.join(IMAGE_STORE_DIR, f"{actual}.qcow2")
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, path)
+            size_mb = os.path.getsize(path) / 1024 ** 2
+            print(f"✓ Downloaded {size_mb:.0f}MB in {time.time() - started:.1f}s (sha512 verified)"
+                  if expected else f"✓ Downloaded {size_mb:.0f}MB")
+        else:
+            print(f"Using cached {os_name} cloud image")
+
+        index[key] = {"sha512": os.path.basename(path)[:-len(".qcow2")], "url": image_url,
+                      "fetched": int(time.time())}
+        write_json_atomic(IMAGE_INDEX_FILE, index)
+
+    return path
+
+def disk_backing(disk_path):
+    """Return the backing file of a qcow2 image, or None for a standalone image."""
+    info = json.loads(run(f"qemu-img info -U --output=json {shlex.quote(disk_path)}").stdout)
+    return info.get("full-backing-filename") or info.get("backing-filename")
+
+def base_image_hash(path):
+    """Return the SHA-512 of a base image (cloud image or template)."""
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(IMAGE_STORE_DIR):
+        return os.path.basename(path)[:-len(".qcow2")]
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(TEMPLATES_DIR):
+        template = os.path.basename(path)[:-len(".qcow2")]
+        info = load_template(template)
+        if info is not None:
+            if not info.get("sha512"):
+                info["sha512"] = file_sha512(path)
+                write_json_atomic(os.path.join(TEMPLATES_DIR, f"{template}.json"), info)
+            return info["sha512"]
+    return file_sha512(path)
+
+def find_base_image(sha512, recorded=None):
+    """Return a local image whose contents hash to sha512, or None.
+
+    recorded is a backup's "base" entry: bases outside the image store and
+    templates (such as legacy IMAGES_DIR/<os>-<arch>.qcow2 images) are
+    found at its recorded path once their hash has been checked.
+    """
+    path = os.path.join(IMAGE_STORE_DIR, f"{sha512}.qcow2")
+    if os.path.exists(path):
+        return path
+    for template in list_templates():
+        if template.get("sha512") == sha512 and os.path.exists(template_path(template["name"])):
+            return template_path(template["name"])
+    recorded = recorded or {}
+    for path in (recorded.get("path"), recorded.get("file") and os.path.join(IMAGES_DIR, recorded["file"])):
+        if path and os.path.isfile(path) and file_sha512(path) == sha512:
+            return path
+    return None
+
+def fetch_base_image(sha512, recorded=None):
+    """Return a local, verified copy of the base image sha512, pulling it from S3 if needed."""
+    path = find_base_image(sha512, recorded)
+    if path:
+        return path
+    s3_config = load_config().get("s3", {})
+    if not s3_config.get("enabled"):
+        raise RuntimeError(f"base image {sha512[:16]}... is not available locally and S3 is disabled")
+    client = S3Client(s3_config)
+    resp = client.get(f"{S3_IMAGES_PREFIX}{sha512}.qcow2")
+    if resp is None:
+        raise RuntimeError(f"base image {sha512[:16]}... not found locally or in S3")
+    print(f"Fetching base image {sha512[:16]}... from S3")
+    os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+    path = os.path.join(IMAGE_STORE_DIR, f"{sha512}.qcow2")
+    tmp = f"{path}.download"
+    with resp, open(tmp, "wb") as f:
+        shutil.copyfileobj(resp, f, 4 * 1024 * 1024)
+    if file_sha512(tmp) != sha512:
+        os.remove(tmp)
+        raise RuntimeError(f"base image {sha512[:16]}... from S3 failed verification")
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+    return path
+
+def parse_network(value):
+    """Turn a --network value into a network spec (physical NIC => macvtap)."""
+    if value in list_physical_interfaces():
+        return {'type': 'macvtap', 'value': value}
+    return {'type': 'libvirt', 'value': value}
+
 def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
-              autostart=False, password=None, start=True, network=None):
-    """Create a new VM."""
+              autostart=False, password=None, start=True, network=None, template=None):
+    """Create a new VM, as an overlay on a cloud image or on a template."""
     if vm_exists(name):
         print(f"VM '{name}' already exists.")
         return False, None
@@ -560,15 +3642,27 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
     cfg = load_config()
     defaults = cfg.get("defaults", DEFAULT_CONFIG["defaults"])
 
+    tmpl = None
+    if template:
+        tmpl = load_template(template)
+        if not tmpl:
+            print(f"Template '{template}' does not exist.", file=sys.stderr)
+            return False, None
+        os_name = tmpl["os"]
+
     os_name = os_name or defaults.get("os", "debian")
     cpus = cpus if cpus is not None else defaults.get("cpus", 1)
     ram = ram if ram is not None else defaults.get("ram", 512)
-    disk = disk if disk is not None else defaults.get("disk", 5)
+    if disk is None and not template:
+        disk = defaults.get("disk", 5)
 
     arch = host_arch()
     vcpus = resolve_resource(cpus, host_cpus())
     ram_mb = resolve_resource(ram, host_ram_mb())
-    disk_gb = resolve_resource(disk, host_disk_gb())
+    disk_gb = resolve_resource(disk, host_disk_gb()) if disk is not None else 0
+    if template:
+        # A clone's disk can never be smaller than the template it sits on
+        disk_gb = max(disk_gb, tmpl["disk_gb"])
 
     if password is None:
         password = generate_password()
@@ -590,36 +3684,19 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
     vm_path = vm_dir(name)
     os.makedirs(vm_path, exist_ok=True)
 
-    # Download cloud image to shared cache
-    os_info = OS_IMAGES.get(os_name)
-    if not os_info:
-        raise RuntimeError(f"Unknown OS: {os_name}")
-
-    # Select URL based on architecture
-    if arch == "arm64":
-        image_url = os_info.get("url")
-    else:
-        image_url = os_info.get("url_amd64")
-
-    if not image_url:
-        raise RuntimeError(f"No image URL for {os_name} on {arch}")
-
-    # Use shared image cache
-    image_filename = f"{os_name}-{arch}.qcow2"
-    base_image = os.path.join(IMAGES_DIR, image_filename)
-
-    if not os.path.exists(base_image):
-        print(f"Downloading {os_name} cloud image...")
-        run(f"curl -fsSL {image_url} -o {base_image}")
+    # Download cloud image to shared cache (or sit on the template)
+    if tmpl:
+        base_image = template_path(template)
     else:
-        print(f"Using cached {os_name} cloud image")
+        base_image = ensure_base_image(os_name, arch)
 
     # Create disk image from base
     disk_path = os.path.join(vm_path, f"{name}.qcow2")
     run(f"qemu-img create -f qcow2 -F qcow2 -b {base_image} {disk_path} {disk_gb}G")
 
     # Generate cloud-init
-    user_data, meta_data = generate_cloud_init(name, password, os_name=os_name)
+    user_data, meta_data = generate_cloud_init(name, password, os_name=os_name,
+                                               install_packages=tmpl is None)
     user_data_path = os.path.join(vm_path, "user-data")
     meta_data_path = os.path.join(vm_path, "meta-data")
 
@@ -628,20 +3705,25 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
     with open(meta_data_path, "w") as f:
         f.write(meta_data)
 
-    # Create cloud-init ISO
-    cloud_init_iso = os.path.join(vm_path, "cloud-init.iso")
-    run(f"genisoimage -output {cloud_init_iso} -volid cidata -joliet -rock {user_data_path} {meta_data_path}")
+    # Seed cloud-init: a tiny ISO built in-process, or nothing at all when
+    # the NoCloud-Net server hands out user-data keyed by the SMBIOS serial
+    seed_mode, seed_url = seed_settings()
+    if seed_mode == "net":
+        seed_arg = ["--sysinfo", shlex.quote(f"smbios,system.serial=ds=nocloud-net;s={seed_url}/{name}/")]
+    else:
+        seed_arg = ["--disk", f"{write_seed_iso(vm_path)},device=cdrom"]
 
     # Create VM with virt-install
     cmd_parts = [
         "virt-install",
-        "--connect", "qemu:///system",
+        "--connect", LIBVIRT_URI,
         "--name", name,
         "--memory", str(ram_mb),
         "--vcpus", str(vcpus),
         "--cpu", "host-passthrough",
-        "--disk", f"{disk_path},format=qcow2,bus=virtio,cache=writeback,io=threads",
-        "--disk", f"{cloud_init_iso},device=cdrom",
+        "--disk", f"{disk_path},format=qcow2,bus=virtio,cache=writeback,io=threads,"
+                  f"discard=unmap,detect_zeroes=unmap",
+        *seed_arg,
         "--os-variant", "generic",
         "--network", network_arg,
         "--graphics", "none",
@@ -663,7 +3745,7 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
 
     # Configure autostart
     if autostart:
-        virsh(f"autostart {name}")
+        backend().set_autostart(name)
 
     # Save metadata
     meta = {
@@ -677,6 +3759,8 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
         "network_type": network['type'],
         "network_value": network['value'],
     }
+    if tmpl:
+        meta["template"] = template
     save_meta(name, meta)
 
     if not start:
@@ -684,7 +3768,416 @@ def create_vm(name, os_name=None, cpus=None, ram=None, disk=None,
     else:
         print(f"VM '{name}' created and starting...")
 
-    return True, password
+    return True, password
+
+# ---------------------------------------------------------------------------
+# Templates
+# ---------------------------------------------------------------------------
+
+# Run in the guest before it becomes a template: forget its identity so every
+# clone boots as a fresh cloud-init instance with its own machine-id/host keys.
+SEAL_COMMANDS = " && ".join([
+    "cloud-init clean --logs --seed",
+    "truncate -s 0 /etc/machine-id",
+    "rm -f /var/lib/dbus/machine-id",
+    "rm -f /etc/ssh/ssh_host_*",
+    "apt-get clean",
+    "sync",
+])
+
+def template_path(template):
+    return os.path.join(TEMPLATES_DIR, f"{template}.qcow2")
+
+def load_template(template):
+    p = os.path.join(TEMPLATES_DIR, f"{template}.json")
+    if os.path.exists(p):
+        with open(p) as f:
+            return json.load(f)
+    return None
+
+def list_templates():
+    if not os.path.exists(TEMPLATES_DIR):
+        return []
+    return [load_template(f[:-len(".json")]) for f in sorted(os.listdir(TEMPLATES_DIR))
+            if f.endswith(".json")]
+
+def wait_for_agent(name, timeout=120):
+    """Wait until the guest agent answers a ping."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            backend().agent_command(name, {"execute": "guest-ping"}, timeout=5)
+            return True
+        except RuntimeError:
+            time.sleep(1)
+    return False
+
+def wait_for_shutdown(name, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if vm_state(name) == "shut off":
+            return True
+        time.sleep(1)
+    return False
+
+def make_template(name, template):
+    """Seal a provisioned VM and store its flattened disk as a read-only template."""
+    meta = load_meta(name)
+    if not meta:
+        raise RuntimeError(f"Could not load metadata for VM '{name}'")
+
+    if vm_state(name) != "running":
+        print(f"Starting '{name}' to seal it...")
+        backend().start(name)
+    if not wait_for_agent(name):
+        raise RuntimeError("guest agent did not respond; is qemu-guest-agent installed?")
+
+    print("Sealing guest (cloud-init reset, machine-id and host keys removed)...")
+    exitcode, _out, err = guest_exec(name, SEAL_COMMANDS, timeout=120)
+    if exitcode != 0:
+        raise RuntimeError(f"sealing failed: {err.strip()}")
+
+    backend().shutdown(name)
+    if not wait_for_shutdown(name):
+        raise RuntimeError(f"VM '{name}' did not shut down")
+
+    os.makedirs(TEMPLATES_DIR, exist_ok=True)
+    dest = template_path(template)
+    tmp = dest + ".tmp"
+    print("Writing template image...")
+    disk_path = os.path.join(vm_dir(name), f"{name}.qcow2")
+    run(f"qemu-img convert -O qcow2 {disk_path} {tmp}")
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, dest)
+
+    info = {
+        "name": template,
+        "os": meta.get("os", "debian"),
+        "arch": meta.get("arch", host_arch()),
+        "disk_gb": meta.get("disk_gb"),
+        "vcpus": meta.get("vcpus"),
+        "ram_mb": meta.get("ram_mb"),
+        "source_vm": name,
+        "created": time.strftime("%Y%m%d_%H%M%S"),
+        "sha512": file_sha512(dest),
+    }
+    write_json_atomic(os.path.join(TEMPLATES_DIR, f"{template}.json"), info)
+    return info
+
+# ---------------------------------------------------------------------------
+# Warm pool
+# ---------------------------------------------------------------------------
+
+POOL_PREFIX = "nox-pool-"
+
+def pool_profiles():
+    return load_config().get("pool", {}).get("profiles", {})
+
+def pool_members(profile=None):
+    """Return names of pool VMs (optionally of one profile), ready or not."""
+    if not os.path.exists(VMS_DIR):
+        return []
+    members = []
+    for name in sorted(os.listdir(VMS_DIR)):
+        meta = load_meta(name) or {}
+        if name.startswith(POOL_PREFIX) and meta.get("pool") and (profile is None or meta["pool"] == profile):
+            members.append(name)
+    return members
+
+def resolve_profile(spec):
+    """Resolve a create/profile spec to the concrete values create_vm would use."""
+    defaults = load_config().get("defaults", DEFAULT_CONFIG["defaults"])
+    def pick(key, fallback):
+        return spec.get(key) if spec.get(key) is not None else defaults.get(key, fallback)
+    network = spec.get("network") or "nox-net"
+    tmpl = load_template(spec["template"]) if spec.get("template") else None
+    return (
+        tmpl["os"] if tmpl else pick("os", "debian"),
+        resolve_resource(pick("cpus", 1), host_cpus()),
+        resolve_resource(pick("ram", 512), host_ram_mb()),
+        resolve_resource(pick("disk", 5), host_disk_gb()),
+        network["value"] if isinstance(network, dict) else network,
+    )
+
+def matching_profile(spec):
+    wanted = resolve_profile(spec)
+    for profile, pspec in sorted(pool_profiles().items()):
+        if resolve_profile(pspec) == wanted:
+            return profile
+    return None
+
+def fill_pool_member(profile, spec):
+    """Boot one pool VM, wait until cloud-init is done, then pause it."""
+    name = f"{POOL_PREFIX}{profile}-{secrets.token_hex(3)}"
+    network = parse_network(spec["network"]) if spec.get("network") else None
+    success, _password = create_vm(
+        name, os_name=spec.get("os"), cpus=spec.get("cpus"), ram=spec.get("ram"),
+        disk=spec.get("disk"), autostart=False, network=network, template=spec.get("template"))
+    if not success:
+        raise RuntimeError(f"could not create pool VM '{name}'")
+    meta = load_meta(name)
+    meta["pool"] = profile
+    meta["pool_ready"] = False
+    save_meta(name, meta)
+
+    if not wait_for_agent(name, timeout=600):
+        raise RuntimeError(f"pool VM '{name}' never came up")
+    guest_exec(name, "cloud-init status --wait", timeout=600)
+    backend().suspend(name)
+    meta["pool_ready"] = True
+    save_meta(name, meta)
+    return name
+
+def reap_pool_members(profile):
+    """Delete a profile's members that can no longer be claimed; return the usable ones.
+
+    Only called with the profile's fill lock held, so a member that is not
+    ready is left over from a failed fill, and a ready one that is not
+    paused lost its RAM (e.g. to a host reboot). Members holding
+    claim.state from a failed claim rollback are kept for inspection but
+    not counted.
+    """
+    usable = []
+    for name in pool_members(profile):
+        if (load_meta(name) or {}).get("pool_ready") and vm_state(name) == "paused":
+            usable.append(name)
+        elif os.path.exists(os.path.join(vm_dir(name), "claim.state")):
+            print(f"Warning: pool VM '{name}' holds claim.state from a failed claim; "
+                  f"delete it with 'nox delete {name}'", file=sys.stderr)
+        else:
+            print(f"Removing stale pool VM '{name}' ({vm_state(name) or 'undefined'})")
+            delete_vm(name)
+    return usable
+
+def fill_pool(profile):
+    """Top up a profile to its configured size, booting members in parallel."""
+    import fcntl
+    from concurrent.futures import ThreadPoolExecutor
+
+    spec = pool_profiles().get(profile)
+    if spec is None:
+        raise RuntimeError(f"Unknown pool profile: {profile}")
+    os.makedirs(NOX_DIR, exist_ok=True)
+    # Concurrent refills (one per nox create) would all boot the same missing members
+    with open(os.path.join(NOX_DIR, f"pool-{profile}.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        missing = spec.get("size", 1) - len(reap_pool_members(profile))
+        if missing <= 0:
+            return []
+        print(f"Booting {missing} warm VM(s) for pool '{profile}'...")
+        with ThreadPoolExecutor(max_workers=missing) as pool:
+            return list(pool.map(lambda _i: fill_pool_member(profile, spec), range(missing)))
+
+def refill_pool_in_background(profile):
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "pool", "fill", profile],
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def claim_pool_vm(profile, name, password, autostart=True):
+    """Hand a paused pool VM out as 'name'. Returns True if one was claimed.
+
+    libvirt can only rename inactive domains, so the paused VM is saved to
+    disk (RAM only, no reboot), undefined, moved under its new name and
+    restored running from the saved state. The guest is then re-identified
+    through the agent: hostname, password and clock.
+    """
+    import base64
+
+    for pool_name in pool_members(profile):
+        meta = load_meta(pool_name) or {}
+        if not meta.get("pool_ready") or vm_state(pool_name) != "paused":
+            continue
+        # Renaming the directory is the claim: only one process can win it
+        try:
+            os.rename(vm_dir(pool_name), vm_dir(name))
+        except OSError:
+            continue
+        break
+    else:
+        return False
+
+    print(f"Claiming warm VM '{pool_name}' from pool '{profile}'...")
+    path = vm_dir(name)
+    xml = backend().dumpxml(pool_name)
+    state_file = os.path.join(path, "claim.state")
+    steps = set()
+    try:
+        backend().save(pool_name, state_file)
+        steps.add("saved")
+        backend().undefine(pool_name)
+        steps.add("undefined")
+
+        os.rename(os.path.join(path, f"{pool_name}.qcow2"), os.path.join(path, f"{name}.qcow2"))
+        steps.add("disk")
+        claimed_xml = xml.replace(f"<name>{pool_name}</name>", f"<name>{name}</name>")
+        claimed_xml = claimed_xml.replace(vm_dir(pool_name) + "/", path + "/")
+        claimed_xml = claimed_xml.replace(f"{pool_name}.qcow2", f"{name}.qcow2")
+
+        backend().restore(state_file, claimed_xml)
+        steps.add("restored")
+        os.remove(state_file)
+        backend().define(claimed_xml)
+    except Exception:
+        try:
+            unclaim_pool_vm(pool_name, name, xml, steps)
+        except Exception as e:
+            print(f"Warning: could not return '{pool_name}' to the pool: {e}", file=sys.stderr)
+        raise
+
+    try:
+        backend().agent_command(name, {"execute": "guest-set-time",
+                                       "arguments": {"time": time.time_ns()}})
+        pw_b64 = base64.b64encode(f"nox:{password}".encode()).decode()
+        exitcode, _out, err = guest_exec(name, " && ".join([
+            f"hostnamectl set-hostname {name}",
+            f"sed -i 's/\\b{pool_name}\\b/{name}/g' /etc/hosts",
+            # Keep cloud-init from restoring the pool hostname on the next boot
+            "printf 'preserve_hostname: true\\nmanage_etc_hosts: false\\n' > /etc/cloud/cloud.cfg.d/99-nox.cfg",
+            f"echo $(echo {pw_b64} | base64 -d) | chpasswd",
+        ]), timeout=30)
+        if exitcode != 0:
+            raise RuntimeError(f"re-identifying claimed VM failed: {err.strip()}")
+    except Exception:
+        # Half re-identified: neither a pool member nor usable under its new name
+        delete_vm(name)
+        forget_ip_cache(pool_name)
+        raise
+
+    if autostart:
+        backend().set_autostart(name)
+    meta.update({"name": name, "autostart": autostart, "claimed_from": pool_name})
+    meta.pop("pool", None)
+    meta.pop("pool_ready", None)
+    save_meta(name, meta)
+    forget_ip_cache(pool_name)
+    return True
+
+def unclaim_pool_vm(pool_name, name, xml, steps):
+    """Undo the completed steps of a failed claim, returning the VM to its pool.
+
+    The saved RAM is restored paused under the pool name. If that fails,
+    claim.state is kept in the VM directory and the member is marked not
+    ready instead of being thrown away.
+    """
+    path, pool_path = vm_dir(name), vm_dir(pool_name)
+    if "restored" in steps:
+        # Running (transient) under the new name: put it back into the state file
+        backend().save(name, os.path.join(path, "claim.state"))
+    if "disk" in steps:
+        os.rename(os.path.join(path, f"{name}.qcow2"), os.path.join(path, f"{pool_name}.qcow2"))
+    os.rename(path, pool_path)
+    if "undefined" in steps:
+        backend().define(xml)
+    if "saved" not in steps:
+        return
+    state_file = os.path.join(pool_path, "claim.state")
+    try:
+        backend().restore(state_file, xml, paused=True)
+        os.remove(state_file)
+    except RuntimeError:
+        meta = load_meta(pool_name) or {}
+        meta["pool_ready"] = False
+        save_meta(pool_name, meta)
+        raise
+
+# ---------------------------------------------------------------------------
+# Fleet manifests
+# ---------------------------------------------------------------------------
+
+def load_manifest(path):
+    """Load a fleet manifest from JSON or (if PyYAML is installed) YAML."""
+    with open(path) as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise RuntimeError("YAML manifests need PyYAML (apt install python3-yaml); use JSON instead")
+        return yaml.safe_load(text) or {}
+    return json.loads(text)
+
+def expand_manifest(manifest):
+    """Return {name: spec} for every VM the manifest asks for.
+
+    Entries with "count" are expanded by formatting "name" with n=1..count,
+    e.g. {"name": "worker-{n:02d}", "count": 3}.
+    """
+    defaults = manifest.get("defaults", {})
+    desired = {}
+    for entry in manifest.get("vms", []):
+        spec = dict(defaults)
+        spec.update(entry)
+        count = spec.pop("count", None)
+        template = spec.pop("name")
+        if spec.get("labels"):
+            spec["labels"] = label_strings(spec["labels"])
+        names = [template.format(n=n) for n in range(1, count + 1)] if count else [template]
+        for name in names:
+            if name in desired:
+                raise RuntimeError(f"VM '{name}' appears more than once in the manifest")
+            desired[name] = dict(spec)
+    return desired
+
+def plan_fleet(desired, fleet):
+    """Diff desired VMs against existing ones and return a list of (action, name, detail)."""
+    existing = set(backend().list_names())
+    plan = []
+    for name, spec in sorted(desired.items()):
+        if name not in existing:
+            plan.append(("create", name, spec))
+            continue
+        meta = load_meta(name) or {}
+        changes = {}
+        if spec.get("cpus") is not None and resolve_resource(spec["cpus"], host_cpus()) != meta.get("vcpus"):
+            changes["cpus"] = spec["cpus"]
+        if spec.get("ram") is not None and resolve_resource(spec["ram"], host_ram_mb()) != meta.get("ram_mb"):
+            changes["ram"] = spec["ram"]
+        if spec.get("disk") is not None:
+            disk_gb = resolve_resource(spec["disk"], host_disk_gb())
+            if disk_gb > meta.get("disk_gb", 0):
+                changes["disk"] = spec["disk"]
+            elif disk_gb < meta.get("disk_gb", 0):
+                print(f"Warning: not shrinking disk of '{name}' ({meta.get('disk_gb')}GB > {disk_gb}GB)",
+                      file=sys.stderr)
+        if spec.get("labels") is not None and spec["labels"] != meta.get("labels", {}):
+            changes["labels"] = spec["labels"]
+        plan.append(("resize", name, changes) if changes else ("keep", name, {}))
+
+    # Only VMs this fleet created are candidates for deletion
+    for name in sorted(existing - set(desired)):
+        meta = load_meta(name) or {}
+        if meta.get("fleet") == fleet:
+            plan.append(("delete", name, {}))
+    return plan
+
+def apply_action(action, name, detail, fleet):
+    """Carry out one plan step. Returns a short result string; raises on failure."""
+    if action == "create":
+        network = parse_network(detail["network"]) if detail.get("network") else None
+        success, password = create_vm(
+            name, os_name=detail.get("os"), cpus=detail.get("cpus"), ram=detail.get("ram"),
+            disk=detail.get("disk"), autostart=detail.get("autostart", True),
+            start=detail.get("start", True), network=network, template=detail.get("template"))
+        if not success:
+            raise RuntimeError("create failed")
+        meta = load_meta(name)
+        meta["fleet"] = fleet
+        if detail.get("labels"):
+            meta["labels"] = detail["labels"]
+        save_meta(name, meta)
+        return f"password {password}"
+    if action == "resize":
+        detail = dict(detail)
+        if "labels" in detail:
+            meta = load_meta(name)
+            meta["labels"] = detail.pop("labels")
+            save_meta(name, meta)
+        if detail:
+            resize_vm(name, **detail)
+        return ", ".join(f"{k}={v}" for k, v in detail.items()) or "labels updated"
+    if action == "delete":
+        delete_vm(name)
+        return "deleted"
+    return "up to date"
 
 # ---------------------------------------------------------------------------
 # Commands
@@ -699,21 +4192,44 @@ def cmd_create(args):
         network = select_network_interactive()
     else:
         # Detect if the --network arg is a physical interface or a libvirt network
-        phys = list_physical_interfaces()
-        if network in phys:
-            network = {'type': 'macvtap', 'value': network}
-        else:
-            network = {'type': 'libvirt', 'value': network}
+        network = parse_network(network)
     
-    success, password = create_vm(
-        args.name, os_name=args.os, cpus=args.cpus, ram=args.ram,
-        disk=args.disk, autostart=not getattr(args, "no_autostart", False),
-        start=not args.no_start, network=network
-    )
+    success = False
+    profile = None
+    if not args.no_start and not args.no_pool and not vm_exists(args.name):
+        profile = matching_profile({"os": args.os, "cpus": args.cpus, "ram": args.ram,
+                                    "disk": args.disk, "network": network})
+    if profile:
+        password = generate_password()
+        try:
+            success = claim_pool_vm(profile, args.name, password,
+                                    autostart=not getattr(args, "no_autostart", False))
+        except (RuntimeError, OSError) as e:
+            print(f"Error claiming pool VM: {e}", file=sys.stderr)
+            if os.path.exists(vm_dir(args.name)) or vm_exists(args.name):
+                # The claim could not be rolled back; leave what is left for inspection
+                sys.exit(1)
+            print("Creating from scratch.")
+        else:
+            if not success:
+                print(f"Pool '{profile}' is empty; creating from scratch.")
+        refill_pool_in_background(profile)
+
+    if not success:
+        success, password = create_vm(
+            args.name, os_name=args.os, cpus=args.cpus, ram=args.ram,
+            disk=args.disk, autostart=not getattr(args, "no_autostart", False),
+            start=not args.no_start, network=network
+        )
 
     if not success:
         return
 
+    if args.label:
+        meta = load_meta(args.name)
+        meta["labels"] = {k: v or "" for k, v in parse_labels(args.label).items()}
+        save_meta(args.name, meta)
+
     # Wait for IP if started
     if not args.no_start:
         print("\nWaiting for VM to boot and get IP address...")
@@ -733,35 +4249,221 @@ def cmd_create(args):
         print(f"\nIMPORTANT: Save this password - it won't be shown again!")
         print(f"{'='*60}")
 
+def cmd_apply(args):
+    """Converge VMs to a fleet manifest, creating/resizing/deleting in parallel."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        manifest = load_manifest(args.manifest)
+        desired = expand_manifest(manifest)
+    except (OSError, ValueError, KeyError, RuntimeError) as e:
+        print(f"Invalid manifest: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    fleet = manifest.get("fleet") or os.path.splitext(os.path.basename(args.manifest))[0]
+    plan = plan_fleet(desired, fleet)
+    if not args.prune:
+        plan = [step for step in plan if step[0] != "delete"]
+
+    pending = [step for step in plan if step[0] != "keep"]
+    for action, name, detail in plan:
+        print(f"  {action:<8} {name}")
+    if not pending:
+        print(f"Fleet '{fleet}' is up to date.")
+        return
+    if args.dry_run:
+        return
+
+    # Fetch every base image once up front so workers never race on a download
+    cfg_defaults = load_config().get("defaults", DEFAULT_CONFIG["defaults"])
+    for os_name in sorted({d.get("os") or cfg_defaults.get("os", "debian")
+                           for a, _n, d in pending if a == "create"}):
+        ensure_base_image(os_name, host_arch())
+
+    workers = args.workers or manifest.get("workers", 4)
+    print(f"\nApplying {len(pending)} change(s) to fleet '{fleet}' with {workers} worker(s)...")
+
+    def do(step):
+        action, name, detail = step
+        started = time.time()
+        try:
+            return step, True, apply_action(action, name, detail, fleet), time.time() - started
+        except Exception as e:
+            return step, False, str(e), time.time() - started
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(do, pending))
+
+    created = [step[1] for step, ok, _r, _t in results if ok and step[0] == "create"]
+    ips = {}
+    if args.wait and created:
+        print("\nWaiting for created VMs to get IP addresses...")
+        with ThreadPoolExecutor(max_workers=min(16, len(created))) as pool:
+            ips = dict(zip(created, pool.map(lambda n: vm_ip(n, timeout=180), created)))
+
+    print(f"\n{'ACTION':<8} {'NAME':<24} {'STATUS':<7} {'TIME':>7}  DETAIL")
+    print("-" * 80)
+    failed = 0
+    for (action, name, _detail), ok, result, elapsed in results:
+        failed += not ok
+        if ips.get(name):
+            result += f", ip {ips[name]}"
+        print(f"{action:<8} {name:<24} {'ok' if ok else 'FAILED':<7} {elapsed:>6.1f}s  {result}")
+    if any(step[0] == "create" for step, ok, _r, _t in results if ok):
+        print("\nIMPORTANT: Save these passwords - they won't be shown again!")
+    if failed:
+        sys.exit(1)
+
+def cmd_images(args):
+    """List cached base images, optionally re-checking upstream for new ones."""
+    ensure_dirs()
+    if args.pull:
+        for os_name in ([args.pull] if args.pull != "all" else sorted(OS_IMAGES)):
+            try:
+                ensure_base_image(os_name, host_arch(), refresh=True)
+            except Exception as e:
+                print(f"Error: could not refresh {os_name}: {e}", file=sys.stderr)
+                sys.exit(1)
+
+    index = load_image_index()
+    in_use = {entry["sha512"]: key for key, entry in index.items()}
+    files = sorted(f for f in os.listdir(IMAGE_STORE_DIR) if f.endswith(".qcow2"))
+    if not files:
+        print("No cached images.")
+        return
+
+    print(f"{'IMAGE':<16} {'SHA512':<20} {'SIZE':<10} {'FETCHED'}")
+    print("-" * 70)
+    for filename in files:
+        digest = filename[:-len(".qcow2")]
+        key = in_use.get(digest, "-")
+        size_mb = os.path.getsize(os.path.join(IMAGE_STORE_DIR, filename)) / 1024 ** 2
+        fetched = index.get(key, {}).get("fetched")
+        fetched_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(fetched)) if fetched else "-"
+        print(f"{key:<16} {digest[:16] + '...':<20} {size_mb:>6.0f}MB   {fetched_str}")
+
+def cmd_template(args):
+    """Turn a provisioned VM into a read-only template."""
+    template = args.template_name or args.name
+    if not vm_exists(args.name):
+        print(f"VM '{args.name}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+    if load_template(template):
+        print(f"Template '{template}' already exists.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        make_template(args.name, template)
+    except RuntimeError as e:
+        print(f"Error creating template: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"✓ Template '{template}' created from '{args.name}'")
+    print(f"  '{args.name}' is now sealed and shut off; delete it with: nox delete {args.name}")
+    print(f"  Create clones with: nox clone {template} NAME")
+
+def cmd_templates(args):
+    """List templates, or remove one."""
+    if args.rm:
+        users = [n for n in os.listdir(VMS_DIR) if (load_meta(n) or {}).get("template") == args.rm] \
+            if os.path.exists(VMS_DIR) else []
+        if users:
+            print(f"Template '{args.rm}' is used by: {', '.join(sorted(users))}", file=sys.stderr)
+            sys.exit(1)
+        for suffix in (".qcow2", ".json"):
+            p = os.path.join(TEMPLATES_DIR, args.rm + suffix)
+            if os.path.exists(p):
+                os.remove(p)
+        print(f"Template '{args.rm}' removed.")
+        return
+
+    templates = list_templates()
+    if not templates:
+        print("No templates found.")
+        return
+    print(f"{'NAME':<20} {'OS':<10} {'DISK':<8} {'SOURCE VM':<20} {'CREATED'}")
+    print("-" * 80)
+    for t in templates:
+        print(f"{t['name']:<20} {t['os']:<10} {str(t['disk_gb']) + 'GB':<8} {t['source_vm']:<20} {t['created']}")
+
+def cmd_clone(args):
+    """Create a VM as a linked clone of a template."""
+    network = parse_network(args.network) if args.network else None
+    success, password = create_vm(
+        args.name, cpus=args.cpus, ram=args.ram, disk=args.disk,
+        autostart=not args.no_autostart, start=not args.no_start,
+        network=network, template=args.template)
+    if not success:
+        sys.exit(1)
+    print(f"\n  Password: {password}  (shown once)")
+    print(f"  Connect:  nox ssh {args.name}")
+
+def cmd_pool(args):
+    """Manage the warm pool of pre-booted, paused VMs."""
+    profiles = pool_profiles()
+    if args.action == "fill":
+        names = [args.profile] if args.profile else sorted(profiles)
+        try:
+            for profile in names:
+                for name in fill_pool(profile):
+                    print(f"✓ {name} ready")
+        except RuntimeError as e:
+            print(f"Error filling pool: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif args.action == "drain":
+        for name in pool_members(args.profile):
+            delete_vm(name)
+            print(f"Deleted {name}")
+    else:
+        if not profiles:
+            print("No pool profiles configured (see \"pool\" in ~/.nox/config.json).")
+            return
+        print(f"{'PROFILE':<14} {'READY':<7} {'BOOTING':<8} {'SIZE':<5} SPEC")
+        print("-" * 70)
+        for profile, spec in sorted(profiles.items()):
+            members = pool_members(profile)
+            ready = sum(1 for m in members if (load_meta(m) or {}).get("pool_ready"))
+            os_name, vcpus, ram_mb, disk_gb, network = resolve_profile(spec)
+            print(f"{profile:<14} {ready:<7} {len(members) - ready:<8} {spec.get('size', 1):<5} "
+                  f"{os_name} {vcpus}cpu {ram_mb}MB {disk_gb}GB {network}")
+
+def cmd_seed_server(args):
+    """Serve NoCloud-Net user-data/meta-data to VMs created with seed mode 'net'."""
+    try:
+        serve_seeds(args.listen, args.port)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
 def cmd_start(args):
     if not vm_exists(args.name):
         print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         sys.exit(1)
-    virsh(f"start {args.name}")
+    backend().start(args.name)
     print(f"VM '{args.name}' started.")
 
 def cmd_stop(args):
     if not vm_exists(args.name):
         print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         sys.exit(1)
-    virsh(f"shutdown {args.name}")
+    backend().shutdown(args.name)
     print(f"VM '{args.name}' shutting down.")
 
 def cmd_restart(args):
     if not vm_exists(args.name):
         print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         sys.exit(1)
-    virsh(f"reboot {args.name}")
+    backend().reboot(args.name)
     print(f"VM '{args.name}' restarted.")
 
 def cleanup_macvtap(name):
     """Remove the macvtap interface belonging to a specific VM."""
     try:
         # Get the VM's MAC address from its XML before it's undefined
-        result = virsh(f"dumpxml {name}", check=False)
-        if result.returncode != 0:
+        try:
+            out = backend().dumpxml(name)
+        except RuntimeError:
             return
-        out = result.stdout if isinstance(result.stdout, str) else result.stdout.decode()
 
         import re
         # Find MAC addresses used by this VM
@@ -786,6 +4488,21 @@ def cleanup_macvtap(name):
     except Exception as e:
         print(f"Warning: macvtap cleanup failed: {e}", file=sys.stderr)
 
+def delete_vm(name):
+    """Destroy and undefine a VM and remove its local files."""
+    state = vm_state(name)
+    # Paused (e.g. warm pool) VMs too: undefining a live domain leaves it running as a transient one
+    if state not in (None, "shut off"):
+        backend().destroy(name)
+
+    cleanup_macvtap(name)
+    if state is not None:
+        backend().undefine(name, remove_storage=True)
+    forget_ip_cache(name)
+    d = vm_dir(name)
+    if os.path.exists(d):
+        shutil.rmtree(d)
+
 def cmd_delete(args):
     if not vm_exists(args.name):
         d = vm_dir(args.name)
@@ -796,56 +4513,58 @@ def cmd_delete(args):
             print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         return
 
-    state = vm_state(args.name)
-    if state == "running":
-        virsh(f"destroy {args.name}")
-
-    cleanup_macvtap(args.name)
-    virsh(f"undefine {args.name} --nvram --remove-all-storage")
-    d = vm_dir(args.name)
-    if os.path.exists(d):
-        shutil.rmtree(d)
+    delete_vm(args.name)
     print(f"VM '{args.name}' deleted.")
 
 def cmd_list(args):
-    result = virsh("list --all", check=False)
-    if result.returncode != 0:
+    try:
+        summaries = domain_summaries()
+    except RuntimeError:
         print("Could not list VMs. Is libvirt installed?", file=sys.stderr)
         sys.exit(1)
 
-    # Parse virsh list output
-    vm_names = []
-    for line in result.stdout.splitlines()[2:]:  # Skip header
-        parts = line.split()
-        if len(parts) >= 2:
-            vm_names.append(parts[1])
+    # Warm pool VMs are an implementation detail; see 'nox pool'
+    summaries = [d for d in summaries if not d["name"].startswith(POOL_PREFIX)]
+    ips = lookup_ips([d["name"] for d in summaries if d["state"] == "running"])
+
+    rows = []
+    for d in summaries:
+        meta = load_meta(d["name"]) or {}
+        disk_bytes = d["disk_bytes"]
+        rows.append({
+            "name": d["name"],
+            "state": d["state"],
+            "os": meta.get("os"),
+            "vcpus": d["vcpus"] or meta.get("vcpus"),
+            "ram_mb": d["ram_mb"] or meta.get("ram_mb"),
+            "disk_gb": round(disk_bytes / 1024 ** 3, 1) if disk_bytes else meta.get("disk_gb"),
+            "disk_allocated_bytes": d["disk_allocated_bytes"],
+            "autostart": meta.get("autostart", False),
+            "network": meta.get("network_value"),
+            "ip": ips.get(d["name"]),
+        })
+
+    if getattr(args, "json", False):
+        print(json.dumps(rows, indent=2))
+        return
 
-    if not vm_names:
+    if not rows:
         print("No VMs found.")
         return
 
     print(f"{'NAME':<20} {'STATE':<15} {'OS':<10} {'CPUS':<6} {'RAM':<8} {'DISK':<8} {'AUTOSTART':<10} {'IP'}")
     print("-" * 95)
 
-    for name in vm_names:
-        state = vm_state(name) or "UNKNOWN"
-
-        meta = load_meta(name) or {}
-        os_name = meta.get("os", "?")
-        vcpus = meta.get("vcpus", "?")
-        ram = meta.get("ram_mb", "?")
-        disk_g = meta.get("disk_gb", "?")
-        auto = meta.get("autostart", False)
-
-        ip = ""
-        if state == "running":
-            ip = vm_ip(name, timeout=1) or ""
-
-        ram_str = f"{ram}MB" if ram != "?" else "?"
-        disk_str = f"{disk_g}GB" if disk_g != "?" else "?"
-        auto_str = "yes" if auto else "no"
+    for row in rows:
+        os_name = row["os"] or "?"
+        vcpus = row["vcpus"] or "?"
+        ram_str = f"{row['ram_mb']}MB" if row["ram_mb"] else "?"
+        disk_g = row["disk_gb"]
+        disk_str = f"{disk_g:g}GB" if disk_g else "?"
+        auto_str = "yes" if row["autostart"] else "no"
+        ip = row["ip"] or ""
 
-        print(f"{name:<20} {state:<15} {os_name:<10} {vcpus:<6} {ram_str:<8} {disk_str:<8} {auto_str:<10} {ip}")
+        print(f"{row['name']:<20} {row['state']:<15} {os_name:<10} {vcpus:<6} {ram_str:<8} {disk_str:<8} {auto_str:<10} {ip}")
 
 def cmd_ssh(args):
     if not vm_exists(args.name):
@@ -859,52 +4578,33 @@ def cmd_ssh(args):
 
     if args.ssh_command:
         # Run command inside VM via qemu guest agent
-        import json, base64
         cmd_str = " ".join(args.ssh_command)
-        ga_cmd = json.dumps({
-            "execute": "guest-exec",
-            "arguments": {
-                "path": "/bin/bash",
-                "arg": ["-c", cmd_str],
-                "capture-output": True
-            }
-        })
         try:
-            result = virsh(f"qemu-agent-command {args.name} '{ga_cmd}'")
-            stdout = result.stdout if isinstance(result.stdout, str) else result.stdout.decode()
-            data = json.loads(stdout)
-            pid = data.get("return", {}).get("pid")
-            if pid is None:
-                print("Failed to execute command in VM", file=sys.stderr)
-                sys.exit(1)
-            for _ in range(60):
-                time.sleep(1)
-                status_cmd = json.dumps({"execute": "guest-exec-status", "arguments": {"pid": pid}})
-                res2 = virsh(f"qemu-agent-command {args.name} '{status_cmd}'")
-                out2 = res2.stdout if isinstance(res2.stdout, str) else res2.stdout.decode()
-                status = json.loads(out2).get("return", {})
-                if status.get("exited"):
-                    if status.get("out-data"):
-                        print(base64.b64decode(status["out-data"]).decode(), end="")
-                    if status.get("err-data"):
-                        print(base64.b64decode(status["err-data"]).decode(), end="", file=sys.stderr)
-                    sys.exit(status.get("exitcode", 0))
-            print("Command timed out", file=sys.stderr)
-            sys.exit(1)
+            exitcode, out, err = guest_exec(args.name, cmd_str, timeout=60)
+            print(out, end="")
+            print(err, end="", file=sys.stderr)
+            sys.exit(exitcode)
         except RuntimeError as e:
             print(f"Failed to run command: {e}", file=sys.stderr)
             sys.exit(1)
 
     print(f"Connecting to '{args.name}' via serial console (press Ctrl+] to exit)...")
-    os.execvp("virsh", ["virsh", "--connect", "qemu:///system", "console", args.name])
+    os.execvp("virsh", ["virsh", "--connect", LIBVIRT_URI, "console", args.name])
 
 def cmd_status(args):
     if not vm_exists(args.name):
         print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         sys.exit(1)
 
-    result = virsh(f"dominfo {args.name}")
-    print(result.stdout)
+    info = backend().dominfo(args.name)
+    for key, value in info.items():
+        print(f"{key + ':':<16}{value}")
+    if info.get("State") == "running":
+        print(f"{'IP:':<16}{lookup_ips([args.name]).get(args.name) or '-'}")
+        job = backend().block_job_info(args.name, "vda")
+        if job and job["end"]:
+            print(f"{'Block job:':<16}{100 * job['cur'] / job['end']:.1f}% of "
+                  f"{job['end'] / 1024 ** 3:.2f}GB copied")
 
 def cmd_passwd(args):
     """Change password for a VM user via qemu guest agent."""
@@ -921,40 +4621,14 @@ def cmd_passwd(args):
     new_password = generate_password()
 
     # Change password via qemu guest agent (works without network)
-    import json, base64
+    import base64
     pw_b64 = base64.b64encode(f"nox:{new_password}".encode()).decode()
     cmd_str = f"echo $(echo {pw_b64} | base64 -d) | chpasswd"
-    ga_cmd = json.dumps({
-        "execute": "guest-exec",
-        "arguments": {
-            "path": "/bin/bash",
-            "arg": ["-c", cmd_str],
-            "capture-output": True
-        }
-    })
 
     try:
-        result = virsh(f"qemu-agent-command {args.name} '{ga_cmd}'")
-        stdout = result.stdout if isinstance(result.stdout, str) else result.stdout.decode()
-        data = json.loads(stdout)
-        pid = data.get("return", {}).get("pid")
-
-        if pid is None:
-            raise RuntimeError("guest-exec returned no pid")
-
-        # Wait for command to finish
-        import time
-        for _ in range(10):
-            time.sleep(1)
-            status_cmd = json.dumps({"execute": "guest-exec-status", "arguments": {"pid": pid}})
-            res2 = virsh(f"qemu-agent-command {args.name} '{status_cmd}'")
-            out2 = res2.stdout if isinstance(res2.stdout, str) else res2.stdout.decode()
-            status = json.loads(out2).get("return", {})
-            if status.get("exited"):
-                if status.get("exitcode", 0) != 0:
-                    err = base64.b64decode(status.get("err-data", "")).decode()
-                    raise RuntimeError(f"chpasswd failed: {err}")
-                break
+        exitcode, _out, err = guest_exec(args.name, cmd_str, timeout=10)
+        if exitcode != 0:
+            raise RuntimeError(f"chpasswd failed: {err}")
 
         print(f"\n{'='*60}")
         print(f"Password changed for VM '{args.name}'!")
@@ -968,87 +4642,79 @@ def cmd_passwd(args):
         print(f"Failed to change password: {e}", file=sys.stderr)
         sys.exit(1)
 
-def cmd_resize(args):
-    """Resize VM resources (CPUs, RAM, or disk)."""
-    if not vm_exists(args.name):
-        print(f"VM '{args.name}' does not exist.", file=sys.stderr)
-        sys.exit(1)
-
-    state = vm_state(args.name)
-    meta = load_meta(args.name)
+def resize_vm(name, cpus=None, ram=None, disk=None):
+    """Resize VM resources (CPUs, RAM, or disk). Raises RuntimeError on invalid requests."""
+    state = vm_state(name)
+    meta = load_meta(name)
     if not meta:
-        print(f"Could not load metadata for VM '{args.name}'", file=sys.stderr)
-        sys.exit(1)
+        raise RuntimeError(f"Could not load metadata for VM '{name}'")
 
-    vm_path = vm_dir(args.name)
-    disk_path = os.path.join(vm_path, f"{args.name}.qcow2")
+    vm_path = vm_dir(name)
+    disk_path = os.path.join(vm_path, f"{name}.qcow2")
 
     # Handle CPU resize
-    if args.cpus is not None:
-        vcpus = resolve_resource(args.cpus, host_cpus())
+    if cpus is not None:
+        vcpus = resolve_resource(cpus, host_cpus())
         print(f"Resizing CPUs to {vcpus}...")
         
         # Set maximum vCPUs (requires VM to be shut off)
         if state == "running":
             print("Note: Setting maximum vCPUs requires VM shutdown. Stopping VM...")
-            virsh(f"shutdown {args.name}")
+            backend().shutdown(name)
             # Wait for shutdown
             for _ in range(30):
-                if vm_state(args.name) == "shut off":
+                if vm_state(name) == "shut off":
                     break
                 time.sleep(1)
         
-        virsh(f"setvcpus {args.name} {vcpus} --maximum --config")
-        virsh(f"setvcpus {args.name} {vcpus} --config")
+        backend().set_vcpus(name, vcpus)
         meta["vcpus"] = vcpus
         print(f"✓ CPUs updated to {vcpus}")
         
         if state == "running":
             print("Restarting VM...")
-            virsh(f"start {args.name}")
+            backend().start(name)
 
     # Handle RAM resize
-    if args.ram is not None:
-        ram_mb = resolve_resource(args.ram, host_ram_mb())
+    if ram is not None:
+        ram_mb = resolve_resource(ram, host_ram_mb())
         ram_kb = ram_mb * 1024
         print(f"Resizing RAM to {ram_mb}MB...")
         
         if state == "running":
             print("Note: RAM resize requires VM shutdown. Stopping VM...")
-            virsh(f"shutdown {args.name}")
+            backend().shutdown(name)
             # Wait for shutdown
             for _ in range(30):
-                if vm_state(args.name) == "shut off":
+                if vm_state(name) == "shut off":
                     break
                 time.sleep(1)
         
-        virsh(f"setmaxmem {args.name} {ram_kb} --config")
-        virsh(f"setmem {args.name} {ram_kb} --config")
+        backend().set_memory(name, ram_kb)
         meta["ram_mb"] = ram_mb
         print(f"✓ RAM updated to {ram_mb}MB")
         
         if state == "running":
             print("Restarting VM...")
-            virsh(f"start {args.name}")
+            backend().start(name)
 
     # Handle disk resize
-    if args.disk is not None:
-        disk_gb = resolve_resource(args.disk, host_disk_gb())
+    if disk is not None:
+        disk_gb = resolve_resource(disk, host_disk_gb())
         current_disk = meta.get("disk_gb", 0)
         
         if disk_gb <= current_disk:
-            print(f"Error: New disk size ({disk_gb}GB) must be larger than current size ({current_disk}GB)", file=sys.stderr)
-            print("Disk shrinking is not supported.", file=sys.stderr)
-            sys.exit(1)
+            raise RuntimeError(f"New disk size ({disk_gb}GB) must be larger than current size ({current_disk}GB)\n"
+                               "Disk shrinking is not supported.")
         
         print(f"Expanding disk from {current_disk}GB to {disk_gb}GB...")
         
         # Resize the qcow2 image
         run(f"qemu-img resize {disk_path} {disk_gb}G")
         
-        # If VM is running, use virsh blockresize
+        # If VM is running, grow the disk the guest sees as well
         if state == "running":
-            virsh(f"blockresize {args.name} {disk_path} {disk_gb}G")
+            backend().block_resize(name, disk_path, disk_gb)
         
         meta["disk_gb"] = disk_gb
         print(f"✓ Disk expanded to {disk_gb}GB")
@@ -1057,116 +4723,664 @@ def cmd_resize(args):
         print("  sudo resize2fs /dev/vda1")
 
     # Save updated metadata
-    save_meta(args.name, meta)
+    save_meta(name, meta)
     
-    print(f"\n✓ VM '{args.name}' resized successfully!")
-    if state == "running" and (args.cpus is not None or args.ram is not None):
+    print(f"\n✓ VM '{name}' resized successfully!")
+    if state == "running" and (cpus is not None or ram is not None):
         print(f"VM state: running")
     elif state == "shut off":
-        print(f"VM state: shut off (use 'nox start {args.name}' to start)")
+        print(f"VM state: shut off (use 'nox start {name}' to start)")
 
-
-def cmd_backup(args):
-    """Backup a VM using live snapshot (no downtime)."""
+def cmd_resize(args):
+    """Resize VM resources (CPUs, RAM, or disk)."""
     if not vm_exists(args.name):
         print(f"VM '{args.name}' does not exist.", file=sys.stderr)
         sys.exit(1)
 
-    state = vm_state(args.name)
+    try:
+        resize_vm(args.name, cpus=args.cpus, ram=args.ram, disk=args.disk)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+def load_backup_info(backup_name):
+    info_path = os.path.join(BACKUPS_DIR, backup_name, "backup_info.json")
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path) as f:
+        return json.load(f)
+
+def discard_disks(name, inactive=False):
+    """Return (domain XML root, driver elements of the VM's disks)."""
+    import xml.etree.ElementTree as ET
+    root = ET.fromstring(backend().dumpxml(name, inactive=inactive))
+    return root, root.findall("./devices/disk[@device='disk']/driver")
+
+def enable_discard(name):
+    """Set discard=unmap on a VM's disks in its persistent definition.
+
+    Returns True if the definition changed; a running VM picks it up at
+    its next cold boot.
+    """
+    import xml.etree.ElementTree as ET
+    root, drivers = discard_disks(name, inactive=True)
+    changed = [d for d in drivers if d.get("discard") != "unmap"]
+    for driver in changed:
+        driver.set("discard", "unmap")
+        driver.set("detect_zeroes", "unmap")
+    if changed:
+        backend().define(ET.tostring(root, encoding="unicode"))
+    return bool(changed)
+
+def trim_guest(name, disk_path):
+    """Discard the guest's free space (guest-fstrim) so a backup skips it.
+
+    Returns (trimmed, skipped): bytes the guest reported trimmed, and
+    bytes of disk_path that no longer hold data. Disks created before
+    nox enabled discard=unmap get it switched on, which only takes
+    effect after the VM is next stopped and started; until then nothing
+    is trimmed and (0, 0) is returned.
+    """
+    if not all(d.get("discard") == "unmap" for d in discard_disks(name)[1]):
+        enable_discard(name)
+        print("Note: enabled discard=unmap for this VM's disk; trimming frees space after its next "
+              f"cold boot ('nox stop {name}' then 'nox start {name}').")
+        return 0, 0
+    before = image_data_bytes(disk_path)
+    started = time.time()
+    result = backend().agent_command(name, {"execute": "guest-fstrim"}, timeout=900)
+    trimmed = sum(path.get("trimmed") or 0 for path in result.get("paths", []))
+    for path in result.get("paths", []):
+        if path.get("error"):
+            print(f"  Warning: fstrim {path.get('path')}: {path['error']}", file=sys.stderr)
+    skipped = max(0, before - image_data_bytes(disk_path))
+    print(f"  Trimmed guest free space in {time.time() - started:.1f}s: "
+          f"{skipped / 1024 ** 2:.1f}MB of freed blocks won't be copied")
+    return trimmed, skipped
+
+class GuestFreeze:
+    """Context manager freezing a guest's filesystems around a backup's point in time.
+
+    The pre hook runs in the guest (via guest-exec) before the freeze and
+    the post hook after the thaw, or after a failed pre hook or freeze,
+    which abort the backup.
+    frozen_ms records how long guest I/O was blocked.
+    """
+
+    def __init__(self, name, pre_hook=None, post_hook=None, hook_timeout=300):
+        self.name, self.pre_hook, self.post_hook, self.hook_timeout = name, pre_hook, post_hook, hook_timeout
+        self.frozen_ms = None
+
+    def _hook(self, which, cmd):
+        exitcode, _out, err = guest_exec(self.name, cmd, timeout=self.hook_timeout)
+        if exitcode != 0:
+            raise RuntimeError(f"{which} hook exited with {exitcode}: {err.strip()[:200]}")
+
+    def __enter__(self):
+        try:
+            if self.pre_hook:
+                print("  Running pre-backup hook in the guest...")
+                self._hook("pre-backup", self.pre_hook)
+            # Timed from the freeze request: the guest blocks writers while it flushes
+            self.started = time.monotonic()
+            try:
+                backend().fs_freeze(self.name)
+            except RuntimeError as e:
+                raise RuntimeError(f"guest agent could not freeze filesystems (back up without --quiesce "
+                                   f"for a crash-consistent backup): {e}")
+        except RuntimeError:
+            self._post()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            for attempt in range(3):
+                try:
+                    backend().fs_thaw(self.name)
+                    break
+                except RuntimeError:
+                    if attempt == 2:
+                        raise RuntimeError(f"could not thaw the filesystems of '{self.name}'; "
+                                           f"run 'virsh domfsthaw {self.name}'")
+                    time.sleep(0.5)
+        finally:
+            self.frozen_ms = round((time.monotonic() - self.started) * 1000, 1)
+            print(f"  Guest filesystems frozen for {self.frozen_ms:.1f}ms")
+            self._post()
+
+    def _post(self):
+        if self.post_hook:
+            try:
+                self._hook("post-backup", self.post_hook)
+            except RuntimeError as e:
+                print(f"Warning: {e}", file=sys.stderr)
+
+def backup_hooks(name, settings):
+    """The {"pre", "post"} guest hook commands for a VM from backup.hooks glob patterns."""
+    import fnmatch
+    for pattern, hooks in settings.get("hooks", {}).items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return hooks
+    return {}
+
+def push_backup(name, target, incremental_from=None, checkpoint=None, freeze=None):
+    """Run a libvirt push-mode backup of vda into target (qcow2) and wait for it.
+
+    With incremental_from, only blocks dirtied since that checkpoint are
+    written. With checkpoint, a new persistent dirty bitmap starts here.
+    freeze (a GuestFreeze) is held only while the job starts.
+    """
+    incremental = f"<incremental>{incremental_from}</incremental>" if incremental_from else ""
+    backup_xml = (f"<domainbackup mode='push'>{incremental}<disks>"
+                  f"<disk name='vda' backup='yes' type='file'><target file='{target}'/>"
+                  f"<driver type='qcow2'/></disk></disks></domainbackup>")
+    checkpoint_xml = None
+    if checkpoint:
+        checkpoint_xml = (f"<domaincheckpoint><name>{checkpoint}</name><disks>"
+                          f"<disk name='vda' checkpoint='bitmap'/></disks></domaincheckpoint>")
+    with vm_io_limit(name, target):
+        with freeze or contextlib.nullcontext():
+            backend().backup_begin(name, backup_xml, checkpoint_xml)
+        try:
+            return backend().job_wait(name)
+        except BaseException:
+            backend().job_abort(name)
+            raise
+
+def push_export(name, backup_path, codec_spec, threads, freeze=None):
+    """Full live backup through a push-mode backup job (no overlay, no commit).
+
+    The job writes a point-in-time qcow2 while the guest keeps running;
+    with a compressing codec that copy is then encoded by export_disk.
+    """
+    staging = os.path.join(backup_path, f"{name}.push.qcow2")
+    push_backup(name, staging, freeze=freeze)
+    written = allocated_bytes(staging)
+    if parse_codec(codec_spec)[0] == "none":
+        disk_file = f"{name}.qcow2"
+        os.rename(staging, os.path.join(backup_path, disk_file))
+        disk_info = {"disk_file": disk_file, "disk_format": "qcow2", "codec": "none",
+                     "virtual_size": None, "disk_bytes": os.path.getsize(os.path.join(backup_path, disk_file))}
+    else:
+        try:
+            disk_info = export_disk(staging, backup_path, name, codec_spec, threads)
+        finally:
+            os.remove(staging)
+        written += disk_info["disk_bytes"]
+    disk_info["bytes_written"] = written
+    return disk_info
+
+def pull_export(name, backup_path, codec_spec, threads, readers, freeze=None):
+    """Full live backup read from a pull-mode backup job's NBD export.
+
+    libvirt exposes a point-in-time view of vda on a unix socket (guest
+    writes copy the old blocks into a scratch file first); nox reads it
+    with several connections and compresses the stream as it arrives.
+    """
+    socket_path = os.path.join(backup_path, "nbd.sock")
+    scratch = os.path.join(backup_path, f"{name}.scratch.qcow2")
+    backup_xml = (f"<domainbackup mode='pull'><server transport='unix' socket='{socket_path}'/>"
+                  f"<disks><disk name='vda' backup='yes' type='file'><scratch file='{scratch}'/>"
+                  f"</disk></disks></domainbackup>")
+    with freeze or contextlib.nullcontext():
+        backend().backup_begin(name, backup_xml)
+    try:
+        disk_info = export_disk(nbd_uri(socket_path, "vda"), backup_path, name, codec_spec, threads, readers)
+        disk_info["scratch_bytes"] = allocated_bytes(scratch)
+    finally:
+        # A pull job lasts until it is aborted; that also drops the scratch file
+        backend().job_abort(name)
+        for path in (socket_path, scratch):
+            if os.path.exists(path):
+                os.remove(path)
+    disk_info["bytes_written"] = disk_info["disk_bytes"] + disk_info["scratch_bytes"]
+    disk_info["readers"] = readers
+    return disk_info
+
+def chain_backup(name, mode, backup_path, backup_name, freeze=None):
+    """Take a full/incremental/differential backup based on libvirt checkpoints.
+
+    The VM's meta.json remembers the current chain ("backup_chain"): the
+    full backup and its checkpoint, and the latest backup and its
+    checkpoint. A backup with no usable chain becomes a new full.
+    Returns the fields to merge into backup_info.json.
+    """
+    meta = load_meta(name) or {}
+    chain = meta.get("backup_chain") or {}
+    existing = set(backend().checkpoints(name))
+    if mode != "full" and (chain.get("last_checkpoint") not in existing or
+                           chain.get("full_checkpoint") not in existing or
+                           not load_backup_info(chain.get("last", "")) or
+                           not load_backup_info(chain.get("full", ""))):
+        print("No usable backup chain for this VM; taking a full backup first.")
+        mode = "full"
+
+    checkpoint = f"nox-{backup_name}"
+    if mode == "full":
+        since, parent, members = None, None, []
+    elif mode == "differential":
+        since, parent = chain["full_checkpoint"], chain["full"]
+        members = [parent]
+    else:
+        since, parent = chain["last_checkpoint"], chain["last"]
+        members = load_backup_info(parent).get("chain", [parent])
+
+    disk_file = f"{name}.qcow2"
+    print(f"Running {mode} backup via libvirt backup job...")
+    push_backup(name, os.path.join(backup_path, disk_file), incremental_from=since, checkpoint=checkpoint,
+                freeze=freeze)
+
+    if mode == "full":
+        # A new chain starts here: older bitmaps only cost write overhead now
+        for old in existing:
+            if old.startswith("nox-"):
+                backend().checkpoint_delete(name, old)
+        chain = {"full": backup_name, "full_checkpoint": checkpoint}
+    chain.update({"last": backup_name, "last_checkpoint": checkpoint})
+    meta["backup_chain"] = chain
+    save_meta(name, meta)
+
+    return {"type": mode, "parent": parent, "chain": members + [backup_name], "engine": "push",
+            "checkpoint": checkpoint, "disk_file": disk_file, "disk_format": "qcow2",
+            "codec": "none", "virtual_size": image_virtual_size(os.path.join(backup_path, disk_file)),
+            "disk_bytes": os.path.getsize(os.path.join(backup_path, disk_file)),
+            "bytes_written": allocated_bytes(os.path.join(backup_path, disk_file))}
+
+def chain_image_spec(chain):
+    """Return a qemu json: filename layering every backup in chain (full first)."""
+    spec = None
+    for backup_name in chain:
+        info = load_backup_info(backup_name)
+        if not info:
+            raise RuntimeError(f"Backup chain is missing '{backup_name}'")
+        path = os.path.join(BACKUPS_DIR, backup_name, info.get("disk_file") or f"{info['vm_name']}.qcow2")
+        spec = {"driver": "qcow2", "file": {"driver": "file", "filename": path}, "backing": spec}
+    return "json:" + json.dumps(spec)
+
+def backup_vm(name, codec=None, upload=True, mode="full", engine=None, readers=None, thin=None, threads=None,
+              commit_bandwidth=None, quiesce=None, pre_hook=None, post_hook=None, trim=None):
+    """Back up a VM without downtime.
+
+    Running VMs are copied through a temporary snapshot overlay that is
+    committed back afterwards (engine "snapshot"), through a push-mode
+    backup job (engine "push"), or by reading a pull-mode backup job's
+    NBD export with `readers` connections (engine "pull"). mode
+    "incremental" or "differential" uses the backup job with dirty
+    bitmaps. thin backs up only the disk's overlay plus a hash reference
+    to its base image. threads overrides the compression threads;
+    commit_bandwidth (MB/s) caps merging the snapshot back, defaulting to
+    throttle.blockjob_mb. quiesce freezes the guest's filesystems (with
+    optional pre/post hooks run in the guest) just while the point in
+    time is taken. trim discards the guest's free space first. Returns
+    the backup_info dict; raises on failure after cleaning up.
+    """
+    state = vm_state(name)
     was_running = state == "running"
+    settings = backup_settings()
+    settings["threads"] = threads or settings["threads"]
+    codec = codec or settings["codec"]
+    parse_codec(codec)
+    engine = engine or settings["engine"]
+    if engine not in BACKUP_ENGINES:
+        raise RuntimeError(f"Unknown backup engine '{engine}' (expected one of: {', '.join(BACKUP_ENGINES)})")
+    if mode != "full" and not was_running:
+        print(f"Note: {mode} backups need a running VM; taking a plain full backup.")
+        mode = "full"
+        # The VM may have changed since its last checkpoint; start over next time
+        meta = load_meta(name) or {}
+        if meta.pop("backup_chain", None) is not None:
+            save_meta(name, meta)
+    use_chain = mode != "full"
+
+    base = None
+    thin = settings.get("thin", False) if thin is None else thin
+    if thin and not use_chain:
+        base = disk_backing(os.path.join(vm_dir(name), f"{name}.qcow2"))
+        if not base or not os.path.exists(base):
+            print("Note: disk has no local base image; taking a flattened backup.")
+            base = None
+        elif parse_codec(codec)[0] == "dedup":
+            print("Note: dedup backups already share base image data; ignoring --thin.")
+            base = None
+        elif was_running and engine != "snapshot":
+            print(f"Note: thin backups read the overlay directly; using the snapshot engine instead of {engine}.")
+            engine = "snapshot"
+    use_snapshot = was_running and not use_chain and engine == "snapshot"
+
+    trimmed = skipped = None
+    if was_running and (settings.get("trim", False) if trim is None else trim):
+        print("Trimming free space in the guest...")
+        try:
+            trimmed, skipped = trim_guest(name, os.path.join(vm_dir(name), f"{name}.qcow2"))
+        except RuntimeError as e:
+            print(f"Warning: could not trim the guest, backing up as is: {e}", file=sys.stderr)
+
+    freeze = None
+    if pre_hook or post_hook or (settings.get("quiesce", False) if quiesce is None else quiesce):
+        if was_running:
+            hooks = backup_hooks(name, settings)
+            freeze = GuestFreeze(name, pre_hook or hooks.get("pre"), post_hook or hooks.get("post"))
+        else:
+            print("Note: VM is not running; nothing to quiesce.")
     
     # Create backup directory
     timestamp = time.strftime("%Y%m%d_%H%M%S")
-    backup_name = f"{args.name}_{timestamp}"
+    backup_name = f"{name}_{timestamp}"
     backup_path = os.path.join(BACKUPS_DIR, backup_name)
     os.makedirs(backup_path, exist_ok=True)
 
     print(f"Creating live backup '{backup_name}'...")
 
-    vm_path = vm_dir(args.name)
-    disk_path = os.path.join(vm_path, f"{args.name}.qcow2")
-    snapshot_disk = os.path.join(vm_path, f"{args.name}_snapshot.qcow2")
+    vm_path = vm_dir(name)
+    disk_path = os.path.join(vm_path, f"{name}.qcow2")
+    snapshot_disk = os.path.join(vm_path, f"{name}_snapshot.qcow2")
+    started = time.time()
 
     try:
         # Create external snapshot if VM is running (live backup)
-        if was_running:
-            print("Creating live snapshot (VM continues running)...")
-            # Create external snapshot - VM writes to new file, original becomes read-only
-            virsh(f"snapshot-create-as {args.name} backup_snapshot --disk-only --atomic --no-metadata")
-            # Now the original disk is frozen and can be safely backed up
-            time.sleep(1)  # Brief pause to ensure snapshot is ready
-
-        # Backup disk image with compression
-        print("Backing up disk image (compressed)...")
-        backup_disk = os.path.join(backup_path, f"{args.name}.qcow2")
-        run(f"qemu-img convert -O qcow2 -c {disk_path} {backup_disk}")
-
-        # If we created a snapshot, merge it back
-        if was_running:
-            print("Merging snapshot back...")
-            # Commit changes from snapshot back to original
-            virsh(f"blockcommit {args.name} vda --active --pivot")
-            # Clean up snapshot file
-            if os.path.exists(snapshot_disk):
-                os.remove(snapshot_disk)
+        if use_chain:
+            disk_info = chain_backup(name, mode, backup_path, backup_name, freeze)
+        elif was_running and engine == "push":
+            print(f"Running push backup job (VM continues running, codec {codec})...")
+            disk_info = push_export(name, backup_path, codec, settings["threads"], freeze)
+            disk_info["engine"] = "push"
+        elif was_running and engine == "pull":
+            readers = max(1, int(readers or settings["readers"]))
+            print(f"Reading pull backup export with {readers} readers (codec {codec})...")
+            disk_info = pull_export(name, backup_path, codec, settings["threads"], readers, freeze)
+            disk_info["engine"] = "pull"
+        else:
+            if use_snapshot:
+                print("Creating live snapshot (VM continues running)...")
+                # Create external snapshot - VM writes to new file, original becomes read-only
+                with freeze or contextlib.nullcontext():
+                    backend().snapshot_disk_only(name, "backup_snapshot", "vda", snapshot_disk)
+
+            # Backup disk image, compressed exactly once
+            print(f"Backing up disk image (codec {codec})...")
+            copy_started = time.time()
+            disk_info = export_disk(disk_path, backup_path, name, codec, settings["threads"],
+                                    max(1, int(readers or settings["readers"])), base=base)
+            disk_info["engine"] = "snapshot" if use_snapshot else "offline"
+            disk_info["bytes_written"] = disk_info["disk_bytes"]
+
+            # If we created a snapshot, merge it back
+            if use_snapshot:
+                print("Merging snapshot back...")
+                # Everything the guest wrote meanwhile is rewritten into the base image
+                commit_bytes = allocated_bytes(snapshot_disk)
+                commit_started = time.time()
+                if commit_bandwidth is None:
+                    commit_bandwidth = throttle_settings()["blockjob_mb"]
+                backend().block_commit(name, "vda", bandwidth_mib=commit_bandwidth)
+                disk_info["commit_bytes"] = commit_bytes
+                disk_info["commit_s"] = round(time.time() - commit_started, 1)
+                disk_info["copy_s"] = round(commit_started - copy_started, 1)
+                disk_info["bytes_written"] += commit_bytes
+                # Clean up snapshot file
+                if os.path.exists(snapshot_disk):
+                    os.remove(snapshot_disk)
 
         # Backup metadata
-        meta = load_meta(args.name)
+        meta = load_meta(name)
         if meta:
             backup_meta = os.path.join(backup_path, "meta.json")
             with open(backup_meta, "w") as f:
                 json.dump(meta, f, indent=2)
 
-        # Backup cloud-init files if they exist
-        for filename in ["user-data", "meta-data", "cloud-init.iso"]:
+        # Backup cloud-init files if they exist (the seed ISO is rebuilt on restore)
+        for filename in ["user-data", "meta-data"]:
             src = os.path.join(vm_path, filename)
             if os.path.exists(src):
                 dst = os.path.join(backup_path, filename)
                 shutil.copy2(src, dst)
 
         # Get VM XML definition
-        result = virsh(f"dumpxml {args.name}")
         xml_path = os.path.join(backup_path, "domain.xml")
-        xml_content = result.stdout if isinstance(result.stdout, str) else result.stdout.decode('utf-8')
+        xml_content = backend().dumpxml(name)
         with open(xml_path, "w") as f:
             f.write(xml_content)
 
         # Create backup info file
         backup_info = {
-            "vm_name": args.name,
+            "vm_name": name,
             "backup_name": backup_name,
             "timestamp": timestamp,
             "was_running": was_running,
             "metadata": meta,
+            "duration_s": round(time.time() - started, 1),
+            "type": "full",
+            "chain": [backup_name],
+            "consistency": "quiesced" if freeze else "crash" if was_running else "offline",
         }
+        if freeze:
+            backup_info["freeze_ms"] = freeze.frozen_ms
+        if skipped is not None:
+            backup_info.update(trimmed_bytes=trimmed, skipped_bytes=skipped)
+        backup_info.update(disk_info)
+        backup_info["disk_sha256"] = file_digest(os.path.join(backup_path, backup_info["disk_file"]), "sha256")
         info_path = os.path.join(backup_path, "backup_info.json")
         with open(info_path, "w") as f:
             json.dump(backup_info, f, indent=2)
+        catalog_record(backup_info, backup_path)
 
-        print(f"✓ Backup created successfully: {backup_name}")
-        print(f"  Location: {backup_path}")
-        if was_running:
-            print(f"  VM '{args.name}' remained running during backup")
-
-        # Upload to S3 if configured
-        cfg = load_config()
-        s3_config = cfg.get("s3", {})
-        if s3_config.get("enabled"):
-            upload_to_s3(backup_path, backup_name, s3_config)
-
-    except Exception as e:
-        print(f"Error creating backup: {e}", file=sys.stderr)
+    except BaseException:
         # Try to clean up snapshot if it exists
-        if was_running:
+        if use_snapshot:
             try:
-                virsh(f"blockcommit {args.name} vda --active --pivot", check=False)
+                backend().block_commit(name, "vda", check=False)
                 if os.path.exists(snapshot_disk):
                     os.remove(snapshot_disk)
-            except:
+            except Exception:
                 pass
         shutil.rmtree(backup_path, ignore_errors=True)
+        raise
+
+    print(f"✓ {backup_info['type'].capitalize()} backup created successfully: {backup_name}")
+    print(f"  Location: {backup_path}")
+    print(f"  Disk: {backup_info['disk_bytes'] / 1024 ** 2:.1f}MB ({backup_info['disk_format']}) "
+          f"in {backup_info['duration_s']}s, {backup_info['bytes_written'] / 1024 ** 2:.1f}MB written "
+          f"({backup_info['engine']} engine)")
+    if skipped:
+        print(f"  Trim: {skipped / 1024 ** 2:.1f}MB of freed guest blocks skipped")
+    if was_running:
+        print(f"  VM '{name}' remained running during backup")
+
+    # Upload to S3 if configured
+    cfg = load_config()
+    s3_config = cfg.get("s3", {})
+    if upload and s3_config.get("enabled"):
+        if s3_config.get("queue_uploads"):
+            enqueue_upload(backup_name)
+            print("  Queued for upload to S3 (uploaded by 'nox daemon')")
+        else:
+            upload_to_s3(backup_path, backup_name, s3_config)
+
+    return backup_info
+
+def compare_backup_engines(name, codec=None):
+    """Take a throwaway backup with each engine and print time and bytes written."""
+    if vm_state(name) != "running":
+        raise RuntimeError("engine comparison needs a running VM")
+    results = []
+    for engine in BACKUP_ENGINES:
+        print(f"\n=== {engine} engine ===")
+        info = backup_vm(name, codec=codec, upload=False, engine=engine)
+        shutil.rmtree(os.path.join(BACKUPS_DIR, info["backup_name"]), ignore_errors=True)
+        results.append(info)
+        time.sleep(1)  # backup names have one-second resolution
+
+    mb = 1024 ** 2
+    print(f"\n{'ENGINE':<10} {'TIME':>8} {'BACKUP':>11} {'COMMITTED':>11} {'WRITTEN':>11}")
+    print("-" * 55)
+    for info in results:
+        print(f"{info['engine']:<10} {info['duration_s']:>7}s {info['disk_bytes'] / mb:>9.1f}MB "
+              f"{info.get('commit_bytes', 0) / mb:>9.1f}MB {info['bytes_written'] / mb:>9.1f}MB")
+    print("\nComparison backups were removed.")
+
+def vm_labels(name):
+    """Return a VM's labels, including the implicit fleet=<name> of fleet VMs."""
+    meta = load_meta(name) or {}
+    labels = label_strings(meta.get("labels") or {})
+    if meta.get("fleet"):
+        labels.setdefault("fleet", meta["fleet"])
+    return labels
+
+def label_strings(labels):
+    """Labels with string values, the way --label writes and matches them (tier: 1 -> "1")."""
+    return {str(k): v if isinstance(v, str) else "" if v is None else json.dumps(v) for k, v in labels.items()}
+
+def parse_labels(specs):
+    """Parse KEY=VALUE (or bare KEY) label arguments into a dict; None matches any value."""
+    labels = {}
+    for spec in specs or []:
+        key, sep, value = spec.partition("=")
+        labels[key] = value if sep else None
+    return labels
+
+def select_vms(labels=None):
+    """Names of the VMs carrying all of labels (every VM if labels is empty), minus pool VMs."""
+    names = []
+    for name in sorted(backend().list_names()):
+        if (load_meta(name) or {}).get("pool"):
+            continue
+        have = vm_labels(name)
+        if all(key in have and (value is None or have[key] == value) for key, value in (labels or {}).items()):
+            names.append(name)
+    return names
+
+def backup_priority(name, settings):
+    """A VM's backup priority (higher goes first) from backup.priorities glob patterns."""
+    import fnmatch
+    return max([int(prio) for pattern, prio in settings.get("priorities", {}).items()
+                if fnmatch.fnmatchcase(name, pattern)] or [0])
+
+def backup_many(names, workers=None, jitter=None, bandwidth_mb=None, iops=None, **backup_args):
+    """Back up several VMs with a worker pool and a shared I/O budget.
+
+    VMs start in priority order (backup.priorities), each after a random
+    delay of up to `jitter` seconds; all workers draw from one IOBudget of
+    bandwidth_mb MB/s and iops requests/s. Returns one result dict per VM.
+    """
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    settings = backup_settings()
+    throttle = throttle_settings()
+    workers = max(1, min(len(names), int(workers or settings.get("workers", 2))))
+    jitter = float(settings.get("jitter_s", 0) if jitter is None else jitter)
+    bandwidth_mb = throttle["backup_mb"] if bandwidth_mb is None else bandwidth_mb
+    iops = throttle["iops"] if iops is None else iops
+    IO_BUDGET.configure(bandwidth_mb, iops, shares=workers)
+    threads = max(1, int(settings["threads"]) // workers)
+    queue = sorted(names, key=lambda n: (-backup_priority(n, settings), n))
+    print(f"Backing up {len(queue)} VMs with {workers} workers"
+          f"{f', {bandwidth_mb}MB/s' if bandwidth_mb else ''}{f', {iops} IOPS' if iops else ''}"
+          f"{f', up to {jitter:g}s jitter' if jitter else ''}...")
+    queued = time.time()
+
+    def run_one(name):
+        delay = random.uniform(0, jitter) if jitter else 0
+        time.sleep(delay)
+        result = {"vm": name, "priority": backup_priority(name, settings), "wait_s": time.time() - queued}
+        started = time.time()
+        try:
+            info = backup_vm(name, threads=threads, **backup_args)
+            result.update(ok=True, backup=info["backup_name"], type=info["type"], bytes=info["disk_bytes"])
+        except Exception as e:
+            result.update(ok=False, error=str(e), bytes=0)
+        result["duration_s"] = time.time() - started
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(run_one, queue))
+    finally:
+        IO_BUDGET.configure()
+
+def print_backup_summary(results):
+    mb = 1024 ** 2
+    print(f"\n{'VM':<24} {'STATUS':<7} {'PRIO':>4} {'WAIT':>7} {'TIME':>7} {'SIZE':>10} {'MB/S':>7}  DETAIL")
+    print("-" * 100)
+    for r in results:
+        rate = r["bytes"] / mb / max(r["duration_s"], 1e-6)
+        detail = f"{r['backup']} ({r['type']})" if r["ok"] else r["error"].splitlines()[0][:60]
+        print(f"{r['vm']:<24} {'ok' if r['ok'] else 'FAILED':<7} {r['priority']:>4} {r['wait_s']:>6.1f}s "
+              f"{r['duration_s']:>6.1f}s {r['bytes'] / mb:>8.1f}MB {rate:>7.1f}  {detail}")
+    total = sum(r["bytes"] for r in results)
+    elapsed = max(r["wait_s"] + r["duration_s"] for r in results) if results else 0
+    print(f"\n{sum(r['ok'] for r in results)}/{len(results)} backups succeeded, {total / mb:.1f}MB "
+          f"in {elapsed:.1f}s")
+
+def cmd_backup(args):
+    """Backup a VM using live snapshot (no downtime)."""
+    mode = "incremental" if args.incremental else "differential" if args.differential else "full"
+    engine = "pull" if args.pull else args.engine
+    if args.all or args.label:
+        if args.name or args.compare:
+            print("Give either a VM name or --all/--label, not both.", file=sys.stderr)
+            sys.exit(1)
+        names = select_vms(parse_labels(args.label))
+        if not names:
+            print("No VMs match.", file=sys.stderr)
+            sys.exit(1)
+        results = backup_many(names, workers=args.workers, jitter=args.jitter, bandwidth_mb=args.bandwidth,
+                              iops=args.iops, codec=args.codec, mode=mode, engine=engine,
+                              readers=args.readers, thin=True if args.thin else None,
+                              commit_bandwidth=args.commit_bandwidth, quiesce=args.quiesce or None,
+                              pre_hook=args.pre_hook, post_hook=args.post_hook, trim=args.trim or None)
+        print_backup_summary(results)
+        if not all(r["ok"] for r in results):
+            sys.exit(1)
+        return
+
+    if not args.name:
+        print("Give a VM name, --all or --label.", file=sys.stderr)
+        sys.exit(1)
+    if not vm_exists(args.name):
+        print(f"VM '{args.name}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        if args.compare:
+            compare_backup_engines(args.name, args.codec)
+            return
+        throttle = throttle_settings()
+        IO_BUDGET.configure(throttle["backup_mb"] if args.bandwidth is None else args.bandwidth,
+                            throttle["iops"] if args.iops is None else args.iops)
+        backup_vm(args.name, codec=args.codec, mode=mode, engine=engine, readers=args.readers,
+                  thin=True if args.thin else None, commit_bandwidth=args.commit_bandwidth,
+                  quiesce=args.quiesce or None, pre_hook=args.pre_hook, post_hook=args.post_hook,
+                  trim=args.trim or None)
+    except Exception as e:
+        print(f"Error creating backup: {e}", file=sys.stderr)
         sys.exit(1)
 
+def instant_restore_source(backup_path, info):
+    """Return the backup disk an instant restore can run on, or None.
+
+    Only standalone qcow2 backups can back a live overlay; compressed
+    streams (zstd, dedup) and incremental chains need a full restore.
+    """
+    if info.get("disk_format", "qcow2") != "qcow2" or info.get("base") or \
+            info.get("type") in ("incremental", "differential"):
+        return None
+    return os.path.join(backup_path, info.get("disk_file") or f"{info['vm_name']}.qcow2")
+
+def watch_block_job(name, disk="vda", label="Streaming"):
+    """Print a block job's progress until it finishes."""
+    started = time.time()
+    while True:
+        info = backend().block_job_info(name, disk)
+        if not info:
+            break
+        pct = 100 * info["cur"] / info["end"] if info["end"] else 0
+        rate = info["cur"] / 1024 ** 2 / max(time.time() - started, 1e-6)
+        print(f"\r  {label}: {pct:5.1f}% ({info['cur'] / 1024 ** 3:.2f}/{info['end'] / 1024 ** 3:.2f}GB, "
+              f"{rate:.0f}MB/s)", end="", flush=True)
+        time.sleep(1)
+    print(f"\r  {label}: done in {time.time() - started:.0f}s" + " " * 30)
+
 def cmd_restore(args):
     """Restore a VM from backup with interactive selection."""
     cfg = load_config()
@@ -1174,31 +5388,14 @@ def cmd_restore(args):
     
     # If no backup name provided, show interactive selection
     if not args.backup_name:
-        # Collect local backups
-        local_backups = []
-        if os.path.exists(BACKUPS_DIR):
-            for backup_name in os.listdir(BACKUPS_DIR):
-                backup_path = os.path.join(BACKUPS_DIR, backup_name)
-                if not os.path.isdir(backup_path):
-                    continue
-                
-                info_path = os.path.join(backup_path, "backup_info.json")
-                if os.path.exists(info_path):
-                    with open(info_path) as f:
-                        info = json.load(f)
-                    local_backups.append({
-                        'name': backup_name,
-                        'date': info.get('timestamp', 'N/A'),
-                        'source': 'local'
-                    })
-        
-        # Collect S3 backups if enabled
-        s3_backups = []
-        if s3_config.get("enabled"):
-            s3_backups = list_s3_backups(s3_config)
-        
-        # Combine all backups
-        all_backups = local_backups + s3_backups
+        # Local and S3 backups come from the catalog
+        if not catalog_initialized():
+            catalog_refresh(s3_config)
+        all_backups = [{
+            'name': backup['name'],
+            'date': format_backup_timestamp(backup['timestamp']),
+            'source': 'local' if backup['local'] else 's3'
+        } for backup in catalog_backups()]
         
         if not all_backups:
             print("No backups available.")
@@ -1213,17 +5410,27 @@ def cmd_restore(args):
         
         backup_name = selected['name']
         
-        # Download from S3 if needed
-        if selected.get('source') == 's3':
-            backup_path = os.path.join(BACKUPS_DIR, backup_name)
-            if not os.path.exists(backup_path):
-                if not download_from_s3(backup_name, s3_config):
-                    sys.exit(1)
     else:
         backup_name = args.backup_name
     
     backup_path = os.path.join(BACKUPS_DIR, backup_name)
-    
+
+    # Backups only in S3 are streamed straight into the new disk when possible
+    stream = None
+    if not os.path.exists(backup_path) and s3_config.get("enabled"):
+        try:
+            stream = S3BackupStream(backup_name, s3_config)
+        except Exception as e:
+            print(f"Error: S3 download failed: {e}", file=sys.stderr)
+            sys.exit(1)
+        if stream.streamable:
+            backup_path = stream.backup_path
+        else:
+            stream.close()
+            stream = None
+            if not download_from_s3(backup_name, s3_config):
+                sys.exit(1)
+
     if not os.path.exists(backup_path):
         print(f"Backup '{backup_name}' does not exist.", file=sys.stderr)
         sys.exit(1)
@@ -1237,6 +5444,24 @@ def cmd_restore(args):
     with open(info_path) as f:
         backup_info = json.load(f)
 
+    instant_src = None
+    if args.instant:
+        if args.no_start:
+            print("--instant starts the VM right away; drop --no-start.", file=sys.stderr)
+            sys.exit(1)
+        instant_src = None if stream else instant_restore_source(backup_path, backup_info)
+        if not instant_src:
+            print("Note: this backup can't back a live disk (S3-only, compressed stream or "
+                  "incremental chain); doing a full restore.")
+
+    # Incremental/differential backups need every earlier link of their chain
+    for member in backup_info.get("chain", [])[:-1]:
+        if load_backup_info(member):
+            continue
+        if not s3_config.get("enabled") or not download_from_s3(member, s3_config):
+            print(f"Backup chain is incomplete: '{member}' is missing.", file=sys.stderr)
+            sys.exit(1)
+
     original_name = backup_info["vm_name"]
     restore_name = args.name if args.name else original_name
 
@@ -1247,14 +5472,16 @@ def cmd_restore(args):
             sys.exit(1)
         
         print(f"Deleting existing VM '{restore_name}'...")
-        state = vm_state(restore_name)
-        if state == "running":
-            virsh(f"destroy {restore_name}")
-        cleanup_macvtap(restore_name)
-        virsh(f"undefine {restore_name} --nvram --remove-all-storage", check=False)
+        # Also drops its cached IPs: the restored VM may come back with other MACs
+        delete_vm(restore_name)
 
     print(f"Restoring VM '{restore_name}' from backup '{backup_name}'...")
 
+    # Writes of a restore compete with the other VMs on the same disk
+    restore_mb = throttle_settings(cfg)["restore_mb"] if args.bandwidth is None else args.bandwidth
+    if not instant_src:
+        IO_BUDGET.configure(restore_mb)
+
     # Create VM directory
     vm_path = vm_dir(restore_name)
     os.makedirs(vm_path, exist_ok=True)
@@ -1262,9 +5489,14 @@ def cmd_restore(args):
     try:
         # Restore disk image
         print("Restoring disk image...")
-        backup_disk = os.path.join(backup_path, f"{original_name}.qcow2")
         restore_disk = os.path.join(vm_path, f"{restore_name}.qcow2")
-        run(f"qemu-img convert -O qcow2 {backup_disk} {restore_disk}")
+        if stream:
+            stream.restore_disk(restore_disk)
+        elif instant_src:
+            # Thin overlay on the backup; its data is pulled in once the VM runs
+            run(f"qemu-img create -q -f qcow2 -F qcow2 -b {shlex.quote(instant_src)} {restore_disk}")
+        else:
+            import_disk(backup_path, backup_info, restore_disk)
 
         # Restore metadata
         backup_meta = os.path.join(backup_path, "meta.json")
@@ -1280,6 +5512,9 @@ def cmd_restore(args):
             if os.path.exists(src):
                 dst = os.path.join(vm_path, filename)
                 shutil.copy2(src, dst)
+        if not os.path.exists(os.path.join(vm_path, "cloud-init.iso")) and \
+                os.path.exists(os.path.join(vm_path, "user-data")):
+            write_seed_iso(vm_path)
 
         # Restore VM from XML
         xml_path = os.path.join(backup_path, "domain.xml")
@@ -1292,21 +5527,24 @@ def cmd_restore(args):
             xml_content = xml_content.replace(f"<name>{original_name}</name>", f"<name>{restore_name}</name>")
             xml_content = xml_content.replace(f"{original_name}.qcow2", f"{restore_name}.qcow2")
             
-            # Write modified XML to temp file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.xml', delete=False) as tmp:
-                tmp.write(xml_content)
-                tmp_xml = tmp.name
-            
-            try:
-                virsh(f"define {tmp_xml}")
-            finally:
-                os.unlink(tmp_xml)
+            backend().define(xml_content)
 
         print(f"✓ VM '{restore_name}' restored successfully!")
-        
-        if backup_info.get("was_running") and not args.no_start:
+        catalog_mark_restored(backup_name)
+
+        if instant_src:
+            print(f"Starting VM '{restore_name}' on the backup image...")
+            backend().start(restore_name)
+            bandwidth = restore_mb
+            backend().block_pull(restore_name, "vda", bandwidth)
+            print(f"Copying remaining data into the VM disk in the background"
+                  f"{f' (capped at {bandwidth}MB/s)' if bandwidth else ''}.")
+            print(f"Keep backup '{backup_name}' until 'nox status {restore_name}' no longer shows a pull.")
+            if args.wait:
+                watch_block_job(restore_name, "vda", "Pulling")
+        elif backup_info.get("was_running") and not args.no_start:
             print(f"Starting VM '{restore_name}'...")
-            virsh(f"start {restore_name}")
+            backend().start(restore_name)
         else:
             print(f"VM '{restore_name}' is ready. Use 'nox start {restore_name}' to start it.")
 
@@ -1314,88 +5552,87 @@ def cmd_restore(args):
         print(f"Error restoring backup: {e}", file=sys.stderr)
         shutil.rmtree(vm_path, ignore_errors=True)
         sys.exit(1)
+    finally:
+        if stream:
+            stream.close()
+
+def format_backup_timestamp(timestamp):
+    try:
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(timestamp, "%Y%m%d_%H%M%S"))
+    except (TypeError, ValueError):
+        return timestamp or "?"
 
 def cmd_list_backups(args):
-    """List all backups from local and S3."""
-    cfg = load_config()
-    s3_config = cfg.get("s3", {})
-    
-    # Collect local backups
-    local_backups = []
-    if os.path.exists(BACKUPS_DIR):
-        for backup_name in os.listdir(BACKUPS_DIR):
-            backup_path = os.path.join(BACKUPS_DIR, backup_name)
-            if not os.path.isdir(backup_path):
-                continue
+    """List all backups (local and S3) from the catalog."""
+    s3_config = load_config().get("s3", {})
+    if args.refresh or not catalog_initialized():
+        if s3_config.get("enabled"):
+            print("Refreshing catalog (local + S3)...")
+        catalog_refresh(s3_config)
 
-            info_path = os.path.join(backup_path, "backup_info.json")
-            if os.path.exists(info_path):
-                with open(info_path) as f:
-                    info = json.load(f)
-                
-                # Calculate backup size
-                total_size = 0
-                for root, dirs, files in os.walk(backup_path):
-                    for f in files:
-                        fp = os.path.join(root, f)
-                        if os.path.exists(fp):
-                            total_size += os.path.getsize(fp)
-                
-                size_gb = total_size / (1024 ** 3)
-                
-                local_backups.append({
-                    'name': backup_name,
-                    'vm_name': info.get("vm_name", "?"),
-                    'timestamp': info.get("timestamp", "?"),
-                    'size': f"{size_gb:.2f}GB",
-                    'source': 'Local'
-                })
-    
-    # Collect S3 backups if enabled
-    s3_backups = []
-    if s3_config.get("enabled"):
-        print("Fetching S3 backups...")
-        s3_list = list_s3_backups(s3_config)
-        for backup in s3_list:
-            # Parse VM name from backup name (format: vmname_timestamp)
-            parts = backup['name'].rsplit('_', 2)
-            vm_name = parts[0] if len(parts) >= 3 else "?"
-            
-            s3_backups.append({
-                'name': backup['name'],
-                'vm_name': vm_name,
-                'timestamp': backup.get('date', '?'),
-                'size': backup.get('size', '?'),
-                'source': 'S3'
-            })
-    
-    all_backups = local_backups + s3_backups
-    
-    if not all_backups:
+    backups = catalog_backups()
+    if not backups:
         print("No backups found.")
         return
 
-    print(f"{'SOURCE':<8} {'BACKUP NAME':<40} {'VM NAME':<20} {'DATE':<20} {'SIZE'}")
-    print("-" * 105)
+    print(f"{'SOURCE':<9} {'BACKUP NAME':<40} {'VM NAME':<20} {'DATE':<20} {'TYPE':<13} {'SIZE'}")
+    print("-" * 120)
 
-    for backup in sorted(all_backups, key=lambda x: x.get("timestamp", ""), reverse=True):
-        source = backup['source']
-        name = backup['name']
-        vm_name = backup['vm_name']
-        timestamp = backup['timestamp']
-        size = backup['size']
-        
-        # Format timestamp if needed
-        if timestamp != "?" and len(timestamp) == 15:  # Format: YYYYMMDD_HHMMSS
-            try:
-                dt = time.strptime(timestamp, "%Y%m%d_%H%M%S")
-                date_str = time.strftime("%Y-%m-%d %H:%M:%S", dt)
-            except:
-                date_str = timestamp
+    gb = 1024 ** 3
+    for backup in backups:
+        source = "+".join(label for label, present in (("Local", backup["local"]), ("S3", backup["s3_key"]))
+                          if present)
+        if backup["disk_format"] == "chunks":
+            # The data lives in the shared repository; show its logical size
+            size = f"{json.loads(backup['info'] or '{}').get('data_bytes', 0) / gb:.2f}GB (dedup)"
         else:
-            date_str = timestamp
+            size_bytes = backup["size_bytes"] if backup["local"] else backup["s3_size"]
+            size = f"{size_bytes / gb:.2f}GB" if size_bytes is not None else "?"
+        print(f"{source:<9} {backup['name']:<40} {backup['vm_name'] or '?':<20} "
+              f"{format_backup_timestamp(backup['timestamp']):<20} {backup['type'] or '?':<13} {size}")
+
+    usage = repo_usage(refresh=args.refresh)
+    if usage["backups"]:
+        ratio = usage["data_bytes"] / usage["stored_bytes"] if usage["stored_bytes"] else 0
+        print(f"\nDedup repository: {usage['backups']} backups, {usage['logical_bytes'] / gb:.2f}GB logical "
+              f"({usage['data_bytes'] / gb:.2f}GB non-zero), {usage['stored_bytes'] / gb:.2f}GB stored "
+              f"in {usage['chunks']} chunks, dedup ratio {ratio:.1f}x")
+
+def cmd_prune(args):
+    """Delete backups that fall outside the retention policy."""
+    cfg = load_config()
+    s3_config = cfg.get("s3", {})
+    locations = ["local"] if args.local else ["s3"] if args.s3 else ["local", "s3"]
+    if not s3_config.get("enabled"):
+        if args.s3:
+            print("S3 is not enabled.", file=sys.stderr)
+            sys.exit(1)
+        locations = [location for location in locations if location != "s3"]
+    overrides = {"last": args.keep_last, "hourly": args.keep_hourly, "daily": args.keep_daily,
+                 "weekly": args.keep_weekly, "monthly": args.keep_monthly, "yearly": args.keep_yearly}
+    policies = {location: retention_policy(cfg, location, overrides) for location in locations}
+    for location, policy in policies.items():
+        if not any(policy.values()):
+            print(f"No retention policy for {location} backups: set \"retention\" in {CONFIG_FILE} "
+                  f"or pass --keep-* options.", file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        prune_backups(args.vms, policies, s3_config, dry_run=args.dry_run)
+    except Exception as e:
+        print(f"Error pruning backups: {e}", file=sys.stderr)
+        sys.exit(1)
 
-        print(f"{source:<8} {name:<40} {vm_name:<20} {date_str:<20} {size}")
+def cmd_daemon(args):
+    """Run scheduled backups and the S3 upload queue (or show their status)."""
+    if args.action == "status":
+        print_daemon_status()
+        return
+    try:
+        run_daemon(poll=args.poll)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
 
 def cmd_update(args):
     """Update nox to the latest version from GitHub."""
@@ -1458,6 +5695,50 @@ def main():
     p.add_argument("--network", type=str, default=None, help="Libvirt network to use (if not specified, interactive selection)")
     p.add_argument("--no-autostart", action="store_true", help="Disable autostart on boot")
     p.add_argument("--no-start", action="store_true", help="Create but don't start VM")
+    p.add_argument("--no-pool", action="store_true", help="Don't claim a pre-booted VM from the warm pool")
+    p.add_argument("--label", action="append", metavar="KEY=VALUE", help="Label the VM (repeatable)")
+
+    # apply
+    p = sub.add_parser("apply", help="Create/resize/delete VMs to match a fleet manifest")
+    p.add_argument("manifest", help="Fleet manifest (.json, or .yaml with PyYAML)")
+    p.add_argument("--workers", type=int, default=None, help="Parallel workers (default: manifest 'workers' or 4)")
+    p.add_argument("--prune", action="store_true", help="Delete fleet VMs no longer in the manifest")
+    p.add_argument("--wait", action="store_true", help="Wait for created VMs to get IP addresses")
+    p.add_argument("--dry-run", action="store_true", help="Show the plan without changing anything")
+
+    # template / templates / clone
+    p = sub.add_parser("template", help="Seal a VM and save it as a template")
+    p.add_argument("name")
+    p.add_argument("--as", dest="template_name", default=None, help="Template name (default: VM name)")
+
+    p = sub.add_parser("templates", help="List templates")
+    p.add_argument("--rm", default=None, metavar="TEMPLATE", help="Remove an unused template")
+
+    p = sub.add_parser("clone", help="Create a VM as a linked clone of a template")
+    p.add_argument("template")
+    p.add_argument("name")
+    p.add_argument("--cpus", type=float, default=None)
+    p.add_argument("--ram", type=float, default=None)
+    p.add_argument("--disk", type=float, default=None)
+    p.add_argument("--network", type=str, default=None, help="Libvirt network or physical interface (default: nox-net)")
+    p.add_argument("--no-autostart", action="store_true", help="Disable autostart on boot")
+    p.add_argument("--no-start", action="store_true", help="Create but don't start VM")
+
+    # pool
+    p = sub.add_parser("pool", help="Manage the warm pool of pre-booted VMs")
+    p.add_argument("action", nargs="?", choices=["status", "fill", "drain"], default="status")
+    p.add_argument("profile", nargs="?", default=None)
+
+    # seed-server
+    p = sub.add_parser("seed-server", help="Serve cloud-init data over HTTP (seed mode 'net')")
+    p.add_argument("--listen", default=None,
+                   help="Address to listen on (default: the host's address in the seed network)")
+    p.add_argument("--port", type=int, default=SEED_PORT)
+
+    # images
+    p = sub.add_parser("images", help="List cached OS images")
+    p.add_argument("--pull", nargs="?", const="all", default=None, metavar="OS",
+                   help="Check upstream and download newer images (default: all)")
 
     # start
     p = sub.add_parser("start", help="Start a VM")
@@ -1476,7 +5757,8 @@ def main():
     p.add_argument("name")
 
     # list
-    sub.add_parser("list", aliases=["ls"], help="List all VMs")
+    p = sub.add_parser("list", aliases=["ls"], help="List all VMs")
+    p.add_argument("--json", action="store_true", help="Print machine-readable JSON")
 
     # status
     p = sub.add_parser("status", help="Show VM details")
@@ -1499,8 +5781,43 @@ def main():
     p.add_argument("--disk", type=float, default=None, help="New disk size in GB (can only expand)")
 
     # backup
-    p = sub.add_parser("backup", help="Backup a VM")
-    p.add_argument("name")
+    p = sub.add_parser("backup", help="Backup a VM (or several with --all/--label)")
+    p.add_argument("name", nargs="?", default=None)
+    p.add_argument("--all", action="store_true", help="Back up every VM")
+    p.add_argument("--label", action="append", metavar="KEY[=VALUE]",
+                   help="Back up VMs with this label (repeatable; fleet=NAME selects a fleet)")
+    p.add_argument("--workers", type=int, default=None, help="Concurrent backups (default 2)")
+    p.add_argument("--jitter", type=float, default=None, metavar="SECONDS",
+                   help="Delay each backup's start by a random 0..SECONDS")
+    p.add_argument("--bandwidth", type=float, default=None, metavar="MB/S",
+                   help="Disk read budget, shared by all concurrent backups (default throttle.backup_mb)")
+    p.add_argument("--iops", type=int, default=None, help="Read request budget shared by all concurrent backups")
+    p.add_argument("--commit-bandwidth", type=int, default=None, metavar="MB/S",
+                   help="Cap merging the snapshot back into the live disk (default throttle.blockjob_mb)")
+    p.add_argument("--trim", action="store_true",
+                   help="Discard free space in the guest (fstrim via the guest agent) before the backup")
+    p.add_argument("--quiesce", action="store_true",
+                   help="Freeze guest filesystems via the guest agent while the backup point is taken")
+    p.add_argument("--pre-hook", default=None, metavar="CMD",
+                   help="Run CMD in the guest before freezing (implies --quiesce)")
+    p.add_argument("--post-hook", default=None, metavar="CMD",
+                   help="Run CMD in the guest after thawing (implies --quiesce)")
+    p.add_argument("--codec", default=None,
+                   help="zstd[:LEVEL] (default, multi-threaded), zlib (compressed qcow2), none, "
+                        "or dedup[:LEVEL] (shared chunk repository)")
+    g = p.add_mutually_exclusive_group()
+    g.add_argument("--incremental", action="store_true", help="Only blocks changed since the last backup")
+    g.add_argument("--differential", action="store_true", help="Only blocks changed since the last full backup")
+    p.add_argument("--engine", choices=BACKUP_ENGINES, default=None,
+                   help="Live backup method: snapshot overlay + commit, push backup job, "
+                        "or pull NBD export (default from config)")
+    p.add_argument("--pull", action="store_true", help="Shorthand for --engine pull")
+    p.add_argument("--thin", action="store_true",
+                   help="Back up only the disk overlay plus a hash reference to its base image")
+    p.add_argument("--readers", type=int, default=None,
+                   help="Concurrent NBD readers feeding the compressor (default 4)")
+    g.add_argument("--compare", action="store_true",
+                   help="Back up once with each engine and compare time and bytes written")
 
     # restore
     p = sub.add_parser("restore", help="Restore a VM from backup (interactive if no backup specified)")
@@ -1508,9 +5825,33 @@ def main():
     p.add_argument("--name", default=None, help="New name for restored VM (default: original name)")
     p.add_argument("--force", action="store_true", help="Overwrite existing VM")
     p.add_argument("--no-start", action="store_true", help="Don't start VM after restore")
+    p.add_argument("--instant", action="store_true",
+                   help="Start the VM on the backup image at once and copy its data in the background")
+    p.add_argument("--bandwidth", type=int, default=None, metavar="MB/S",
+                   help="Cap restore disk writes, or the --instant background copy (default throttle.restore_mb)")
+    p.add_argument("--wait", action="store_true", help="Show progress until the background copy finishes")
 
     # backups
-    sub.add_parser("backups", help="List all backups")
+    p = sub.add_parser("backups", help="List all backups")
+    p.add_argument("--refresh", action="store_true", help="Rescan local backups and S3 to reconcile the catalog")
+
+    # prune
+    p = sub.add_parser("prune", help="Delete backups outside the retention policy")
+    p.add_argument("vms", nargs="*", help="VMs to prune (default: all)")
+    p.add_argument("--keep-last", type=int, metavar="N", help="Keep the newest N backups")
+    for period, unit in (("hourly", "hours"), ("daily", "days"), ("weekly", "weeks"),
+                         ("monthly", "months"), ("yearly", "years")):
+        p.add_argument(f"--keep-{period}", type=int, metavar="N",
+                       help=f"Keep the newest backup of each of the last N {unit}")
+    p.add_argument("--dry-run", action="store_true", help="Show what would be deleted without deleting")
+    where = p.add_mutually_exclusive_group()
+    where.add_argument("--local", action="store_true", help="Only prune local backups")
+    where.add_argument("--s3", action="store_true", help="Only prune backups in S3")
+
+    # daemon
+    p = sub.add_parser("daemon", help="Run scheduled backups and queued S3 uploads")
+    p.add_argument("action", nargs="?", choices=["run", "status"], default="run")
+    p.add_argument("--poll", type=float, default=30, help="Seconds between schedule checks (default 30)")
 
     # update
     sub.add_parser("update", aliases=["up"], help="Update nox")
@@ -1523,6 +5864,13 @@ def main():
 
     commands = {
         "create": cmd_create,
+        "apply": cmd_apply,
+        "images": cmd_images,
+        "pool": cmd_pool,
+        "seed-server": cmd_seed_server,
+        "template": cmd_template,
+        "templates": cmd_templates,
+        "clone": cmd_clone,
         "start": cmd_start,
         "stop": cmd_stop,
         "restart": cmd_restart,
@@ -1537,6 +5885,8 @@ def main():
         "backup": cmd_backup,
         "restore": cmd_restore,
         "backups": cmd_list_backups,
+        "prune": cmd_prune,
+        "daemon": cmd_daemon,
         "update": cmd_update,
         "up": cmd_update,
     }
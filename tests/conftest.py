@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# nox derives ~/.nox paths at import time; keep tests away from the real one
+os.environ["HOME"] = tempfile.mkdtemp(prefix="nox-test-home-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+"""Backup stream codecs: compress into a sink and read back."""
+
+import gzip
+import importlib.util
+import io
+import os
+import shutil
+import sys
+
+import pytest
+
+import nox
+
+DATA = os.urandom(300 * 1024) + bytes(2 * 1024 * 1024) + b"nox " * 50000
+
+HAVE_ZSTD_MODULE = importlib.util.find_spec("zstandard") is not None
+HAVE_ZSTD_BINARY = shutil.which("zstd") is not None
+
+
+def round_trip(codec, level=None, threads=1):
+    sink = io.BytesIO()
+    writer = nox.open_compressor(sink, codec, level, threads)
+    for offset in range(0, len(DATA), 100000):
+        writer.write(DATA[offset:offset + 100000])
+    writer.close()
+    compressed = sink.getvalue()
+    return compressed, nox.open_decompressor(io.BytesIO(compressed), codec).read()
+
+
+@pytest.mark.parametrize("spec, parsed", [
+    (None, ("zstd", None)), ("zstd", ("zstd", None)), ("zstd:19", ("zstd", 19)),
+    ("zlib:1", ("zlib", 1)), ("none", ("none", None)), ("dedup:5", ("dedup", 5)),
+])
+def test_parse_codec(spec, parsed):
+    assert nox.parse_codec(spec) == parsed
+
+
+def test_unknown_codec_is_refused():
+    with pytest.raises(RuntimeError, match="Unknown codec 'lzma'"):
+        nox.parse_codec("lzma:9")
+
+
+def test_none_passes_data_through():
+    compressed, restored = round_trip("none")
+    assert compressed == DATA and restored == DATA
+
+
+def test_zlib_writes_gzip():
+    compressed, restored = round_trip("zlib", 1)
+    assert restored == DATA
+    assert gzip.decompress(compressed) == DATA
+    assert len(compressed) < len(DATA) // 2
+
+
+@pytest.mark.skipif(not HAVE_ZSTD_MODULE, reason="python3-zstandard not installed")
+def test_zstd_module():
+    compressed, restored = round_trip("zstd", 3, threads=2)
+    assert restored == DATA
+    assert compressed[:4] == b"\x28\xb5\x2f\xfd"
+
+
+@pytest.mark.skipif(not HAVE_ZSTD_BINARY, reason="zstd binary not installed")
+def test_zstd_binary_fallback(monkeypatch):
+    monkeypatch.setitem(sys.modules, "zstandard", None)  # import raises ImportError
+    compressed, restored = round_trip("zstd", 3, threads=2)
+    assert restored == DATA
+    assert compressed[:4] == b"\x28\xb5\x2f\xfd"
+    assert len(compressed) < len(DATA) // 2
+
+
+def test_zstd_without_module_or_binary_fails(monkeypatch):
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    monkeypatch.setattr(nox.shutil, "which", lambda name: None)
+    with pytest.raises(RuntimeError, match="zstd codec needs"):
+        nox.open_compressor(io.BytesIO(), "zstd")
+    with pytest.raises(RuntimeError, match="zstd codec needs"):
+        nox.open_decompressor(io.BytesIO(), "zstd")
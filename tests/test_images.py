@@ -0,0 +1,154 @@
+"""Resumable image downloads and SHA512SUMS checks against a local HTTP server."""
+
+import hashlib
+import http.server
+import json
+import os
+import re
+import threading
+
+import pytest
+
+import nox
+
+IMAGE = os.urandom(3 * 1024 * 1024 + 12345)
+SHA512 = hashlib.sha512(IMAGE).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves /image.qcow2 with Range support and /SHA512SUMS from the server's files dict."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        status, start = 200, 0
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match[1]), min(int(match[2]), len(body) - 1)
+            body, status = body[start:end + 1], 206
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(self.server.files[self.path])}")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+            self.server.served += len(body)
+
+
+@pytest.fixture
+def server():
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    srv.files = {"/image.qcow2": IMAGE, "/SHA512SUMS": f"{SHA512}  image.qcow2\n".encode()}
+    srv.served = 0
+    srv.url = f"http://127.0.0.1:{srv.server_address[1]}"
+    thread = threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def images(tmp_path, monkeypatch, server):
+    images_dir = tmp_path / "images"
+    monkeypatch.setattr(nox, "IMAGES_DIR", str(images_dir))
+    monkeypatch.setattr(nox, "IMAGE_STORE_DIR", str(images_dir / "sha512"))
+    monkeypatch.setattr(nox, "IMAGE_INDEX_FILE", str(images_dir / "index.json"))
+    config = {"images": {"testos": {"url_amd64": f"{server.url}/image.qcow2", "sums": f"{server.url}/SHA512SUMS"}}}
+    monkeypatch.setattr(nox, "load_config", lambda: config)
+    os.makedirs(images_dir)
+    return images_dir
+
+
+def test_parallel_download(tmp_path, server):
+    dest = str(tmp_path / "image.qcow2")
+    nox.download_file(f"{server.url}/image.qcow2", dest, connections=4)
+    with open(dest, "rb") as f:
+        assert f.read() == IMAGE
+    assert server.served == len(IMAGE)
+    assert sorted(os.listdir(tmp_path)) == ["image.qcow2"]
+
+
+def test_resumes_from_part_files(tmp_path, server):
+    dest = str(tmp_path / "image.qcow2")
+    url = f"{server.url}/image.qcow2"
+    half = len(IMAGE) // 2
+    # First range fully done, second one a third of the way through
+    ranges = [[0, half - 1, half], [half, len(IMAGE) - 1, 1000]]
+    with open(dest + ".part", "wb") as f:
+        f.write(IMAGE[:half + 1000])
+        f.truncate(len(IMAGE))
+    with open(dest + ".part.json", "w") as f:
+        json.dump({"url": url, "size": len(IMAGE), "ranges": ranges}, f)
+
+    nox.download_file(url, dest, connections=2)
+    with open(dest, "rb") as f:
+        assert f.read() == IMAGE
+    assert server.served == len(IMAGE) - half - 1000
+    assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+
+def test_stale_progress_for_another_file_is_ignored(tmp_path, server):
+    dest = str(tmp_path / "image.qcow2")
+    with open(dest + ".part", "wb") as f:
+        f.write(b"x" * 100)
+    with open(dest + ".part.json", "w") as f:
+        json.dump({"url": "http://elsewhere/image", "size": 100, "ranges": [[0, 99, 100]]}, f)
+    nox.download_file(f"{server.url}/image.qcow2", dest)
+    with open(dest, "rb") as f:
+        assert f.read() == IMAGE
+
+
+def test_verified_image_is_stored_by_hash(images):
+    path = nox.ensure_base_image("testos", "amd64")
+    assert path == os.path.join(nox.IMAGE_STORE_DIR, f"{SHA512}.qcow2")
+    with open(path, "rb") as f:
+        assert f.read() == IMAGE
+    with open(nox.IMAGE_INDEX_FILE) as f:
+        assert json.load(f)["testos-amd64"]["sha512"] == SHA512
+    # Cached from now on
+    assert nox.ensure_base_image("testos", "amd64") == path
+
+
+def test_checksum_mismatch_is_refused(images, server):
+    server.files["/SHA512SUMS"] = f"{'0' * 128}  image.qcow2\n".encode()
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        nox.ensure_base_image("testos", "amd64")
+    assert os.listdir(nox.IMAGE_STORE_DIR) == []
+    assert not os.path.exists(nox.IMAGE_INDEX_FILE)
+
+
+def test_legacy_image_is_adopted_without_a_download(images, server):
+    with open(images / "testos-amd64.qcow2", "wb") as f:
+        f.write(IMAGE)
+    path = nox.ensure_base_image("testos", "amd64")
+    assert path == os.path.join(nox.IMAGE_STORE_DIR, f"{SHA512}.qcow2")
+    assert server.served < 1024
+
+
+def test_legacy_image_is_used_offline(images, server, capsys):
+    with open(images / "testos-amd64.qcow2", "wb") as f:
+        f.write(IMAGE)
+    del server.files["/SHA512SUMS"]
+    path = nox.ensure_base_image("testos", "amd64")
+    assert path == os.path.join(nox.IMAGE_STORE_DIR, f"{SHA512}.qcow2")
+    assert "unverified" in capsys.readouterr().err
+
+
+def test_offline_without_a_cached_image_fails(images, server):
+    del server.files["/SHA512SUMS"]
+    with pytest.raises(RuntimeError, match="SHA512SUMS"):
+        nox.ensure_base_image("testos", "amd64")
@@ -0,0 +1,124 @@
+"""NbdClient and read_extents against an in-process NBD server."""
+
+import os
+import socketserver
+import struct
+import threading
+
+import pytest
+
+import nox
+
+NBD_MAGIC, OPT_MAGIC, REPLY_MAGIC, SIMPLE_REPLY = 0x4e42444d41474943, 0x49484156454f5054, 0x3e889045565a9, 0x67446698
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """Fixed newstyle handshake with NBD_OPT_GO, then simple replies to read/write/flush."""
+
+    def recv(self, n):
+        data = b""
+        while len(data) < n:
+            block = self.request.recv(n - len(data))
+            if not block:
+                raise EOFError
+            data += block
+        return data
+
+    def reply(self, option, rtype, payload=b""):
+        self.request.sendall(struct.pack(">QIII", REPLY_MAGIC, option, rtype, len(payload)) + payload)
+
+    def handle(self):
+        disk = self.server.disk
+        self.request.sendall(struct.pack(">QQH", NBD_MAGIC, OPT_MAGIC, 3))
+        self.recv(4)
+        _magic, option, length = struct.unpack(">QII", self.recv(16))
+        data = self.recv(length)
+        export = data[4:4 + struct.unpack(">I", data[:4])[0]].decode()
+        if option != 7 or export != self.server.export:
+            self.reply(option, 0x80000006, b"no such export")
+            return
+        self.reply(option, 3, struct.pack(">HQH", 0, len(disk), 1))
+        self.reply(option, 1)
+        try:
+            while True:
+                _magic, _flags, cmd, handle, offset, length = struct.unpack(">IHHQQI", self.recv(28))
+                if cmd == nox.NbdClient.CMD_DISC:
+                    return
+                data = self.recv(length) if cmd == nox.NbdClient.CMD_WRITE else b""
+                if offset + length > len(disk):
+                    self.request.sendall(struct.pack(">IIQ", SIMPLE_REPLY, 22, handle))
+                    continue
+                if cmd == nox.NbdClient.CMD_WRITE:
+                    disk[offset:offset + length] = data
+                self.request.sendall(struct.pack(">IIQ", SIMPLE_REPLY, 0, handle))
+                if cmd == nox.NbdClient.CMD_READ:
+                    with self.server.lock:
+                        self.server.reads.append((offset, length))
+                    self.request.sendall(bytes(disk[offset:offset + length]))
+        except EOFError:
+            pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    srv = socketserver.ThreadingUnixStreamServer(str(tmp_path / "nbd.sock"), Handler)
+    srv.disk = bytearray(os.urandom(3 * 1024 * 1024))
+    srv.export, srv.reads, srv.lock = "disk", [], threading.Lock()
+    srv.socket_path = str(tmp_path / "nbd.sock")
+    srv.daemon_threads = True
+    thread = threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_read_write_flush(server):
+    client = nox.NbdClient(server.socket_path, "disk")
+    try:
+        assert client.size == len(server.disk)
+        assert client.read(4096, 8192) == bytes(server.disk[4096:12288])
+        client.write(100, b"hello")
+        client.flush()
+        assert client.read(98, 9) == bytes(server.disk[98:100]) + b"hello" + bytes(server.disk[105:107])
+    finally:
+        client.close()
+    assert server.disk[100:105] == b"hello"
+
+
+def test_unknown_export_is_refused(server):
+    with pytest.raises(RuntimeError, match="refused: no such export"):
+        nox.NbdClient(server.socket_path, "other")
+
+
+def test_failed_request_raises(server):
+    client = nox.NbdClient(server.socket_path, "disk")
+    try:
+        with pytest.raises(RuntimeError, match="error 22"):
+            client.read(len(server.disk) - 10, 20)
+    finally:
+        client.close()
+
+
+class Sink:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+
+@pytest.mark.parametrize("readers", [1, 4])
+def test_read_extents_reads_data_and_zero_fills_holes(server, monkeypatch, readers):
+    monkeypatch.setattr(nox, "NBD_CHUNK", 256 * 1024)
+    mib = 1024 * 1024
+    extents = [(0, mib + 5000, True), (mib + 5000, mib - 5000, False), (2 * mib, mib, True)]
+    sink = Sink()
+    nox.read_extents(server.socket_path, "disk", extents, sink, readers)
+
+    expected = bytearray(server.disk)
+    expected[mib + 5000:2 * mib] = bytes(mib - 5000)
+    assert sink.data == expected
+    # Holes are never read, and data is fetched in NBD_CHUNK pieces
+    assert sum(length for _offset, length in server.reads) == 2 * mib + 5000
+    assert max(length for _offset, length in server.reads) == 256 * 1024
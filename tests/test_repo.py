@@ -0,0 +1,123 @@
+"""Content-defined chunking round trips through the local repository."""
+
+import io
+import json
+import os
+import random
+
+import pytest
+
+import nox
+
+
+@pytest.fixture(autouse=True)
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(nox, "REPO_DIR", str(tmp_path / "repo"))
+
+
+def store(data, pieces=(1 << 20,)):
+    """Write data through a RepoWriter in pieces of the given sizes (cycled); return the manifest."""
+    writer = nox.RepoWriter()
+    offset, i = 0, 0
+    while offset < len(data):
+        size = pieces[i % len(pieces)]
+        writer.write(data[offset:offset + size])
+        offset += size
+        i += 1
+    return writer.close()
+
+
+def restore(manifest):
+    reader = nox.RepoReader(manifest, threads=2)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+def disk_like(seed, blocks):
+    """Random 4KiB blocks with zero runs, like a sparse disk image."""
+    rng = random.Random(seed)
+    out = bytearray()
+    for _ in range(blocks):
+        out += bytes(nox.CDC_BLOCK) if rng.random() < 0.2 else rng.randbytes(nox.CDC_BLOCK)
+    return bytes(out)
+
+
+def test_round_trip():
+    data = disk_like(1, 1024) + bytes(nox.CDC_MIN * 40) + disk_like(2, 256)
+    manifest = store(data)
+    assert restore(manifest) == data
+    assert sum(length for _digest, length in manifest["chunks"]) == len(data)
+    # The zero run is recorded without storing anything
+    assert any(digest is None for digest, _length in manifest["chunks"])
+
+
+def test_chunking_does_not_depend_on_write_sizes():
+    data = disk_like(3, 600)
+    assert store(data)["chunks"] == store(data, pieces=(4096, 65536, 12345))["chunks"]
+
+
+def test_chunks_repeat_after_a_block_shift():
+    data = disk_like(4, 1500)
+    first = store(data)
+    shifted = store(os.urandom(nox.CDC_BLOCK * 3) + data)
+    assert restore(shifted)[nox.CDC_BLOCK * 3:] == data
+    shared = {d for d, _ in first["chunks"]} & {d for d, _ in shifted["chunks"]}
+    assert len(shared) >= len(first["chunks"]) - 3
+    assert shifted["new_chunks"] <= 3
+
+
+def test_corrupt_chunk_is_detected():
+    manifest = store(disk_like(5, 64))
+    digest = next(d for d, _ in manifest["chunks"] if d)
+    with open(nox.chunk_path(digest), "wb") as f:
+        f.write(nox.pack_chunk(b"not the data"))
+    with pytest.raises(RuntimeError, match="corrupt"):
+        restore(manifest)
+
+
+class FakeS3:
+    """Just enough of S3Client for the chunk upload path, counting LIST requests."""
+
+    parallel = 2
+
+    def __init__(self):
+        self.objects, self.lists = {}, 0
+
+    def list(self, prefix):
+        self.lists += 1
+        return [{"key": key, "size": len(blob), "modified": "2000-01-01T00:00:00Z"}
+                for key, blob in sorted(self.objects.items()) if key.startswith(prefix)]
+
+    def get(self, key):
+        if key not in self.objects:
+            return None
+        resp = io.BytesIO(self.objects[key])
+        resp.headers = {"ETag": str(hash(self.objects[key]))}
+        return resp
+
+    def put(self, key, blob, headers=None):
+        self.objects[key] = blob
+
+
+def test_chunk_uploads_list_s3_once_per_gc_generation(capsys):
+    client = FakeS3()
+    first = store(disk_like(6, 256))
+    nox.upload_repo_chunks(first, client)
+    uploaded = {key for key in client.objects if key.startswith(nox.S3_REPO_PREFIX)}
+    assert len(uploaded) == len({d for d, _ in first["chunks"] if d})
+
+    second = store(disk_like(6, 256) + disk_like(7, 64))
+    nox.upload_repo_chunks(second, client)
+    nox.upload_repo_chunks(second, client)
+    assert client.lists == 1
+    assert "All chunks already in S3" in capsys.readouterr().out
+
+    # Another host's GC deleted a chunk: the record is rebuilt from a fresh listing
+    gone = sorted(uploaded)[0]
+    del client.objects[gone]
+    client.objects[nox.S3_REPO_GC] = json.dumps({"generation": 1}).encode()
+    nox.upload_repo_chunks(second, client)
+    assert client.lists == 2
+    assert gone in client.objects
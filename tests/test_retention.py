@@ -0,0 +1,72 @@
+"""Grandfather-father-son retention selection."""
+
+import nox
+
+
+def backup(timestamp, chain=None, vm="web"):
+    name = f"{vm}_{timestamp}"
+    return {"name": name, "timestamp": timestamp, "chain": [f"{vm}_{t}" for t in chain or []] + [name]}
+
+
+def newest_first(backups):
+    return sorted(backups, key=lambda b: b["timestamp"], reverse=True)
+
+
+def policy(**counts):
+    return dict(dict.fromkeys(nox.RETENTION_KEYS, 0), **counts)
+
+
+def test_keep_last():
+    backups = newest_first(backup(f"202610{d:02d}_120000") for d in range(1, 8))
+    assert set(nox.select_retained(backups, policy(last=3))) == {b["name"] for b in backups[:3]}
+
+
+def test_daily_keeps_the_newest_backup_of_each_day():
+    backups = newest_first(backup(f"202610{d:02d}_{h:02d}0000") for d in range(1, 6) for h in (1, 13, 22))
+    keep = nox.select_retained(backups, policy(daily=3))
+    assert sorted(keep) == ["web_20261003_220000", "web_20261004_220000", "web_20261005_220000"]
+    assert all(reasons == ["daily"] for reasons in keep.values())
+
+
+def test_periods_combine_and_record_every_reason():
+    # Sundays: 2026-09-27, 2026-10-04, 2026-10-11
+    backups = newest_first(backup(f"2026{md}_120000") for md in ("0927", "1003", "1004", "1010", "1011", "1012"))
+    keep = nox.select_retained(backups, policy(last=1, daily=2, weekly=3, monthly=2))
+    assert keep == {
+        "web_20261012_120000": ["last", "daily", "weekly", "monthly"],
+        "web_20261011_120000": ["daily", "weekly"],
+        "web_20261004_120000": ["weekly"],
+        "web_20260927_120000": ["monthly"],
+    }
+
+
+def test_kept_incremental_keeps_its_chain():
+    full = backup("20261001_120000")
+    inc1 = backup("20261002_120000", ["20261001_120000"])
+    inc2 = backup("20261003_120000", ["20261001_120000", "20261002_120000"])
+    newer_full = backup("20261004_120000")
+    keep = nox.select_retained(newest_first([full, inc1, inc2, newer_full]), policy(last=2))
+    assert keep == {
+        newer_full["name"]: ["last"],
+        inc2["name"]: ["last"],
+        inc1["name"]: [f"chain of {inc2['name']}"],
+        full["name"]: [f"chain of {inc2['name']}"],
+    }
+
+
+def test_chain_reason_is_recorded_once():
+    full = backup("20261001_120000")
+    incs = [backup(f"2026100{d}_120000", [f"2026100{x}_120000" for x in range(1, d)]) for d in range(2, 5)]
+    keep = nox.select_retained(newest_first([full] + incs), policy(last=3))
+    assert keep[full["name"]] == [f"chain of {incs[-1]['name']}"]
+
+
+def test_undated_backups_are_never_selected_by_period():
+    backups = [{"name": "web_old", "timestamp": None, "chain": ["web_old"]}, backup("20261001_120000")]
+    assert set(nox.select_retained(backups, policy(daily=5))) == {"web_20261001_120000"}
+
+
+def test_retention_policy_layers():
+    cfg = {"retention": {"daily": 7, "weekly": 4, "local": {"daily": 2}, "s3": {"monthly": 12}}}
+    assert nox.retention_policy(cfg, "local") == policy(daily=2, weekly=4)
+    assert nox.retention_policy(cfg, "s3", {"weekly": 1, "last": None}) == policy(daily=7, weekly=1, monthly=12)
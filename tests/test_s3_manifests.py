@@ -0,0 +1,150 @@
+"""Per-VM S3 manifests: conditional-PUT updates that survive concurrent writers."""
+
+import io
+import json
+
+import pytest
+
+import nox
+
+
+class FakeS3:
+    """In-memory bucket honouring If-Match / If-None-Match like S3 conditional writes.
+
+    before_put(key) runs ahead of each PUT, so a test can slip in a
+    concurrent writer between a read and the write that follows it.
+    """
+
+    bucket = "test"
+
+    def __init__(self):
+        self.objects, self.versions = {}, {}
+        self.before_put = lambda key: None
+
+    def get(self, key, byte_range=None):
+        if key not in self.objects:
+            return None
+        resp = io.BytesIO(self.objects[key])
+        resp.headers = {"ETag": f'"{self.versions[key]}"'}
+        return resp
+
+    def put(self, key, data, headers=None):
+        self.before_put(key)
+        headers = headers or {}
+        etag = f'"{self.versions[key]}"' if key in self.objects else None
+        if ("If-None-Match" in headers and etag) or ("If-Match" in headers and headers["If-Match"] != etag):
+            raise RuntimeError(f"S3 PUT {key} failed: HTTP 412 Precondition Failed")
+        self.objects[key] = data
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def doc(self, key):
+        return json.loads(self.objects[key])
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(nox.time, "sleep", lambda seconds: None)
+
+
+def append(value):
+    return lambda doc: {"items": (doc or {"items": []})["items"] + [value]}
+
+
+def interfere_once(client, key, mutate):
+    """Make another writer update key just before the next PUT to it."""
+    def before_put(k):
+        if k == key:
+            client.before_put = lambda k: None
+            nox.s3_update_json(client, key, mutate)
+    client.before_put = before_put
+
+
+def test_update_creates_then_modifies():
+    client = FakeS3()
+    assert nox.s3_update_json(client, "doc.json", append(1)) == {"items": [1]}
+    assert nox.s3_update_json(client, "doc.json", append(2)) == {"items": [1, 2]}
+    assert client.doc("doc.json") == {"items": [1, 2]}
+
+
+def test_conflicting_update_is_retried_on_the_fresh_copy():
+    client = FakeS3()
+    nox.s3_update_json(client, "doc.json", append(1))
+    interfere_once(client, "doc.json", append("other"))
+    assert nox.s3_update_json(client, "doc.json", append(2)) == {"items": [1, "other", 2]}
+    assert client.doc("doc.json") == {"items": [1, "other", 2]}
+
+
+def test_concurrent_create_is_retried():
+    client = FakeS3()
+    interfere_once(client, "doc.json", append("other"))
+    nox.s3_update_json(client, "doc.json", append(1))
+    assert client.doc("doc.json") == {"items": ["other", 1]}
+
+
+def test_persistent_conflicts_give_up():
+    client = FakeS3()
+    nox.s3_update_json(client, "doc.json", append(1))
+
+    def always_changed(key):
+        client.versions[key] += 1
+    client.before_put = always_changed
+    with pytest.raises(RuntimeError, match="too many concurrent writers"):
+        nox.s3_update_json(client, "doc.json", append(2), attempts=3)
+    assert client.doc("doc.json") == {"items": [1]}
+
+
+def test_other_errors_are_not_retried():
+    client = FakeS3()
+
+    def fail(key):
+        raise RuntimeError("S3 PUT failed: HTTP 500 Internal Server Error")
+    client.before_put = fail
+    with pytest.raises(RuntimeError, match="HTTP 500"):
+        nox.s3_update_json(client, "doc.json", append(1))
+
+
+def entry(name, timestamp, size=100):
+    info = {"backup_name": name, "timestamp": timestamp, "vm_name": "web"}
+    return nox.s3_manifest_entry(info, f"{nox.S3_PREFIX}{name}.tar", size)
+
+
+def test_manifest_update_merges_entries_and_syncs_the_index():
+    client = FakeS3()
+    nox.s3_manifest_update(client, "web", add=[entry("web_b", "2024-01-02_00-00-00")])
+    nox.s3_manifest_update(client, "web", add=[entry("web_a", "2024-01-01_00-00-00"),
+                                               entry("web_b", "2024-01-02_00-00-00", 250)])
+    manifest = client.doc(nox.s3_manifest_key("web"))
+    assert [b["name"] for b in manifest["backups"]] == ["web_a", "web_b"]
+    assert manifest["backups"][1]["bytes"] == 250
+    assert manifest["version"] == 2
+    assert client.doc(nox.S3_INDEX_KEY)["vms"]["web"] == {
+        "backups": 2, "latest": "2024-01-02_00-00-00", "bytes": 350, "version": 2}
+
+    nox.s3_manifest_update(client, "web", remove={"web_a", "web_b"})
+    assert client.doc(nox.s3_manifest_key("web"))["backups"] == []
+    assert client.doc(nox.S3_INDEX_KEY)["vms"]["web"] == {"backups": 0, "version": 3}
+
+
+def test_manifest_update_keeps_a_concurrent_writers_backup():
+    client = FakeS3()
+    nox.s3_manifest_update(client, "web", add=[entry("web_a", "2024-01-01_00-00-00")])
+    other = nox.s3_manifest_entry({"backup_name": "web_c", "timestamp": "2024-01-03_00-00-00"},
+                                  f"{nox.S3_PREFIX}web_c.tar", 100)
+    key = nox.s3_manifest_key("web")
+    interfere_once(client, key, lambda doc: dict(doc, backups=doc["backups"] + [other], version=doc["version"] + 1))
+    nox.s3_manifest_update(client, "web", add=[entry("web_b", "2024-01-02_00-00-00")])
+    assert [b["name"] for b in client.doc(key)["backups"]] == ["web_a", "web_b", "web_c"]
+    assert client.doc(nox.S3_INDEX_KEY)["vms"]["web"]["backups"] == 3
+
+
+def test_index_is_not_rolled_back_by_a_stale_manifest():
+    client = FakeS3()
+    nox.s3_manifest_update(client, "web", add=[entry("web_a", "2024-01-01_00-00-00")])
+    nox.s3_manifest_update(client, "db", add=[entry("db_a", "2024-01-01_00-00-00")])
+    # Another host already recorded a newer version of web's manifest in the index
+    interfere_once(client, nox.S3_INDEX_KEY,
+                   lambda doc: dict(doc, vms=dict(doc["vms"], web={"backups": 5, "version": 10})))
+    nox.s3_manifest_update(client, "web", add=[entry("web_b", "2024-01-02_00-00-00")])
+    index = client.doc(nox.S3_INDEX_KEY)
+    assert index["vms"]["web"] == {"backups": 5, "version": 10}
+    assert index["vms"]["db"]["backups"] == 1
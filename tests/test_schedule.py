@@ -0,0 +1,57 @@
+"""When the backup daemon considers a VM due."""
+
+import time
+
+import pytest
+
+import nox
+
+
+def local(*fields):
+    """Epoch time of a local wall-clock time (year, month, day, hour, minute)."""
+    return time.mktime(tuple(fields) + (0,) * (6 - len(fields)) + (0, 0, -1))
+
+
+@pytest.mark.parametrize("value, seconds", [
+    (90, 90), ("90", 90), ("45s", 45), ("30m", 1800), ("6h", 21600), ("1d", 86400), ("2w", 1209600), ("1.5h", 5400),
+])
+def test_parse_duration(value, seconds):
+    assert nox.parse_duration(value) == seconds
+
+
+def test_every_counts_from_the_last_backup():
+    last = local(2026, 10, 16, 8, 0)
+    assert nox.backup_due({"every": "6h"}, last) == last + 6 * 3600
+    assert nox.backup_due({}, last) == last + 86400
+
+
+def test_every_without_a_backup_is_due_now():
+    assert nox.backup_due({"every": "6h"}, None, now=local(2026, 10, 16, 12, 0)) <= local(2026, 10, 16, 12, 0)
+
+
+def test_at_is_due_once_per_day():
+    schedule = {"at": "02:30"}
+    now = local(2026, 10, 16, 12, 0)
+    slot = local(2026, 10, 16, 2, 30)
+    # Missed today's slot: due immediately (at the slot time)
+    assert nox.backup_due(schedule, local(2026, 10, 15, 2, 31), now) == slot
+    assert nox.backup_due(schedule, None, now) == slot
+    # Already backed up since the slot: tomorrow
+    assert nox.backup_due(schedule, local(2026, 10, 16, 2, 31), now) == local(2026, 10, 17, 2, 30)
+
+
+def test_at_before_the_slot_looks_at_yesterday():
+    now = local(2026, 10, 16, 1, 0)
+    assert nox.backup_due({"at": "02:30"}, local(2026, 10, 15, 2, 35), now) == local(2026, 10, 16, 2, 30)
+    assert nox.backup_due({"at": "02:30"}, local(2026, 10, 14, 2, 35), now) == local(2026, 10, 15, 2, 30)
+
+
+def test_schedule_for_picks_the_first_match(monkeypatch):
+    metas = {"db1": {"labels": {"tier": "db"}}, "ci1": {"fleet": "ci"}, "web1": {}}
+    monkeypatch.setattr(nox, "load_meta", metas.get)
+    schedules = [{"vms": "web*", "every": "1h"}, {"label": "tier=db", "at": "01:00"},
+                 {"label": ["fleet"], "every": "2h"}, {"vms": ["other"]}]
+    assert nox.schedule_for("web1", schedules) is schedules[0]
+    assert nox.schedule_for("db1", schedules) is schedules[1]
+    assert nox.schedule_for("ci1", schedules) is schedules[2]
+    assert nox.schedule_for("nobody", schedules[1:]) is None
@@ -0,0 +1,64 @@
+"""The NoCloud seed ISO builder, read back with a minimal ISO9660 parser."""
+
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import nox
+
+FILES = {"user-data": b"#cloud-config\nhostname: web\n" + b"x" * 5000, "meta-data": b"instance-id: web\n"}
+
+
+def read_iso(path):
+    """Return (primary, joliet) as (volume_id, {name: data}) from the root directories."""
+    with open(path, "rb") as f:
+        image = f.read()
+    trees = []
+    for sector, encoding in ((16, "ascii"), (17, "utf-16-be")):
+        vd = image[sector * nox.ISO_SECTOR:(sector + 1) * nox.ISO_SECTOR]
+        assert vd[1:6] == b"CD001"
+        volume_id = vd[40:72].decode(encoding).rstrip()
+        root_extent, root_size = struct.unpack_from("<I4xI", vd, 158)
+        directory = image[root_extent * nox.ISO_SECTOR:root_extent * nox.ISO_SECTOR + root_size]
+        files, offset = {}, 0
+        while offset < len(directory) and directory[offset]:
+            length = directory[offset]
+            extent, size = struct.unpack_from("<I4xI", directory, offset + 2)
+            name = directory[offset + 33:offset + 33 + directory[offset + 32]]
+            if not directory[offset + 25] & 2:
+                files[name.decode(encoding)] = image[extent * nox.ISO_SECTOR:extent * nox.ISO_SECTOR + size]
+            offset += length
+        trees.append((volume_id, files))
+    return trees
+
+
+def test_seed_iso_has_primary_and_joliet_trees(tmp_path):
+    path = str(tmp_path / "seed.iso")
+    nox.build_seed_iso(path, FILES)
+    (volume_id, primary), (joliet_id, joliet) = read_iso(path)
+    assert volume_id == joliet_id == "cidata"
+    assert joliet == FILES
+    assert primary == {"USER_DAT.;1": FILES["user-data"], "META_DAT.;1": FILES["meta-data"]}
+
+
+def test_write_seed_iso_reads_the_files_next_to_the_vm(tmp_path):
+    for name, data in FILES.items():
+        (tmp_path / name).write_bytes(data)
+    path = nox.write_seed_iso(str(tmp_path))
+    assert read_iso(path)[1][1] == FILES
+    assert not (tmp_path / "cloud-init.iso.tmp").exists()
+
+
+def test_colliding_level1_names_are_refused(tmp_path):
+    with pytest.raises(RuntimeError, match="collide"):
+        nox.build_seed_iso(str(tmp_path / "seed.iso"), {"meta-data": b"", "meta-dat": b""})
+
+
+@pytest.mark.skipif(not shutil.which("bsdtar"), reason="bsdtar not installed")
+def test_seed_iso_is_readable_by_libarchive(tmp_path):
+    path = str(tmp_path / "seed.iso")
+    nox.build_seed_iso(path, FILES)
+    for name, data in FILES.items():
+        assert subprocess.run(["bsdtar", "-xOf", path, name], capture_output=True, check=True).stdout == data